@@ -0,0 +1,1013 @@
+# -*- coding: utf-8 -*-
+"""
+微基准测试
+
+由 loadtest.py --bench NAME 运行，每项返回一个结果字典；--bench-size 覆盖默认规模。
+
+用法:
+    python loadtest.py --bench panel-store
+    python loadtest.py --bench panel-store --bench-size 10000 --json
+"""
+import atexit
+import gc
+import json
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, Tuple
+
+# 名称 -> (函数, 默认规模)
+BENCHMARKS: Dict[str, Tuple[Callable[[int], dict], int]] = {}
+
+
+def benchmark(name: str, size: int):
+    """注册一项基准测试，函数接收规模参数，可以是协程函数"""
+    def register(fn):
+        BENCHMARKS[name] = (fn, size)
+        return fn
+    return register
+
+
+def import_main():
+    """导入main，数据目录指向临时目录，不会混入部署环境的数据"""
+    os.environ.setdefault('DISCORD_TOKEN', 'loadtest')
+    os.environ.setdefault('NAI_API_KEY', 'loadtest')
+    data_dir = tempfile.mkdtemp(prefix='nai-bench-')
+    atexit.register(shutil.rmtree, data_dir, True)
+    os.environ['DATA_DIR'] = data_dir
+    import main
+    return main
+
+
+def traced_bytes(build: Callable[[], object]) -> Tuple[int, object]:
+    """build() 返回的对象在tracemalloc下新增的内存"""
+    gc.collect()
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    obj = build()
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    return used, obj
+
+
+def latency_us(fn: Callable[[object], object], args) -> Dict[str, float]:
+    """对每个参数调用一次 fn，返回耗时的分位数（微秒）"""
+    samples = []
+    for arg in args:
+        start = time.perf_counter()
+        fn(arg)
+        samples.append((time.perf_counter() - start) * 1e6)
+    samples.sort()
+    return {'p50': samples[len(samples) // 2], 'p99': samples[int(len(samples) * 0.99)], 'max': samples[-1]}
+
+
+def ops_per_s(fn: Callable[[], object], n: int) -> float:
+    start = time.perf_counter()
+    for _ in range(n):
+        fn()
+    elapsed = time.perf_counter() - start
+    return n / elapsed if elapsed else 0.0
+
+
+@benchmark('panel-store', 100_000)
+def bench_panel_store(users: int) -> dict:
+    """
+    面板会话内存
+
+    users 个用户各打开一次面板：原来的 panel_states 为每个用户保存一份设置字典的副本，
+    现在是 PanelSessionStore 中的 PanelState。
+    """
+    from panel_store import PANEL_MAX_SESSIONS, PanelSessionStore, PanelState
+
+    user_ids = [str(10**17 + i) for i in range(users)]
+    # 与 load_user_settings 相同，每个用户的设置来自独立解析的JSON
+    settings = [json.loads(json.dumps(PanelState().to_dict())) for _ in user_ids]
+
+    def before():
+        panel_states = {}
+        for user_id, data in zip(user_ids, settings):
+            panel_states[user_id] = data.copy()
+        return panel_states
+
+    def after(max_size=users):
+        store = PanelSessionStore(max_size=max_size)
+        for user_id, data in zip(user_ids, settings):
+            store.put(user_id, PanelState.from_dict(data))
+        return store
+
+    before_bytes, _ = traced_bytes(before)
+    after_bytes, store = traced_bytes(after)
+    capped_bytes, capped = traced_bytes(lambda: after(PANEL_MAX_SESSIONS))
+
+    lookups = iter(user_ids * 2)
+    return {
+        'users': users,
+        'before_mb': before_bytes / 1e6,
+        'before_b_per_user': before_bytes / users,
+        'after_mb': after_bytes / 1e6,
+        'after_b_per_user': after_bytes / users,
+        'capped_mb': capped_bytes / 1e6,
+        'capped_sessions': len(capped),
+        'capped_evictions': capped.evictions,
+        'get_per_s': ops_per_s(lambda: store.get(next(lookups)), users)
+    }
+
+
+@benchmark('panel-render', 100_000)
+def bench_panel_render(clicks: int) -> dict:
+    """
+    面板点击的渲染开销
+
+    随机状态上的点击次数/秒：冷路径每次清空渲染缓存（相当于原来每次点击都重建Embed和
+    下拉菜单），热路径使用共享渲染器的缓存。
+    """
+    import random
+
+    import discord
+
+    import panel_renderer
+    from constants import MODELS, SAMPLER_OPTIONS, SIZE_OPTIONS
+    from panel_store import PanelState
+
+    rng = random.Random(0)
+    states = [
+        PanelState(model=rng.choice(list(MODELS)), size=rng.choice(SIZE_OPTIONS)[1],
+                   sampler=rng.choice(SAMPLER_OPTIONS)[1], remove_metadata=rng.random() < 0.5)
+        for _ in range(1000)
+    ]
+    presets = tuple(f'preset{i}' for i in range(10))
+    caches = (panel_renderer._render_embed, panel_renderer.select_options, panel_renderer.preset_options)
+
+    def clear():
+        for cache in caches:
+            cache.cache_clear()
+
+    def click(cold):
+        state = states[rng.randrange(len(states))]
+        if cold:
+            clear()
+        return panel_renderer.build_panel_embed(state)
+
+    def open_panel(cold):
+        state = states[rng.randrange(len(states))]
+        if cold:
+            clear()
+        view = discord.ui.View(timeout=None)
+        panel_renderer.add_panel_items(view, state, presets)
+        return view, panel_renderer.build_panel_embed(state)
+
+    report = {'clicks': clicks}
+    for name, fn, n in (('click', click, clicks), ('open', open_panel, max(1, clicks // 10))):
+        report[f'{name}_cold_per_s'] = ops_per_s(lambda: fn(True), n)
+        clear()
+        report[f'{name}_cached_per_s'] = ops_per_s(lambda: fn(False), n)
+    return report
+
+
+@benchmark('preset-index', 100_000)
+def bench_preset_index(users: int) -> dict:
+    """
+    预设自动补全
+
+    一个用户有1万个预设时的前缀和模糊查询延迟（对比原来对全部名称的子串扫描），
+    以及 users 个用户（每人1-5个预设）全部建立索引后的内存和查询延迟。
+    """
+    import random
+
+    from preset_index import PresetIndex, PresetIndexStore
+
+    rng = random.Random(0)
+    words = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(3, 8))) for _ in range(2000)]
+
+    def preset_name():
+        return '_'.join(rng.sample(words, rng.randint(1, 3)))
+
+    names = set()
+    while len(names) < 10_000:
+        names.add(preset_name())
+    names = list(names)
+    start = time.perf_counter()
+    index = PresetIndex(names)
+    build_ms = (time.perf_counter() - start) * 1000
+    prefixes = [name[:rng.randint(1, 4)] for name in rng.sample(names, 1000)]
+    # 模糊查询：名称中间的一段，偶尔带一个错字
+    fuzzy = []
+    for name in rng.sample(names, 1000):
+        start = rng.randrange(max(1, len(name) - 5))
+        query = name[start:start + 6]
+        if rng.random() < 0.3:
+            query = query[:2] + rng.choice('xyz') + query[3:]
+        fuzzy.append(query)
+
+    def linear(query):
+        query = query.lower()
+        return [name for name in names if query in name.lower()][:25]
+
+    report = {
+        'presets': len(names),
+        'build_ms': build_ms,
+        'prefix_us': latency_us(index.search, prefixes),
+        'fuzzy_us': latency_us(index.search, fuzzy),
+        'linear_scan_us': latency_us(linear, prefixes),
+        'add_remove_us': latency_us(lambda name: (index.add(name), index.remove(name)),
+                                    [preset_name() + '_new' for _ in range(1000)])
+    }
+
+    user_names = {str(10**17 + i): [preset_name() for _ in range(rng.randint(1, 5))] for i in range(users)}
+    store = PresetIndexStore(user_names.__getitem__)
+    index_bytes, _ = traced_bytes(lambda: [store.get(user_id) for user_id in user_names])
+    queries = [(user_id, user_names[user_id][0][:2]) for user_id in rng.sample(list(user_names), 1000)]
+    report.update({
+        'users': users,
+        'indexes_mb': index_bytes / 1e6,
+        'user_query_us': latency_us(lambda item: store.search(*item), queries)
+    })
+    return report
+
+
+@benchmark('gateway', 2000)
+def bench_gateway(guilds: int) -> dict:
+    """
+    网关缓存
+
+    把 guilds 个合成的 GUILD_CREATE 载荷（每个10个频道、5个成员）送入bot的连接状态，
+    订阅了消息intent时再送入5000条 MESSAGE_CREATE（精简模式下Discord不会发送这些事件）。
+    按 LEAN_GATEWAY 的当前值运行，设置 LEAN_GATEWAY=false 后再运行一次即可对比。
+    """
+    main = import_main()
+    import discord
+
+    state = main.bot._connection
+    state.dispatch = lambda *args, **kwargs: None
+
+    def guild(i):
+        members = [{'user': {'id': str(3 * 10**17 + i * 1000 + m), 'username': f'u{m}', 'discriminator': '0', 'avatar': None},
+                    'roles': [], 'joined_at': '2024-01-01T00:00:00+00:00', 'deaf': False, 'mute': False, 'flags': 0}
+                   for m in range(5)]
+        return {
+            'id': str(10**17 + i), 'name': f'g{i}', 'member_count': 500, 'unavailable': False, 'features': [],
+            'roles': [{'id': str(10**17 + i), 'name': '@everyone', 'permissions': '0', 'position': 0, 'color': 0,
+                       'hoist': False, 'managed': False, 'mentionable': False}],
+            'channels': [{'id': str(2 * 10**17 + i * 10 + c), 'type': 0, 'name': f'c{c}', 'position': c,
+                          'permission_overwrites': []} for c in range(10)],
+            'members': members,
+            'presences': [{'user': {'id': m['user']['id']}, 'status': 'online', 'activities': [], 'client_status': {}}
+                          for m in members],
+            'emojis': [], 'stickers': [], 'voice_states': [], 'threads': [], 'stage_instances': [],
+            'guild_scheduled_events': []
+        }
+
+    def message(k):
+        i = k % guilds
+        return {'id': str(4 * 10**17 + k), 'channel_id': str(2 * 10**17 + i * 10), 'guild_id': str(10**17 + i),
+                'author': {'id': str(3 * 10**17 + i * 1000), 'username': 'u0', 'discriminator': '0', 'avatar': None},
+                'content': 'x' * 200, 'timestamp': '2024-01-01T00:00:00+00:00', 'edited_timestamp': None, 'tts': False,
+                'mention_everyone': False, 'mentions': [], 'mention_roles': [], 'attachments': [], 'embeds': [],
+                'pinned': False, 'type': 0}
+
+    payloads = [guild(i) for i in range(guilds)]
+    messages = [message(k) for k in range(5000)] if state._intents.guild_messages else []
+
+    def feed():
+        state.clear()
+        for data in payloads:
+            state._add_guild(discord.Guild(data=data, state=state))
+        for data in messages:
+            state.parse_message_create(data)
+        return state
+
+    start = time.perf_counter()
+    feed()
+    parse_s = time.perf_counter() - start
+    cache_bytes, _ = traced_bytes(feed)
+    return {
+        'lean': main.LEAN_GATEWAY,
+        'guilds': len(state.guilds),
+        'cached_members': sum(len(g._members) for g in state.guilds),
+        'cached_messages': len(state._messages or ()),
+        'parse_s': parse_s,
+        'cache_mb': cache_bytes / 1e6
+    }
+
+
+@benchmark('request-compiler', 20_000)
+def bench_request_compiler(n: int) -> dict:
+    """
+    请求体序列化
+
+    compile_request 生成的请求体（500重试直接复用 fallback_body）对比按请求字典
+    每次尝试都用 json.dumps 序列化（原来 aiohttp 的 json= 参数，重试时再序列化一次）。
+    对比只计序列化，不含原来逐任务重建默认参数和V4提示词字典的开销。图生图带3MB的图片，迭代次数为 n/400。
+    """
+    import base64
+    import random
+
+    import request_compiler
+    from request_compiler import compile_request
+
+    image = base64.b64encode(random.Random(0).randbytes(3_000_000)).decode()
+    base = dict(prompt='1girl, 猫耳, solo, looking at viewer', model='nai-diffusion-4-5-full', width=832, height=1216,
+                steps=28, cfg=5.5, sampler='k_euler_ancestral', n_samples=1)
+    cases = (
+        ('v3_txt2img', dict(base, model='nai-diffusion-3'), n),
+        ('v45_txt2img', base, n),
+        ('v45_img2img_3mb', dict(base, image=image), max(1, n // 400)),
+    )
+
+    report = {'orjson': request_compiler.orjson is not None}
+    for name, params, iterations in cases:
+        compiled = compile_request(params, 1234)
+        payload = json.loads(compiled.body)
+        if compiled.fallback_body is not None:
+            fallback = json.loads(compiled.fallback_body)
+            # 简化重试的请求体应当正好少了V4提示词字段
+            trimmed = dict(payload, parameters={key: value for key, value in payload['parameters'].items()
+                                                if key not in ('v4_prompt', 'v4_negative_prompt')})
+            report[f'{name}_fallback_ok'] = fallback == trimmed
+
+        def old(retry):
+            body = json.dumps(payload).encode()
+            if retry:
+                body = json.dumps(fallback).encode()
+            return body
+
+        for retry in (False, True):
+            if retry and compiled.fallback_body is None:
+                continue
+            suffix = '_retry' if retry else ''
+            report[f'{name}{suffix}_before_us'] = 1e6 / ops_per_s(lambda: old(retry), iterations)
+            report[f'{name}{suffix}_after_us'] = 1e6 / ops_per_s(lambda: compile_request(params, 1234), iterations)
+    return report
+
+
+@benchmark('prompt-tokens', 5000)
+def bench_prompt_tokens(prompts: int) -> dict:
+    """
+    提示词token计数
+
+    prompts 条 "预设, 提示词" 形式的合并提示词每秒的计数次数：整段BPE、按逗号分段缓存和估算，
+    并检查分段计数之和与整段计数一致。TOKENIZER_DIR 下没有CLIP词表时使用合成的merges
+    （2000个随机单词各自合并为一个token），结果只用于比较缓存的效果。
+    """
+    import gzip
+    import random
+
+    import prompt_tokens
+
+    rng = random.Random(2)
+    words = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(3, 12))) for _ in range(3000)]
+    synthetic = not (prompt_tokens.TOKENIZER_DIR / prompt_tokens.CLIP_VOCAB_FILE).exists()
+    if synthetic:
+        merges = []
+        for word in words[:2000]:
+            parts = list(word[:-1]) + [word[-1] + '</w>']
+            while len(parts) > 1:
+                merges.append(f'{parts[0]} {parts[1]}')
+                parts[:2] = [parts[0] + parts[1]]
+        vocab_dir = tempfile.mkdtemp(prefix='nai-bench-')
+        atexit.register(shutil.rmtree, vocab_dir, True)
+        with gzip.open(os.path.join(vocab_dir, prompt_tokens.CLIP_VOCAB_FILE), 'wt', encoding='utf-8') as f:
+            f.write('#version\n' + '\n'.join(dict.fromkeys(merges)))
+        prompt_tokens.TOKENIZER_DIR = prompt_tokens.Path(vocab_dir)
+    clip = prompt_tokens.load_tokenizers()['clip']
+
+    def tag(pool=None):
+        return rng.choice(pool) if pool else ' '.join(rng.choices(words, k=rng.randint(1, 3)))
+
+    presets = [', '.join(tag() for _ in range(40)) for _ in range(20)]
+
+    def merged(pool=None):
+        return rng.choice(presets) + ', ' + ', '.join(tag(pool) for _ in range(rng.randint(5, 25)))
+
+    unique = [merged() for _ in range(prompts)]
+    # 标签来自有限的词表时更接近真实提示词
+    tags = [tag() for _ in range(1500)]
+    pooled = [merged(tags) for _ in range(prompts)]
+
+    def per_s(fn, texts):
+        start = time.perf_counter()
+        for text in texts:
+            fn(text)
+        return len(texts) / (time.perf_counter() - start)
+
+    def fragments(text):
+        return prompt_tokens.count_tokens('clip', text)
+
+    report = {
+        'synthetic_vocab': synthetic,
+        'fragment_sum_exact': all(fragments(text) == clip.count(text) for text in unique[:500])
+    }
+    for name, texts in (('unique', unique), ('tag_pool', pooled)):
+        clip._bpe.cache_clear()
+        prompt_tokens._fragment_tokens.cache_clear()
+        report[f'{name}_bpe_per_s'] = per_s(clip.count, texts)
+        report[f'{name}_fragment_cold_per_s'] = per_s(fragments, texts)
+        report[f'{name}_fragment_warm_per_s'] = per_s(fragments, texts)
+        info = prompt_tokens._fragment_tokens.cache_info()
+        report[f'{name}_fragment_hit_rate'] = info.hits / (info.hits + info.misses)
+    report['estimate_per_s'] = per_s(prompt_tokens.estimate_tokens, unique)
+    return report
+
+
+def free_port() -> int:
+    import socket
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@benchmark('supervisor', 5)
+async def bench_supervisor(crashes: int) -> dict:
+    """
+    连接崩溃后的恢复时间
+
+    启动模拟的Discord REST和网关服务，在进程内运行 main.main_async()，之后关闭网关连接
+    crashes 次（4012为不可恢复的关闭码，discord.py不会自行重连），测量从关闭到 /readyz 恢复200的时间，
+    并检查队列和生成历史等进程级状态在重启后仍然存在。
+    """
+    import asyncio
+
+    import aiohttp
+    import discord.gateway
+    import discord.http
+    import yarl
+    from aiohttp import web
+
+    fake_port, http_port = free_port(), free_port()
+    user = {'id': '1', 'username': 'bot', 'discriminator': '0', 'global_name': None, 'avatar': None, 'bot': True}
+    sockets = []
+
+    def reply(data):
+        # discord.py 只在 content-type 恰好为 application/json 时解析（json_response 会附加charset）
+        body = json.dumps(data).encode()
+        return lambda request: web.Response(body=body, content_type='application/json')
+
+    async def gateway(request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        sockets.append(ws)
+        await ws.send_json({'op': 10, 'd': {'heartbeat_interval': 41250}})
+        async for msg in ws:
+            if json.loads(msg.data)['op'] == 2:
+                await ws.send_json({'op': 0, 's': 1, 't': 'READY', 'd': {
+                    'v': 10, 'user': user, 'guilds': [], 'session_id': 's',
+                    'resume_gateway_url': f'ws://127.0.0.1:{fake_port}/gw', 'application': {'id': '1', 'flags': 0}}})
+        return ws
+
+    app = web.Application()
+    app.router.add_get('/api/v10/users/@me', reply(user))
+    app.router.add_get('/api/v10/oauth2/applications/@me', reply({
+        'id': '1', 'name': 'bot', 'description': '', 'icon': None, 'bot_public': True, 'bot_require_code_grant': False,
+        'owner': user, 'verify_key': 'k', 'flags': 0, 'team': None, 'summary': ''}))
+    app.router.add_put('/api/v10/applications/1/commands', reply([]))
+    app.router.add_get('/api/v10/gateway/bot', reply({
+        'url': f'ws://127.0.0.1:{fake_port}/gw', 'shards': 1,
+        'session_start_limit': {'total': 1000, 'remaining': 1000, 'reset_after': 0, 'max_concurrency': 1}}))
+    app.router.add_get('/gw', gateway)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', fake_port).start()
+    discord.http.Route.BASE = f'http://127.0.0.1:{fake_port}/api/v10'
+    discord.gateway.DiscordWebSocket.DEFAULT_GATEWAY = yarl.URL(f'ws://127.0.0.1:{fake_port}/gw')
+
+    # 令牌需要是 x.y.z 的形式；PORT 在导入main时读取
+    os.environ['DISCORD_TOKEN'] = 'bench.bench.bench'
+    os.environ['PORT'] = str(http_port)
+    start = time.perf_counter()
+    main = import_main()
+    bot_task = asyncio.create_task(main.main_async())
+
+    async def wait_ready(session, since, ready=True):
+        while True:
+            try:
+                async with session.get(f'http://127.0.0.1:{http_port}/readyz') as response:
+                    if (response.status == 200) == ready:
+                        return time.perf_counter() - since
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.005)
+
+    recoveries = []
+    try:
+        async with aiohttp.ClientSession() as session:
+            cold_start_s = await asyncio.wait_for(wait_ready(session, start), 30)
+            for _ in range(crashes):
+                since = time.perf_counter()
+                for ws in sockets:
+                    await ws.close(code=4012)
+                sockets.clear()
+                await asyncio.wait_for(wait_ready(session, since, ready=False), 10)
+                recoveries.append(await asyncio.wait_for(wait_ready(session, since), 60))
+        state_kept = main.task_queue is not None and main.history_log._records is not None
+    finally:
+        bot_task.cancel()
+        try:
+            await bot_task
+        except asyncio.CancelledError:
+            pass
+        await runner.cleanup()
+    return {
+        'cold_start_s': cold_start_s,
+        'recoveries_s': ' '.join(f'{took:.2f}' for took in recoveries),
+        'state_kept': state_kept
+    }
+
+
+@benchmark('runtime-config', 600)
+async def bench_runtime_config(deliveries: int) -> dict:
+    """
+    运行中调整配置
+
+    deliveries 个模拟上传（每个20ms）经过上传队列，期间依次把上传并发改为 16/2/8/1/32/4，
+    检查每个结果恰好送达一次、每次调整100ms后的协程数和上传峰值；另外测量应用一次修改的耗时
+    （只在内存中 / 含原子写文件），以及直接编辑配置文件后被轮询发现的时间。
+    """
+    import asyncio
+
+    main = import_main()
+    store = main.runtime_config
+    delivered = []
+    inflight = [0, 0]
+
+    async def fake_deliver(delivery):
+        inflight[0] += 1
+        inflight[1] = max(inflight[1], inflight[0])
+        await asyncio.sleep(0.02)
+        inflight[0] -= 1
+        delivered.append(delivery)
+
+    main.deliver_result = fake_deliver
+    main.ensure_delivery_workers()
+
+    async def produce():
+        for i in range(deliveries):
+            await main.delivery_queue.put(i)
+
+    producer = asyncio.create_task(produce())
+    resizes = []
+    for target in (16, 2, 8, 1, 32, 4):
+        await asyncio.sleep(0.15)
+        await store.update({'delivery_concurrency': target})
+        inflight[1] = 0
+        await asyncio.sleep(0.1)
+        resizes.append(f'{target}:{len(main.delivery_workers)}/{inflight[1]}')
+    await producer
+    await main.delivery_queue.join()
+
+    async def apply_us(fn):
+        samples = []
+        for i in range(200):
+            start = time.perf_counter()
+            result = fn({'job_timeout': 60 + i % 2})
+            if asyncio.iscoroutine(result):
+                await result
+            samples.append((time.perf_counter() - start) * 1e6)
+        samples.sort()
+        return {'p50': samples[100], 'p99': samples[198]}
+
+    report = {
+        'deliveries': deliveries,
+        'delivered_once': len(delivered) == len(set(delivered)) == deliveries,
+        # 目标并发:100ms后的协程数/上传峰值
+        'resizes': ' '.join(resizes),
+        'apply_us': await apply_us(lambda changes: store._apply(changes, 'bench')),
+        # 包含在线程中写文件
+        'update_with_file_us': await apply_us(store.update)
+    }
+
+    store.start(0.05)
+    try:
+        store.path.write_text('{"generation_concurrency": 3}', encoding='utf-8')
+        start = time.perf_counter()
+        while store.current.generation_concurrency != 3:
+            await asyncio.sleep(0.005)
+        report['file_edit_picked_up_ms'] = (time.perf_counter() - start) * 1000
+        # 无效的文件保留当前配置
+        store.path.write_text('{"generation_concurrency": 99}', encoding='utf-8')
+        await asyncio.sleep(0.2)
+        report['invalid_file_kept'] = store.current.generation_concurrency == 3
+    finally:
+        store.stop()
+    return report
+
+
+@benchmark('queued-jobs', 10_000)
+def bench_queued_jobs(jobs: int) -> dict:
+    """
+    排队任务的内存
+
+    jobs 个由服务器内 /nai 命令载荷构建的交互：原来队列中的字典任务持有整个 discord.Interaction
+    （及其用户、成员、频道对象）和参数字典，现在只保存 Job 和 JobParams。
+    """
+    import discord
+
+    from jobs import Job, JobParams
+
+    client = discord.Client(intents=discord.Intents.default())
+    state = client._connection
+    state.user = discord.ClientUser(state=state, data={
+        'id': '4321', 'username': 'nai-bot', 'discriminator': '0', 'avatar': None, 'bot': True})
+    prompt = '1girl, solo, masterpiece ' * 8
+
+    def payload(i):
+        return {
+            'id': str(10**18 + i), 'application_id': '1234', 'type': 2, 'token': 'aW50ZXJhY3Rpb246' + 'x' * 180 + str(i),
+            'version': 1, 'attachment_size_limit': 10485760, 'guild_id': '999', 'channel_id': '888',
+            'locale': 'zh-CN', 'guild_locale': 'zh-CN', 'app_permissions': '0', 'entitlements': [],
+            'authorizing_integration_owners': {'0': '999'}, 'context': 0,
+            'channel': {'id': '888', 'type': 0, 'guild_id': '999', 'name': 'nai', 'position': 1,
+                        'permission_overwrites': [], 'nsfw': False, 'parent_id': None, 'rate_limit_per_user': 0,
+                        'topic': None, 'last_message_id': None, 'flags': 0},
+            'data': {'id': '555', 'name': 'nai', 'type': 1,
+                     'options': [{'name': 'prompt', 'type': 3, 'value': prompt}]},
+            'member': {'user': {'id': str(10**17 + i), 'username': f'user{i}', 'discriminator': '0',
+                                'global_name': f'User {i}', 'avatar': 'a' * 32},
+                       'roles': ['1', '2', '3'], 'joined_at': '2024-01-01T00:00:00+00:00', 'deaf': False,
+                       'mute': False, 'flags': 0, 'permissions': '2147483647', 'nick': None, 'avatar': None,
+                       'premium_since': None, 'pending': False}
+        }
+
+    def params():
+        # 每次命令解析出的都是独立的字符串
+        return {'prompt': ''.join(prompt), 'negative_prompt': None, 'model': ''.join('nai-diffusion-4-5-full'),
+                'width': 832, 'height': 1216, 'steps': 28, 'cfg': 5, 'sampler': ''.join('k_euler_ancestral'),
+                'seed': -1, 'smea': False, 'dyn': False, 'remove_metadata': False, 'stream': False, 'n_samples': 1}
+
+    def before():
+        return [{'interaction': discord.Interaction(data=payload(i), state=state), 'enqueued_at': time.monotonic(),
+                 'params': params(), 'predicted': 12.3} for i in range(jobs)]
+
+    def after():
+        queue = []
+        for i in range(jobs):
+            job = Job.from_interaction(discord.Interaction(data=payload(i), state=state), JobParams(**params()))
+            job.predicted = 12.3
+            queue.append(job)
+        return queue
+
+    before_bytes, _ = traced_bytes(before)
+    after_bytes, _ = traced_bytes(after)
+    return {
+        'jobs': jobs,
+        'before_mb': before_bytes / 1e6,
+        'before_b_per_job': before_bytes / jobs,
+        'after_mb': after_bytes / 1e6,
+        'after_b_per_job': after_bytes / jobs
+    }
+
+
+@benchmark('preset-library', 100_000)
+def bench_preset_library(users: int) -> dict:
+    """
+    预设存储
+
+    users 个用户（每人1-5个预设，提示词来自40套常见质量标签和25套负面标签，部分带个人标签）的
+    user_presets.json 迁移到 preset_library.log 后，对比文件大小、加载耗时、加载后的内存、
+    展开一个预设和保存一个预设的耗时，并抽查展开结果与原文一致。
+    """
+    import random
+
+    from preset_library import LEGACY_FILE_NAME, LIBRARY_FILE_NAME, PresetLibrary
+
+    rng = random.Random(1)
+    quality = ['masterpiece', 'best quality', 'amazing quality', 'very aesthetic', 'absurdres', 'highres',
+               'ultra-detailed', 'newest', 'year 2024', 'detailed eyes', 'beautiful detailed', 'extremely detailed CG',
+               'official art', 'incredibly absurdres']
+    negative = ['lowres', 'bad anatomy', 'bad hands', 'text', 'error', 'missing fingers', 'extra digit', 'fewer digits',
+                'cropped', 'worst quality', 'low quality', 'normal quality', 'jpeg artifacts', 'signature', 'watermark',
+                'username', 'blurry', 'nsfw', 'artist name', 'bad feet', 'multiple views', 'sketch', 'censored']
+    vocab = [f'tag{i} style' for i in range(2000)] + ['1girl', 'solo', 'silver hair', 'blue eyes', 'smile',
+                                                       'looking at viewer', 'school uniform', 'outdoors']
+    # 社区常见的若干套标签，用户复制后偶尔改动
+    quality_sets = [', '.join(rng.sample(quality, rng.randint(4, 9))) for _ in range(40)]
+    negative_sets = [', '.join(rng.sample(negative, rng.randint(8, 18))) for _ in range(25)]
+
+    legacy = {}
+    for u in range(users):
+        presets = {}
+        for p in range(rng.randint(1, 5)):
+            prompt = rng.choice(quality_sets)
+            if rng.random() < 0.2:
+                prompt += ', ' + rng.choice(quality)
+            if rng.random() < 0.6:
+                prompt += ', ' + ', '.join(rng.sample(vocab, rng.randint(0, 6)))
+            presets[f'preset{p}'] = {'prompt': prompt, 'negative': rng.choice(negative_sets) if rng.random() < 0.9 else ''}
+        legacy[str(10**17 + u)] = presets
+
+    directory = tempfile.mkdtemp(prefix='nai-bench-')
+    try:
+        legacy_path = os.path.join(directory, LEGACY_FILE_NAME)
+
+        def save_legacy():
+            # 与 utils.save_json_file 相同的格式
+            with open(legacy_path, 'w', encoding='utf-8') as f:
+                json.dump(legacy, f, ensure_ascii=False, indent=2)
+
+        save_legacy()
+        start = time.perf_counter()
+        PresetLibrary(directory).load()
+        migration_s = time.perf_counter() - start
+
+        def load_legacy():
+            with open(legacy_path, encoding='utf-8') as f:
+                return json.load(f)
+
+        def load_library():
+            library = PresetLibrary(directory)
+            library.load()
+            return library
+
+        report = {'users': users, 'presets': sum(len(presets) for presets in legacy.values()),
+                  'migration_s': migration_s}
+        for name, load, file_name in (('before', load_legacy, LEGACY_FILE_NAME),
+                                      ('after', load_library, LIBRARY_FILE_NAME)):
+            best = float('inf')
+            for _ in range(3):
+                gc.collect()
+                start = time.perf_counter()
+                load()
+                best = min(best, time.perf_counter() - start)
+            resident, _ = traced_bytes(load)
+            report[f'{name}_file_mb'] = os.path.getsize(os.path.join(directory, file_name)) / 1e6
+            report[f'{name}_load_ms'] = best * 1000
+            report[f'{name}_resident_mb'] = resident / 1e6
+
+        library = load_library()
+        report['expanded_ok'] = all(
+            library.get(user_id, name) == (data['prompt'], data['negative'])
+            for user_id in rng.sample(list(legacy), min(users, 2000)) for name, data in legacy[user_id].items()
+        )
+        user_ids = list(legacy)[:20000]
+        start = time.perf_counter()
+        for user_id in user_ids:
+            library.get(user_id, 'preset0')
+        report['expand_us'] = (time.perf_counter() - start) / len(user_ids) * 1e6
+
+        start = time.perf_counter()
+        library.put('1', 'bench', quality_sets[0], negative_sets[0])
+        report['after_save_ms'] = (time.perf_counter() - start) * 1000
+        legacy['1'] = {'bench': {'prompt': quality_sets[0], 'negative': negative_sets[0]}}
+        start = time.perf_counter()
+        save_legacy()
+        report['before_save_ms'] = (time.perf_counter() - start) * 1000
+        return report
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+@benchmark('contact-sheet', 5)
+def bench_contact_sheet(rounds: int) -> dict:
+    """
+    拼图耗时和大小
+
+    把 4 张和 9 张 832×1216 的结果拼成一张JPEG，每种预热一次后取 rounds 次的平均耗时，
+    并和原图PNG的总大小对比。原图是随机噪声，PNG基本无法压缩，是最坏情况。
+    """
+    import io
+
+    from PIL import Image
+
+    from image_processor import compose_contact_sheet
+
+    image = Image.frombytes('RGB', (832, 1216), os.urandom(832 * 1216 * 3))
+    buffer = io.BytesIO()
+    image.save(buffer, 'PNG', compress_level=1)
+    png = buffer.getvalue()
+
+    report = {'rounds': rounds, 'tile': '832x1216'}
+    for tiles in (4, 9):
+        images = [(png, 1000 + i) for i in range(tiles)]
+        compose_contact_sheet(images)
+        start = time.perf_counter()
+        for _ in range(rounds):
+            sheet = compose_contact_sheet(images)
+        report[f'tiles_{tiles}'] = {
+            'ms': (time.perf_counter() - start) / rounds * 1000,
+            'sheet_mb': len(sheet) / 1e6,
+            'originals_mb': len(png) * tiles / 1e6
+        }
+    return report
+
+
+@benchmark('history-log', 1_000_000)
+def bench_history_log(records: int) -> dict:
+    """
+    历史记录日志的追加和查询
+
+    5000 个用户交替写入 records 条记录，然后重新打开日志（扫描重建每个用户的索引），
+    再测按编号读取和每用户分页（第一页加下一页）的速度。
+    """
+    import random
+
+    from history_log import RECORD, HistoryLog
+
+    users = 5000
+    rng = random.Random(42)
+    params = {'prompt': '1girl, solo, masterpiece, best quality, looking at viewer', 'negative_prompt': 'lowres',
+              'model': 'nai-diffusion-3', 'sampler': 'k_euler_ancestral', 'width': 832, 'height': 1216,
+              'steps': 28, 'cfg': 5, 'n_samples': 1, 'smea': True}
+    directory = tempfile.mkdtemp(prefix='nai-bench-history-')
+    try:
+        log = HistoryLog(directory)
+        start = time.perf_counter()
+        for _ in range(records):
+            log.append(rng.randint(1, users), params, rng.getrandbits(32))
+        append_s = time.perf_counter() - start
+        log.close()
+
+        log = HistoryLog(directory)
+        gc.collect()
+        tracemalloc.start()
+        start = time.perf_counter()
+        len(log)
+        reopen_s = time.perf_counter() - start
+        reopen_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        get_per_s = ops_per_s(lambda: log.get(rng.randrange(records)), 20000)
+
+        def two_pages():
+            page = log.page(rng.randint(1, users), limit=10)
+            if page:
+                log.page(page[-1].user_id, before=page[-1].record_id, limit=10)
+
+        page_per_s = ops_per_s(two_pages, 2000) * 2
+        log.close()
+        return {
+            'records': records,
+            'users': users,
+            'record_bytes': RECORD.size,
+            'file_mb': sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory)) / 1e6,
+            'append_per_s': records / append_s,
+            'reopen_s': reopen_s,
+            'reopen_peak_mb': reopen_peak / 1e6,
+            'get_per_s': get_per_s,
+            'page_per_s': page_per_s
+        }
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+@benchmark('logging', 1000)
+async def bench_logging(lines: int) -> dict:
+    """
+    stdout写得慢时的事件循环延迟
+
+    stdout换成一个管道，由后台线程每100毫秒只读16KB（模拟慢速的日志收集器）。
+    事件循环每5毫秒写一条2KB的日志，同时每10毫秒测一次调度延迟：
+    direct 是StreamHandler直接写管道，queue 是 log_setup 的QueueHandler加后台线程写出。
+    """
+    import asyncio
+    import logging
+    import sys
+    import threading
+
+    import log_setup
+
+    def slow_reader(fd):
+        while os.read(fd, 16384):
+            time.sleep(0.1)
+        os.close(fd)
+
+    logger = logging.getLogger('bench.logging')
+    root = logging.getLogger()
+    report = {'lines': lines, 'line_bytes': 2000}
+    for mode in ('direct', 'queue'):
+        read_fd, write_fd = os.pipe()
+        reader = threading.Thread(target=slow_reader, args=(read_fd,), daemon=True)
+        reader.start()
+        pipe = os.fdopen(write_fd, 'w', encoding='utf-8')
+        root_handlers, root_level = list(root.handlers), root.level
+        if mode == 'direct':
+            logger.handlers = [logging.StreamHandler(pipe)]
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+        else:
+            stdout, sys.stdout = sys.stdout, pipe
+            try:
+                log_setup.setup_logging(level='INFO', json_output=False)
+            finally:
+                sys.stdout = stdout
+            logger.handlers = []
+            logger.propagate = True
+
+        lags = []
+
+        async def probe():
+            while True:
+                start = time.perf_counter()
+                await asyncio.sleep(0.01)
+                lags.append(time.perf_counter() - start - 0.01)
+
+        task = asyncio.create_task(probe())
+        start = time.perf_counter()
+        for _ in range(lines):
+            logger.info('[生成开始] ' + 'x' * 2000)
+            await asyncio.sleep(0.005)
+        elapsed = time.perf_counter() - start
+        task.cancel()
+
+        # 等后台线程把剩余日志写完，再恢复原来的日志配置
+        await asyncio.to_thread(log_setup.stop_logging)
+        root.handlers, root.level = root_handlers, root_level
+        logger.handlers = []
+        logger.propagate = True
+        await asyncio.to_thread(pipe.close)
+        await asyncio.to_thread(reader.join)
+
+        lags.sort()
+        report[mode] = {
+            'p50_ms': lags[len(lags) // 2] * 1000,
+            'p99_ms': lags[int(len(lags) * 0.99)] * 1000,
+            'max_ms': lags[-1] * 1000,
+            'loop_s': elapsed
+        }
+    return report
+
+
+@benchmark('input-cache', 50)
+async def bench_input_cache(rounds: int) -> dict:
+    """
+    图生图输入的准备耗时（冷与热）
+
+    本地HTTP服务提供两张 1024×1536 的PNG。cold_first 是第一次准备（含进程池启动），
+    cold 是进程池已启动时准备另一张新图，warm 是 rounds 次重复准备同一张图（缓存命中）。
+    缓存按内容哈希识别，命中时仍要下载，只跳过缩放和编码，所以 warm 应接近 download。
+    """
+    import asyncio
+    import io
+    import types
+
+    from aiohttp import web
+    from PIL import Image
+
+    from input_cache import InputImageCache, fit_size
+
+    def png(seed):
+        image = Image.frombytes('RGB', (1024, 1536), os.urandom(1024 * 1536 * 3))
+        buffer = io.BytesIO()
+        image.save(buffer, 'PNG', compress_level=1)
+        return buffer.getvalue()
+
+    images = {'a.png': png(1), 'b.png': png(2)}
+    downloads = []
+
+    async def serve(request):
+        downloads.append(request.match_info['name'])
+        return web.Response(body=images[request.match_info['name']], content_type='image/png')
+
+    port = free_port()
+    app = web.Application()
+    app.router.add_get('/{name}', serve)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+
+    def attachment(name):
+        return types.SimpleNamespace(url=f'http://127.0.0.1:{port}/{name}')
+
+    width, height = fit_size(1024, 1536)
+    cache = InputImageCache()
+
+    async def timed(coro_fn, n=1):
+        start = time.perf_counter()
+        for _ in range(n):
+            await coro_fn()
+        return (time.perf_counter() - start) / n * 1000
+
+    try:
+        cold_first_ms = await timed(lambda: cache.prepare(attachment('a.png'), width, height))
+        cold_ms = await timed(lambda: cache.prepare(attachment('b.png'), width, height))
+        warm_ms = await timed(lambda: cache.prepare(attachment('a.png'), width, height), rounds)
+        download_ms = await timed(lambda: cache._download(attachment('a.png').url), rounds)
+        stats = cache.stats()
+    finally:
+        await cache.close()
+        await runner.cleanup()
+    return {
+        'input': '1024x1536',
+        'input_mb': len(images['a.png']) / 1e6,
+        'target': f'{width}x{height}',
+        'cold_first_ms': cold_first_ms,
+        'cold_ms': cold_ms,
+        'warm_ms': warm_ms,
+        'download_ms': download_ms,
+        'prepares': stats['hits'] + stats['misses'],
+        'hits': stats['hits'],
+        'downloads': len(downloads) - rounds
+    }
+
+
+def print_bench_report(name: str, report: dict):
+    print('=' * 60)
+    print(f'基准测试: {name}')
+    for key, value in report.items():
+        if isinstance(value, dict):
+            value = ' '.join(f'{k}={v:,.1f}' for k, v in value.items())
+        elif isinstance(value, float):
+            value = f'{value:,.3f}' if value < 1000 else f'{value:,.0f}'
+        print(f'  {key}: {value}')
+    print('=' * 60)
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+# 尺寸步进值
+SIZE_STEP = 64
+
+# 尺寸限制
+SIZE_LIMITS = {
+    'maxPixels': 832 * 1216,
+    'maxWidth': 1216,
+    'maxHeight': 1216
+}
+
+# 单次请求最多生成的图片数量
+MAX_SAMPLES = 4
+
+# 尺寸预设
+SIZE_PRESETS = {
+    'portrait_s': {'width': 512, 'height': 768},
+    'portrait_m': {'width': 832, 'height': 1216},
+    'landscape_s': {'width': 768, 'height': 512},
+    'landscape_m': {'width': 1216, 'height': 832},
+    'square_s': {'width': 512, 'height': 512},
+    'square_m': {'width': 768, 'height': 768},
+    'square_l': {'width': 832, 'height': 832}
+}
+
+# 模型列表
+MODELS = {
+    'nai-diffusion-4-5-full': '🌟 V4.5 Full',
+    'nai-diffusion-4-5-curated': '✨ V4.5 Curated',
+    'nai-diffusion-4-full': '🎯 V4 Full',
+    'nai-diffusion-4-curated': '📌 V4 Curated',
+    'nai-diffusion-4-curated-preview': '👁️ V4 Preview',
+    'nai-diffusion-3': '🎨 V3 Anime',
+    'nai-diffusion-3-inpainting': '🔧 V3 Inpainting',
+    'nai-diffusion-2': '🌸 V2 Anime',
+    'nai-diffusion': '🎯 V1 Anime',
+    'safe-diffusion': '✅ V1 Curated',
+    'nai-diffusion-furry': '🦊 V1 Furry',
+    'nai-diffusion-furry-v3': '🐺 V3 Furry'
+}
+
+# 尺寸选项 (显示名称, 预设值)
+SIZE_OPTIONS = (
+    ('📱 竖图 832×1216', 'portrait_m'),
+    ('📱 竖图小 512×768', 'portrait_s'),
+    ('🖼️ 横图 1216×832', 'landscape_m'),
+    ('🖼️ 横图小 768×512', 'landscape_s'),
+    ('⬜ 方图 512×512', 'square_s'),
+    ('◻️ 方图 768×768', 'square_m'),
+    ('◼ 方图 832×832', 'square_l')
+)
+
+# 采样器选项 (显示名称, 采样器)
+SAMPLER_OPTIONS = (
+    ('Euler Ancestral', 'k_euler_ancestral'),
+    ('Euler', 'k_euler'),
+    ('DPM++ 2M', 'k_dpmpp_2m'),
+    ('DPM++ 2S Ancestral', 'k_dpmpp_2s_ancestral'),
+    ('DPM++ SDE', 'k_dpmpp_sde'),
+    ('DDIM V3', 'ddim_v3')
+)
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+import logging
+import math
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from constants import SIZE_PRESETS
+
+logger = logging.getLogger(__name__)
+
+# 负载级别
+NORMAL = 0
+DEGRADED = 1
+SHED = 2
+LEVEL_NAMES = {NORMAL: '正常', DEGRADED: '降级', SHED: '暂停接收'}
+# 负载降到进入阈值的该比例以下才会退出当前级别
+EXIT_RATIO = 0.5
+
+
+def smaller_preset(width: int, height: int, max_pixels: int) -> Optional[Tuple[int, int]]:
+    """在不超过 max_pixels 的预设尺寸中选择宽高比最接近的（相同时取较大的），没有时返回None"""
+    ratio = math.log(width / height)
+    candidates = [(abs(math.log(size['width'] / size['height']) - ratio), -size['width'] * size['height'],
+                   size['width'], size['height'])
+                  for size in SIZE_PRESETS.values() if size['width'] * size['height'] <= max_pixels]
+    if not candidates:
+        return None
+    _, _, best_width, best_height = min(candidates)
+    return best_width, best_height
+
+
+def degrade_params(params: Dict[str, Any], config) -> List[str]:
+    """
+    按降级策略修改任务参数，返回修改说明（未修改时为空列表）
+
+    限制步数；文生图超过像素上限时换成宽高比相近的较小预设（图生图的尺寸跟随输入图片，不修改）；
+    清除元数据时使用快速模式。
+    """
+    changes = []
+    steps = params.get('steps', 28)
+    if steps > config.degrade_max_steps:
+        params['steps'] = config.degrade_max_steps
+        changes.append(f'步数 {steps} → {config.degrade_max_steps}')
+    width, height = params['width'], params['height']
+    if not params.get('image') and width * height > config.degrade_max_pixels:
+        size = smaller_preset(width, height, config.degrade_max_pixels)
+        if size is not None:
+            params['width'], params['height'] = size
+            changes.append(f'尺寸 {width}×{height} → {size[0]}×{size[1]}')
+    if params.get('remove_metadata') and not params.get('fast_metadata'):
+        params['fast_metadata'] = True
+        changes.append('快速清除元数据')
+    return changes
+
+
+class DegradationController:
+    """
+    根据队列长度和预估等待时间决定负载级别
+
+    任一指标达到进入阈值时立即升级；所有指标都低于 进入阈值 × EXIT_RATIO，
+    并且当前级别已保持 degrade_hold 秒后才逐级降回，避免在阈值附近反复切换。
+    阈值从传入的 RuntimeConfig 读取，运行中修改后下一次 update 即生效。
+    """
+
+    def __init__(self, clock: Callable[[], float] = time.monotonic):
+        self.clock = clock
+        self.level = NORMAL
+        self.since = clock()
+        self.transitions = 0
+        self.degraded_jobs = 0
+        self.rejected_jobs = 0
+
+    @staticmethod
+    def _reached(config, level: int, depth: int, wait: float, ratio: float = 1.0) -> bool:
+        if level == SHED:
+            max_depth, max_wait = config.shed_queue_depth, config.shed_wait
+        else:
+            max_depth, max_wait = config.degrade_queue_depth, config.degrade_wait
+        return depth >= max_depth * ratio or wait >= max_wait * ratio
+
+    def update(self, config, depth: int, wait: float) -> int:
+        """depth 为排队任务数，wait 为排队和进行中的任务全部完成的预估时间（秒）"""
+        now = self.clock()
+        if self._reached(config, SHED, depth, wait):
+            target = SHED
+        elif self._reached(config, DEGRADED, depth, wait):
+            target = DEGRADED
+        else:
+            target = NORMAL
+
+        level = self.level
+        if target > level:
+            level = target
+        elif (level > NORMAL and now - self.since >= config.degrade_hold
+              and not self._reached(config, level, depth, wait, EXIT_RATIO)):
+            level -= 1
+
+        if level != self.level:
+            logger.warning(f"[负载级别] {LEVEL_NAMES[self.level]} -> {LEVEL_NAMES[level]} | "
+                           f"队列: {depth} | 预估等待: {wait:.0f}秒 | 上一级别持续: {now - self.since:.0f}秒")
+            self.level = level
+            self.since = now
+            self.transitions += 1
+        return level
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'level': LEVEL_NAMES[self.level],
+            'seconds': self.clock() - self.since,
+            'transitions': self.transitions,
+            'degraded_jobs': self.degraded_jobs,
+            'rejected_jobs': self.rejected_jobs
+        }
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+logger = logging.getLogger(__name__)
+
+# Discord CDN附件链接的默认有效期（秒），链接中带有 ex 参数时以其为准
+DEFAULT_URL_TTL = 24 * 3600
+# 距离过期不足该时间（秒）的链接不再复用
+EXPIRY_MARGIN = 3600
+
+
+def upload_key(images: List[bytes], sheet_quality: Optional[int] = None, channel_id: Optional[int] = None) -> str:
+    """
+    上传内容的哈希：由所在频道、各张原图和拼图质量（单张图片时为None）决定
+
+    只在同一个频道内复用，引用的附件和消息链接不会出现在其他服务器、频道或私信中。
+    拼图的键在拼图之前就能算出，命中时不需要再拼一次。
+    """
+    digests = [hashlib.blake2b(image, digest_size=16).digest() for image in images]
+    prefix = b'%d:%d:' % (channel_id or 0, sheet_quality or 0)
+    return hashlib.blake2b(prefix + b''.join(digests), digest_size=16).hexdigest()
+
+
+def url_expiry(url: str, now: float) -> float:
+    """CDN签名链接的 ex 参数是十六进制的过期时间戳"""
+    ex = parse_qs(urlsplit(url).query).get('ex')
+    if ex:
+        try:
+            return int(ex[0], 16)
+        except ValueError:
+            pass
+    return now + DEFAULT_URL_TTL
+
+
+class DeliveryIndex:
+    """
+    (频道, 内容哈希) -> 已上传的附件链接
+
+    同一频道中相同的结果（固定种子的重复请求、重新发送的结果）再次发送时，在嵌入中引用已有附件，
+    不再重新上传。条目按LRU淘汰，链接即将过期时视为未命中。max_entries 为0时不记录。
+    """
+
+    def __init__(self, max_entries: int = 1024, clock: Callable[[], float] = time.time):
+        self.max_entries = max_entries
+        self.clock = clock
+        # 哈希 -> (附件链接, 所在消息链接, 附件大小, 过期时间)
+        self._entries: 'OrderedDict[str, Tuple[str, str, int, float]]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.saved_bytes = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def get(self, key: str) -> Optional[Tuple[str, str]]:
+        """返回 (附件链接, 消息链接)，没有或即将过期时返回None"""
+        entry = self._entries.get(key)
+        if entry is not None and entry[3] - EXPIRY_MARGIN > self.clock():
+            self._entries.move_to_end(key)
+            self.hits += 1
+            self.saved_bytes += entry[2]
+            return entry[0], entry[1]
+        if entry is not None:
+            del self._entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key: str, url: str, jump_url: str, size: int):
+        if not self.enabled:
+            return
+        self._entries[key] = (url, jump_url, size, url_expiry(url, self.clock()))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'saved_bytes': self.saved_bytes
+        }
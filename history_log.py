@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import struct
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# 定长记录: 用户ID, 同一用户的上一条记录号, 时间, 文本偏移, 文本长度,
+#          seed, 宽, 高, 步数, cfg, 图片数量, 标志位
+RECORD = struct.Struct('<QIdQIIHHHfBB')
+NO_RECORD = 0xFFFFFFFF
+# 只读取记录开头的用户ID，用于启动时重建索引
+USER_FIELD = struct.Struct(f'<Q{RECORD.size - 8}x')
+
+FLAG_SMEA = 1
+FLAG_DYN = 2
+FLAG_REMOVE_METADATA = 4
+FLAG_IMG2IMG = 8
+
+# 变长文本（提示词、负面提示词、模型、采样器）以\0分隔存放在单独的文件中
+TEXT_SEPARATOR = '\x00'
+# 启动时扫描记录文件的块大小
+SCAN_CHUNK_RECORDS = 65536
+
+
+@dataclass(slots=True)
+class HistoryRecord:
+    """一条已完成的生成记录"""
+    record_id: int
+    user_id: int
+    created: float
+    prompt: str
+    negative_prompt: str
+    model: str
+    sampler: str
+    seed: int
+    width: int
+    height: int
+    steps: int
+    cfg: float
+    n_samples: int
+    flags: int
+
+    @property
+    def is_img2img(self) -> bool:
+        return bool(self.flags & FLAG_IMG2IMG)
+
+    def to_params(self) -> Dict[str, Any]:
+        """还原为队列任务的参数（图生图的输入图片不保存）"""
+        return {
+            'prompt': self.prompt,
+            'negative_prompt': self.negative_prompt or None,
+            'model': self.model,
+            'width': self.width,
+            'height': self.height,
+            'steps': self.steps,
+            'cfg': round(self.cfg, 2),
+            'sampler': self.sampler,
+            'seed': self.seed,
+            'smea': bool(self.flags & FLAG_SMEA),
+            'dyn': bool(self.flags & FLAG_DYN),
+            'remove_metadata': bool(self.flags & FLAG_REMOVE_METADATA),
+            'n_samples': self.n_samples
+        }
+
+
+class HistoryLog:
+    """
+    只追加的生成历史
+
+    记录文件由定长记录组成，记录号即 偏移 / 记录长度，按号读取只需一次seek和read。
+    每条记录保存同一用户上一条记录的编号，形成倒序链表，内存中只保留每个用户的最新记录号，
+    因此翻页只读取本页的记录，内存占用与用户数成正比，与记录总数无关。
+    各方法会在线程中调用，读写共用文件位置，由锁串行化。
+    """
+
+    def __init__(self, directory, name: str = 'history'):
+        self.directory = Path(directory)
+        self.record_path = self.directory / f'{name}.dat'
+        self.text_path = self.directory / f'{name}_text.dat'
+        self._records = None
+        self._texts = None
+        self._count = 0
+        self._text_size = 0
+        self._last: Dict[int, int] = {}
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def _read_at(f, offset: int, size: int) -> bytes:
+        f.seek(offset)
+        return f.read(size)
+
+    def open(self):
+        """打开文件并重建用户索引（记录很多时耗时较长，可在线程中预先调用）"""
+        with self._lock:
+            if self._records is not None:
+                return
+            self.directory.mkdir(parents=True, exist_ok=True)
+            # 无缓冲的追加模式：写入总是落在文件末尾，读取前seek到指定位置
+            self._records = open(self.record_path, 'a+b', buffering=0)
+            self._texts = open(self.text_path, 'a+b', buffering=0)
+
+            size = os.fstat(self._records.fileno()).st_size
+            if size % RECORD.size:
+                # 上次写入中断留下的不完整记录
+                logger.warning(f"[历史记录] 截断不完整的记录: {size % RECORD.size} 字节")
+                size -= size % RECORD.size
+                self._records.truncate(size)
+            self._count = size // RECORD.size
+            self._text_size = os.fstat(self._texts.fileno()).st_size
+
+            start = time.perf_counter()
+            for first in range(0, self._count, SCAN_CHUNK_RECORDS):
+                n = min(SCAN_CHUNK_RECORDS, self._count - first)
+                data = self._read_at(self._records, first * RECORD.size, n * RECORD.size)
+                # 同一用户出现多次时后面的记录号覆盖前面的
+                self._last.update(zip((fields[0] for fields in USER_FIELD.iter_unpack(data)), range(first, first + n)))
+            if self._count:
+                logger.info(f"[历史记录] 已加载 {self._count} 条记录，{len(self._last)} 个用户，耗时 {time.perf_counter() - start:.2f}秒")
+
+    def __len__(self) -> int:
+        with self._lock:
+            self.open()
+            return self._count
+
+    def append(self, user_id: int, params: Dict[str, Any], seed: int) -> int:
+        """追加一条记录，返回记录号"""
+        with self._lock:
+            self.open()
+            text = TEXT_SEPARATOR.join((
+                params.get('prompt') or '', params.get('negative_prompt') or '',
+                params.get('model') or '', params.get('sampler') or ''
+            )).encode('utf-8')
+            flags = ((FLAG_SMEA if params.get('smea') else 0) |
+                     (FLAG_DYN if params.get('dyn') else 0) |
+                     (FLAG_REMOVE_METADATA if params.get('remove_metadata') else 0) |
+                     (FLAG_IMG2IMG if params.get('image') else 0))
+            record = RECORD.pack(
+                user_id, self._last.get(user_id, NO_RECORD), time.time(), self._text_size, len(text),
+                seed & 0xFFFFFFFF, params.get('width', 0), params.get('height', 0), params.get('steps', 28),
+                params.get('cfg', 5), params.get('n_samples', 1), flags
+            )
+            # 先写文本再写记录，中断时最多留下无人引用的文本
+            self._texts.write(text)
+            self._text_size += len(text)
+            self._records.write(record)
+            record_id = self._count
+            self._count += 1
+            self._last[user_id] = record_id
+            return record_id
+
+    def _read_fields(self, record_id: int) -> Optional[tuple]:
+        if not 0 <= record_id < self._count:
+            return None
+        return RECORD.unpack(self._read_at(self._records, record_id * RECORD.size, RECORD.size))
+
+    def _build(self, record_id: int, fields: tuple) -> HistoryRecord:
+        user_id, _, created, text_offset, text_len, seed, width, height, steps, cfg, n_samples, flags = fields
+        prompt, negative, model, sampler = self._read_at(
+            self._texts, text_offset, text_len
+        ).decode('utf-8').split(TEXT_SEPARATOR)
+        return HistoryRecord(record_id, user_id, created, prompt, negative, model, sampler,
+                             seed, width, height, steps, cfg, n_samples, flags)
+
+    def get(self, record_id: int) -> Optional[HistoryRecord]:
+        with self._lock:
+            self.open()
+            fields = self._read_fields(record_id)
+            return None if fields is None else self._build(record_id, fields)
+
+    def page(self, user_id: int, before: Optional[int] = None, limit: int = 10) -> List[HistoryRecord]:
+        """
+        按时间倒序返回用户的记录
+
+        before 为上一页最后一条记录的编号，省略时从最新一条开始。
+        """
+        with self._lock:
+            self.open()
+            if before is None:
+                record_id = self._last.get(user_id, NO_RECORD)
+            else:
+                fields = self._read_fields(before)
+                record_id = fields[1] if fields is not None and fields[0] == user_id else NO_RECORD
+            records = []
+            while record_id != NO_RECORD and len(records) < limit:
+                fields = self._read_fields(record_id)
+                if fields is None:
+                    break
+                records.append(self._build(record_id, fields))
+                record_id = fields[1]
+            return records
+
+    def has_more(self, user_id: int, record_id: int) -> bool:
+        """该记录之前是否还有同一用户的记录"""
+        with self._lock:
+            self.open()
+            fields = self._read_fields(record_id)
+            return fields is not None and fields[0] == user_id and fields[1] != NO_RECORD
+
+    def close(self):
+        with self._lock:
+            for f in (self._records, self._texts):
+                if f is not None:
+                    f.close()
+            self._records = self._texts = None
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+import hmac
+import logging
+import os
+import time
+from typing import Optional
+
+from aiohttp import web
+
+from profiler import ProfilerBusy, profile_cpu, profile_memory
+
+logger = logging.getLogger(__name__)
+
+# 管理接口令牌，未设置时管理接口不可用
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN', '')
+HTTP_HOST = os.getenv('HTTP_HOST', '0.0.0.0')
+
+
+class HttpServer:
+    """
+    进程内的HTTP服务，与bot共用事件循环
+
+    /debug/* 为管理接口，需要在 Authorization: Bearer <ADMIN_TOKEN> 或 ?token= 中提供令牌。
+    """
+
+    def __init__(self, port: int, host: str = HTTP_HOST, admin_token: str = ADMIN_TOKEN):
+        self.port = port
+        self.host = host
+        self.admin_token = admin_token
+        self.app = web.Application()
+        self.app.router.add_get('/debug/profile', self.handle_profile)
+        self._runner: Optional[web.AppRunner] = None
+
+    def _authorized(self, request: web.Request) -> bool:
+        if not self.admin_token:
+            return False
+        header = request.headers.get('Authorization', '')
+        token = header[7:] if header.startswith('Bearer ') else request.query.get('token', '')
+        return hmac.compare_digest(token.encode(), self.admin_token.encode())
+
+    async def handle_profile(self, request: web.Request) -> web.Response:
+        """GET /debug/profile?seconds=N&mode=cpu|memory"""
+        if not self._authorized(request):
+            raise web.HTTPUnauthorized()
+        try:
+            seconds = float(request.query.get('seconds', '10'))
+        except ValueError:
+            raise web.HTTPBadRequest(text='seconds 必须是数字')
+        mode = request.query.get('mode', 'cpu')
+        if mode not in ('cpu', 'memory') or seconds <= 0:
+            raise web.HTTPBadRequest(text='mode 必须是 cpu 或 memory，seconds 必须大于0')
+
+        logger.info(f"[性能采样] 来源: HTTP {request.remote} | 模式: {mode} | 时长: {seconds}s")
+        try:
+            report = await (profile_cpu(seconds) if mode == 'cpu' else profile_memory(seconds))
+        except ProfilerBusy:
+            raise web.HTTPConflict(text='已有采样正在进行')
+        filename = f"profile-{mode}-{time.strftime('%Y%m%d-%H%M%S')}.{'folded' if mode == 'cpu' else 'txt'}"
+        return web.Response(
+            text=report,
+            headers={'Content-Disposition': f'attachment; filename="{filename}"'}
+        )
+
+    async def start(self):
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info(f"[HTTP] 监听 {self.host}:{self.port} | 管理接口: {'已启用' if self.admin_token else '未启用'}")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
@@ -1,14 +1,28 @@
 # -*- coding: utf-8 -*-
 import io
-from PIL import Image
+import base64
+import logging
+import math
+from PIL import Image, ImageDraw, ImageFont
 from typing import Optional
 
-def process_image_metadata(image_data: bytes) -> bytes:
+logger = logging.getLogger(__name__)
+
+# 拼图的最长边上限，超过时按比例缩小每一格
+SHEET_MAX_SIDE = 4096
+# 格子之间的间隔和背景色
+SHEET_GAP = 8
+SHEET_BACKGROUND = (32, 32, 32)
+
+def process_image_metadata(image_data: bytes, quality: int = 95, compress_level: int = 9, fast: bool = False) -> bytes:
     """
     处理图像：移除元数据和Alpha通道
 
     Args:
         image_data: 原始图片的二进制数据
+        quality: JPEG/WebP质量
+        compress_level: PNG压缩级别
+        fast: 快速模式（高负载时使用），跳过耗时的压缩优化，文件会稍大
 
     Returns:
         处理后的图片二进制数据
@@ -44,8 +58,8 @@ def process_image_metadata(image_data: bytes) -> bytes:
                 img.save(
                     output_buffer,
                     format='JPEG',
-                    quality=95,
-                    optimize=True,
+                    quality=quality,
+                    optimize=not fast,
                     exif=b"",  # 移除EXIF数据
                     icc_profile=None,  # 移除ICC配置文件
                     subsampling=0,  # 最高质量的色彩子采样
@@ -56,8 +70,8 @@ def process_image_metadata(image_data: bytes) -> bytes:
                 img.save(
                     output_buffer,
                     format='WEBP',
-                    quality=95,
-                    method=6,  # 最慢但最好的压缩
+                    quality=quality,
+                    method=2 if fast else 6,  # 6为最慢但最好的压缩
                     exif=b"",
                     icc_profile=None
                 )
@@ -66,8 +80,8 @@ def process_image_metadata(image_data: bytes) -> bytes:
                 img.save(
                     output_buffer,
                     format='PNG',
-                    optimize=True,
-                    compress_level=9,  # 最大压缩
+                    optimize=not fast,
+                    compress_level=1 if fast else compress_level,  # 默认最大压缩
                     icc_profile=None
                 )
 
@@ -76,7 +90,7 @@ def process_image_metadata(image_data: bytes) -> bytes:
             return output_buffer.read()
 
     except Exception as e:
-        print(f"Error processing image metadata: {e}")
+        logger.error(f"Error processing image metadata: {e}")
         # 如果处理失败，返回原始数据
         return image_data
 
@@ -121,5 +135,103 @@ def get_image_info(image_data: bytes) -> dict:
             }
             return info
     except Exception as e:
-        print(f"Error getting image info: {e}")
-        return {}
\ No newline at end of file
+        logger.error(f"Error getting image info: {e}")
+        return {}
+
+
+def prepare_input_image(image_data: bytes, width: int, height: int, is_mask: bool = False) -> str:
+    """
+    将图生图的输入图片缩放到目标尺寸并编码为base64（在工作进程中运行）
+
+    Args:
+        image_data: 原始图片的二进制数据
+        width: 目标宽度（64的倍数）
+        height: 目标高度（64的倍数）
+        is_mask: 是否为局部重绘的蒙版，蒙版会被二值化为黑白图
+
+    Returns:
+        PNG图片的base64字符串
+    """
+    with io.BytesIO(image_data) as input_buffer:
+        img = Image.open(input_buffer)
+        img.load()
+
+    if is_mask:
+        # 白色区域为需要重绘的部分
+        img = img.convert('L').point(lambda v: 255 if v >= 128 else 0)
+        img = img.resize((width, height), Image.NEAREST).convert('RGB')
+    else:
+        if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+            img = img.convert('RGBA')
+            background = Image.new('RGB', img.size, (255, 255, 255))
+            background.paste(img, mask=img.split()[-1])
+            img = background
+        elif img.mode != 'RGB':
+            img = img.convert('RGB')
+        if img.size != (width, height):
+            img = img.resize((width, height), Image.LANCZOS)
+
+    output_buffer = io.BytesIO()
+    # 只作为请求输入，使用最快的压缩级别
+    img.save(output_buffer, format='PNG', compress_level=1)
+    return base64.b64encode(output_buffer.getvalue()).decode('ascii')
+
+def compose_contact_sheet(images: list, quality: int = 90) -> bytes:
+    """
+    将多张结果拼成一张带seed标注的网格图，编码为JPEG（在线程中运行）
+
+    所有格子写入同一块预先分配的画布，只在最后编码一次。
+
+    Args:
+        images: [(图片二进制数据, seed), ...]
+        quality: JPEG质量
+
+    Returns:
+        拼图的JPEG二进制数据
+    """
+    tiles = []
+    for image_data, seed in images:
+        with io.BytesIO(image_data) as input_buffer:
+            img = Image.open(input_buffer)
+            img.load()
+        tiles.append((img if img.mode == 'RGB' else img.convert('RGB'), seed))
+
+    count = len(tiles)
+    cols = math.ceil(math.sqrt(count))
+    rows = math.ceil(count / cols)
+    tile_width = max(img.width for img, _ in tiles)
+    tile_height = max(img.height for img, _ in tiles)
+
+    # 超过最长边上限时缩小每一格
+    scale = min(1.0, (SHEET_MAX_SIDE - SHEET_GAP * (cols + 1)) / (tile_width * cols),
+                (SHEET_MAX_SIDE - SHEET_GAP * (rows + 1)) / (tile_height * rows))
+    if scale < 1.0:
+        tile_width, tile_height = int(tile_width * scale), int(tile_height * scale)
+        tiles = [(img.resize((max(1, int(img.width * scale)), max(1, int(img.height * scale))), Image.BILINEAR), seed)
+                 for img, seed in tiles]
+
+    sheet_width = cols * tile_width + (cols + 1) * SHEET_GAP
+    sheet_height = rows * tile_height + (rows + 1) * SHEET_GAP
+    positions = [
+        (SHEET_GAP + (i % cols) * (tile_width + SHEET_GAP), SHEET_GAP + (i // cols) * (tile_height + SHEET_GAP))
+        for i in range(count)
+    ]
+
+    # 同模式、无蒙版的paste是逐行内存拷贝，比先转成NumPy数组再切片赋值少两次整图复制
+    sheet = Image.new('RGB', (sheet_width, sheet_height), SHEET_BACKGROUND)
+    for (img, _), (x, y) in zip(tiles, positions):
+        sheet.paste(img, (x, y))
+
+    # 在每格左上角标注seed
+    draw = ImageDraw.Draw(sheet)
+    font = ImageFont.load_default(size=max(16, tile_height // 40))
+    for (_, seed), (x, y) in zip(tiles, positions):
+        label = f'seed {seed}'
+        left, top, right, bottom = draw.textbbox((x + 8, y + 8), label, font=font)
+        draw.rectangle((left - 4, top - 4, right + 4, bottom + 4), fill=(0, 0, 0))
+        draw.text((x + 8, y + 8), label, fill=(255, 255, 255), font=font)
+
+    output_buffer = io.BytesIO()
+    # 拼图只用于预览，原图可按需获取，因此使用编码较快且体积小的JPEG
+    sheet.save(output_buffer, format='JPEG', quality=quality, subsampling=2)
+    return output_buffer.getvalue()
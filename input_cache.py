@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Optional, Tuple
+
+import aiohttp
+
+from constants import SIZE_LIMITS, SIZE_STEP
+from image_processor import prepare_input_image
+from memory_budget import ByteBudget, BytesLRU
+
+# 允许的输入图片类型和大小
+ALLOWED_CONTENT_TYPES = ('image/png', 'image/jpeg', 'image/webp')
+MAX_INPUT_BYTES = 10 * 1024 * 1024
+# 已处理输入的缓存上限
+INPUT_CACHE_BYTES = int(os.getenv('INPUT_CACHE_MB', '64')) * 1024 * 1024
+
+
+class InputImageError(Exception):
+    """输入图片不符合要求"""
+
+
+def fit_size(width: int, height: int, allow_upscale: bool = False) -> Tuple[int, int]:
+    """保持宽高比，缩放到SIZE_LIMITS以内最接近的64倍数尺寸；allow_upscale时放大到上限"""
+    scale = min(
+        float('inf') if allow_upscale else 1.0,
+        SIZE_LIMITS['maxWidth'] / width,
+        SIZE_LIMITS['maxHeight'] / height,
+        (SIZE_LIMITS['maxPixels'] / (width * height)) ** 0.5
+    )
+    new_width = max(SIZE_STEP, int(width * scale) // SIZE_STEP * SIZE_STEP)
+    new_height = max(SIZE_STEP, int(height * scale) // SIZE_STEP * SIZE_STEP)
+    return new_width, new_height
+
+
+def validate_attachment(attachment) -> Tuple[int, int]:
+    """
+    只根据Discord提供的附件元数据校验（不下载），返回目标尺寸
+    """
+    content_type = (attachment.content_type or '').split(';')[0]
+    if content_type not in ALLOWED_CONTENT_TYPES:
+        raise InputImageError(f'不支持的图片格式: {content_type or "未知"}，请上传PNG/JPEG/WEBP')
+    if attachment.size > MAX_INPUT_BYTES:
+        raise InputImageError(f'图片过大（{attachment.size / 1024 / 1024:.1f} MB），最大 {MAX_INPUT_BYTES // 1024 // 1024} MB')
+    if not attachment.width or not attachment.height:
+        raise InputImageError('无法读取图片尺寸')
+    return fit_size(attachment.width, attachment.height)
+
+
+class InputImageCache:
+    """
+    图生图输入图片的准备与缓存
+
+    每次上传的附件ID和链接都不同，只能下载后按内容哈希识别；
+    (内容哈希, 尺寸, 是否蒙版) → base64 的缓存让相同内容跳过缩放和编码。
+    传入 budget 时缓存占用计入内存预算。
+    """
+
+    def __init__(self, max_bytes: int = INPUT_CACHE_BYTES, budget: Optional[ByteBudget] = None):
+        self.max_bytes = max_bytes
+        self._prepared = BytesLRU(max_bytes, budget)
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self.hits = 0
+        self.misses = 0
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30))
+        return self._session
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=int(os.getenv('INPUT_WORKERS', '1')))
+        return self._executor
+
+    async def _download(self, url: str) -> bytes:
+        async with self._get_session().get(url) as response:
+            if response.status != 200:
+                raise InputImageError(f'下载图片失败: HTTP {response.status}')
+            data = bytearray()
+            async for chunk in response.content.iter_chunked(64 * 1024):
+                data.extend(chunk)
+                if len(data) > MAX_INPUT_BYTES:
+                    raise InputImageError('图片过大')
+            return bytes(data)
+
+    async def prepare(self, attachment, width: int, height: int, is_mask: bool = False) -> str:
+        """返回缩放到 width×height 后的base64 PNG"""
+        data = await self._download(attachment.url)
+        key = (hashlib.sha256(data).hexdigest(), width, height, is_mask)
+        encoded = self._prepared.get(key)
+        if encoded is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            loop = asyncio.get_running_loop()
+            encoded = await loop.run_in_executor(
+                self._get_executor(), prepare_input_image, data, width, height, is_mask
+            )
+            self._prepared.put(key, encoded, len(encoded))
+        return encoded
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'entries': self._prepared.stats()['entries'],
+            'bytes': self._prepared.used_bytes,
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+import sys
+import time
+from dataclasses import dataclass, fields
+from typing import Any, Dict, List, Optional
+
+import discord
+
+# 交互令牌的有效期（秒），过期后无法再通过followup发送结果
+TOKEN_LIFETIME = 15 * 60
+
+
+@dataclass(slots=True)
+class JobParams:
+    """
+    一个任务的生成参数
+
+    字段固定，比字符串键的dict更紧凑；保留 params['key'] 和 params.get() 的访问方式，
+    请求编译、成本模型和生成历史可以直接使用。
+    """
+    prompt: str
+    model: str
+    width: int
+    height: int
+    negative_prompt: Optional[str] = None
+    steps: int = 28
+    cfg: float = 5
+    sampler: str = 'k_euler_ancestral'
+    seed: int = -1
+    smea: bool = False
+    dyn: bool = False
+    remove_metadata: bool = False
+    stream: bool = False
+    n_samples: int = 1
+    # 图生图/局部重绘的输入（base64）
+    image: Optional[str] = None
+    mask: Optional[str] = None
+    strength: float = 0.7
+    noise: float = 0.0
+    # 降级模式下使用快速元数据清除
+    fast_metadata: bool = False
+
+    def __post_init__(self):
+        # 模型和采样器名称在所有任务间共用同一个字符串对象
+        self.model = sys.intern(self.model)
+        self.sampler = sys.intern(self.sampler)
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'JobParams':
+        """从参数dict构建，忽略未知字段"""
+        return cls(**{name: data[name] for name in cls.__slots__ if name in data})
+
+    def __getitem__(self, key: str) -> Any:
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __setitem__(self, key: str, value: Any):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return getattr(self, key, default)
+
+    def update(self, values: Dict[str, Any]):
+        for key, value in values.items():
+            self[key] = value
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {f.name: getattr(self, f.name) for f in fields(self)}
+
+
+@dataclass(slots=True)
+class Job:
+    """
+    队列中的任务
+
+    只保存发送结果需要的信息（应用ID、交互令牌、频道ID、用户ID和名称），不持有 discord.Interaction
+    及其引用的用户、服务器、频道对象；结果通过基于令牌的webhook发送。
+    """
+    application_id: int
+    token: str
+    # 结果发送到的频道，已上传附件只在同一频道内复用
+    channel_id: Optional[int]
+    user_id: int
+    user_name: str
+    params: JobParams
+    enqueued_at: float
+    # 交互令牌过期的时间（time.monotonic）
+    deadline: float
+    # 入队时由成本模型填写的预估耗时（秒）
+    predicted: Optional[float] = None
+    # 降级模式下对参数做的修改说明
+    degraded: Optional[List[str]] = None
+
+    @classmethod
+    def from_interaction(cls, interaction: discord.Interaction, params: JobParams) -> 'Job':
+        now = time.monotonic()
+        # 令牌从交互创建时开始计时，扣除处理命令已经用掉的时间
+        age = max(0.0, (discord.utils.utcnow() - interaction.created_at).total_seconds())
+        return cls(interaction.application_id, interaction.token, interaction.channel_id,
+                   interaction.user.id, str(interaction.user),
+                   params, now, now - age + TOKEN_LIFETIME)
+
+    @property
+    def expired(self) -> bool:
+        return time.monotonic() >= self.deadline
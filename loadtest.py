@@ -0,0 +1,765 @@
+# -*- coding: utf-8 -*-
+"""
+离线压力测试工具
+
+启动一个本地的 /ai/generate-image 模拟服务，用伪造的Discord交互对象
+把合成的到达序列送入真实的队列代码，统计吞吐量、排队等待、端到端延迟和事件循环延迟。
+
+用法:
+    python loadtest.py --jobs 200 --rate 5 --latency 2.0 --jitter 0.5
+    python loadtest.py --trace trace.jsonl --json > baseline.json
+    MEMORY_BUDGET_MB=64 GENERATION_CONCURRENCY=8 python loadtest.py --jobs 40 --rate 50 --n-samples 4 --memory-check
+    python loadtest.py --scenario panel-restart --users 200
+    python loadtest.py --bench panel-store    # 微基准测试，见 bench.py
+"""
+import argparse
+import asyncio
+import base64
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+from aiohttp import web
+from PIL import Image
+
+
+# 模拟服务缓存的ZIP数量
+ZIP_CACHE_ENTRIES = 64
+# --memory-check 允许RSS增长超出内存预算的部分（MB）：预算只统计图片缓冲区，
+# 不含运行中才加载的模块、线程栈、解码器状态和小对象
+RSS_SLACK_MB = 32
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = min(len(ordered) - 1, max(0, int(round(pct / 100 * (len(ordered) - 1)))))
+    return ordered[k]
+
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    return {
+        'p50': percentile(values, 50),
+        'p90': percentile(values, 90),
+        'p99': percentile(values, 99),
+        'max': max(values) if values else 0.0
+    }
+
+
+class FakeNovelAIServer:
+    """模拟NovelAI图片生成接口，支持延迟分布、错误率和返回图片大小配置"""
+
+    def __init__(self, latency: float = 1.0, jitter: float = 0.2, error_rate: float = 0.0,
+                 payload: str = 'noise', host: str = '127.0.0.1', port: int = 0, preview_frames: int = 28,
+                 scale_latency: bool = False):
+        self.latency = latency
+        self.scale_latency = scale_latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.payload = payload
+        self.preview_frames = preview_frames
+        self.host = host
+        self.port = port
+        self.requests = 0
+        self.errors = 0
+        self._image_cache: Dict[tuple, Image.Image] = {}
+        self._zip_cache: 'OrderedDict[tuple, bytes]' = OrderedDict()
+        self._preview_b64: Optional[str] = None
+        self._runner: Optional[web.AppRunner] = None
+
+    @property
+    def base_url(self) -> str:
+        return f'http://{self.host}:{self.port}'
+
+    def build_image(self, width: int, height: int) -> Image.Image:
+        key = (width, height)
+        if key not in self._image_cache:
+            if self.payload == 'noise':
+                # 随机噪声几乎无法压缩，接近真实图片的最坏大小
+                self._image_cache[key] = Image.frombytes('RGB', (width, height), os.urandom(width * height * 3))
+            else:
+                self._image_cache[key] = Image.new('RGB', (width, height), (200, 180, 160))
+        return self._image_cache[key]
+
+    def build_zip(self, width: int, height: int, n_samples: int = 1, seed: int = 0) -> bytes:
+        """
+        按尺寸、数量和种子构建（并缓存）包含PNG的ZIP
+
+        和真实接口一样，相同参数和种子返回相同的图片，不同种子的图片内容不同（把种子写入第一行像素）。
+        """
+        key = (width, height, n_samples, seed)
+        if key not in self._zip_cache:
+            buf = io.BytesIO()
+            with zipfile.ZipFile(buf, 'w', zipfile.ZIP_STORED) as zf:
+                for i in range(n_samples):
+                    img = self.build_image(width, height).copy()
+                    for x, byte in enumerate((seed + i).to_bytes(4, 'big')):
+                        img.putpixel((x, 0), (byte, byte, byte))
+                    png = io.BytesIO()
+                    img.save(png, format='PNG', compress_level=1)
+                    zf.writestr(f'image_{i}.png', png.getvalue())
+            self._zip_cache[key] = buf.getvalue()
+            while len(self._zip_cache) > ZIP_CACHE_ENTRIES:
+                self._zip_cache.popitem(last=False)
+        self._zip_cache.move_to_end(key)
+        return self._zip_cache[key]
+
+    def sample_latency(self, params: dict) -> float:
+        """按延迟分布取样；scale_latency时按 像素×步数×数量 相对 512×768×28 缩放"""
+        delay = max(0.0, random.gauss(self.latency, self.jitter))
+        if self.scale_latency:
+            units = (int(params.get('width', 512)) * int(params.get('height', 768)) *
+                     int(params.get('steps', 28)) * int(params.get('n_samples', 1)))
+            delay *= units / (512 * 768 * 28)
+        return delay
+
+    async def handle_generate(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        body = await request.json()
+        params = body.get('parameters', {})
+        await asyncio.sleep(self.sample_latency(params))
+
+        if random.random() < self.error_rate:
+            self.errors += 1
+            return web.Response(status=500, text='simulated error')
+
+        data = await asyncio.to_thread(
+            self.build_zip, int(params.get('width', 512)), int(params.get('height', 768)),
+            int(params.get('n_samples', 1)), int(params.get('seed', 0))
+        )
+        return web.Response(body=data, content_type='application/zip')
+
+    def preview_b64(self) -> str:
+        """小尺寸JPEG中间预览"""
+        if self._preview_b64 is None:
+            buf = io.BytesIO()
+            Image.new('RGB', (64, 96), (120, 120, 120)).save(buf, format='JPEG')
+            self._preview_b64 = base64.b64encode(buf.getvalue()).decode('ascii')
+        return self._preview_b64
+
+    async def handle_generate_stream(self, request: web.Request) -> web.StreamResponse:
+        """按SSE格式逐步推送中间预览，最后推送完整PNG"""
+        self.requests += 1
+        body = await request.json()
+        params = body.get('parameters', {})
+        total = self.sample_latency(params)
+
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        frames = max(1, self.preview_frames)
+        for step in range(frames):
+            await asyncio.sleep(total / frames)
+            event = {'event_type': 'intermediate', 'step_ix': step, 'image': self.preview_b64()}
+            await response.write(f"event: intermediate\ndata: {json.dumps(event)}\n\n".encode())
+
+        zip_data = await asyncio.to_thread(
+            self.build_zip, int(params.get('width', 512)), int(params.get('height', 768)),
+            int(params.get('n_samples', 1)), int(params.get('seed', 0))
+        )
+        with zipfile.ZipFile(io.BytesIO(zip_data)) as zf:
+            pngs = [zf.read(name) for name in sorted(zf.namelist())]
+        for samp_ix, png in enumerate(pngs):
+            final = {'event_type': 'final', 'samp_ix': samp_ix, 'image': base64.b64encode(png).decode('ascii')}
+            await response.write(f"event: final\ndata: {json.dumps(final)}\n\n".encode())
+        await response.write_eof()
+        return response
+
+    async def start(self):
+        app = web.Application(client_max_size=16 * 1024 * 1024)
+        app.router.add_post('/ai/generate-image', self.handle_generate)
+        app.router.add_post('/ai/generate-image-stream', self.handle_generate_stream)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+
+def _serve(conn, options: dict, sizes: List[tuple]):
+    async def serve():
+        server = FakeNovelAIServer(**options)
+        for width, height in sizes:
+            server.build_image(width, height)
+        await server.start()
+        conn.send(server.port)
+        # 等待主进程通知停止，之后返回请求数
+        await asyncio.get_running_loop().run_in_executor(None, conn.recv)
+        conn.send(server.requests)
+        await server.stop()
+
+    asyncio.run(serve())
+
+
+class ProcessServer:
+    """
+    在子进程中运行 FakeNovelAIServer
+
+    模拟服务缓存的图片和ZIP不计入被测进程的内存，用于 --memory-check 测量RSS。
+    """
+
+    def __init__(self, options: dict, sizes: List[tuple]):
+        import multiprocessing
+        self.host = options.get('host', '127.0.0.1')
+        self.port = 0
+        self.requests = 0
+        self._conn, child = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(target=_serve, args=(child, options, sizes), daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        return f'http://{self.host}:{self.port}'
+
+    def build_image(self, width: int, height: int):
+        pass
+
+    async def start(self):
+        self._process.start()
+        self.port = await asyncio.to_thread(self._conn.recv)
+
+    async def stop(self):
+        self._conn.send('stop')
+        self.requests = await asyncio.to_thread(self._conn.recv)
+        await asyncio.to_thread(self._process.join, 5)
+
+
+class FakeUser:
+    def __init__(self, user_id: int):
+        self.id = user_id
+        self.name = f'loadtest_{user_id}'
+
+    def __str__(self):
+        return self.name
+
+
+class FakeResponse:
+    def __init__(self, record: 'JobRecord'):
+        self.record = record
+
+    async def send_message(self, content=None, **kwargs):
+        self.record.acked_at = time.monotonic()
+        if content and content.startswith('❌'):
+            # 被拒绝的任务不会有后续结果
+            self.record.rejected = True
+            self.record.finished.set()
+
+    async def edit_message(self, *args, **kwargs):
+        pass
+
+
+class FakeAttachment:
+    count = 0
+
+    def __init__(self, filename: str, size: int):
+        FakeAttachment.count += 1
+        self.filename = filename
+        self.size = size
+        # 与Discord CDN相同的签名链接格式，ex 为十六进制的过期时间戳
+        self.url = (f'https://cdn.discordapp.com/attachments/1/{FakeAttachment.count}/{filename}'
+                    f'?ex={int(time.time()) + 86400:x}&is={int(time.time()):x}&hm=loadtest')
+
+
+class FakeMessage:
+    """发送的消息；流式模式下作为占位消息，记录预览编辑次数"""
+
+    def __init__(self, record: 'JobRecord', attachments=()):
+        self.record = record
+        self.attachments = list(attachments)
+        self.jump_url = f'https://discord.com/channels/1/1/{id(self)}'
+
+    async def edit(self, content=None, embed=None, attachments=None, **kwargs):
+        if embed is None:
+            self.record.preview_edits += 1
+            return self
+        return await self.record.followup.send(embed=embed, files=attachments, wait=True)
+
+
+class FakeFollowup:
+    """记录followup发送时间和上传字节数，可按带宽模拟上传耗时"""
+
+    upload_mbps = 0.0
+
+    def __init__(self, record: 'JobRecord'):
+        self.record = record
+
+    async def send(self, *args, embed=None, file=None, files=None, wait=False, **kwargs):
+        if embed is None and wait:
+            return FakeMessage(self.record)
+        if file is not None:
+            files = [file]
+        sent = 0
+        attachments = []
+        for f in files or ():
+            size = len(f.fp.getbuffer()) if hasattr(f.fp, 'getbuffer') else 0
+            attachments.append(FakeAttachment(f.filename, size))
+            sent += size
+        self.record.upload_bytes += sent
+        if self.upload_mbps > 0 and sent:
+            await asyncio.sleep(sent * 8 / (self.upload_mbps * 1_000_000))
+        self.record.done_at = time.monotonic()
+        self.record.ok = bool(embed is not None and embed.title and embed.title.startswith('✅'))
+        self.record.degraded = any(field.name == '⚡ 高峰降级' for field in (embed.fields if embed else ()))
+        self.record.reused = bool(embed is not None and not files and embed.image and embed.image.url)
+        self.record.attachments += len(attachments)
+        if self.record.ok:
+            # 降级任务返回的图片更少；拼图和复用的结果用一个或零个附件承载多张图片，按Seed计数
+            seeds = next((field.value for field in embed.fields if field.name == 'Seed'), '')
+            self.record.images = len(seeds.split(', ')) if seeds else len(attachments)
+        self.record.finished.set()
+        return FakeMessage(self.record, attachments) if wait else None
+
+
+class FakeInteraction:
+    count = 0
+
+    def __init__(self, record: 'JobRecord'):
+        FakeInteraction.count += 1
+        self.application_id = 1
+        self.token = f'loadtest-{FakeInteraction.count}'
+        self.channel_id = 1
+        self.created_at = datetime.now(timezone.utc)
+        self.user = FakeUser(record.user_id)
+        self.response = FakeResponse(record)
+        self.followup = FakeFollowup(record)
+        record.followup = self.followup
+
+
+class JobRecord:
+    __slots__ = ('user_id', 'submitted_at', 'acked_at', 'started_at', 'done_at',
+                 'upload_bytes', 'attachments', 'images', 'ok', 'rejected', 'degraded', 'reused', 'finished', 'followup',
+                 'preview_edits')
+
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self.submitted_at = time.monotonic()
+        self.acked_at = None
+        self.started_at = None
+        self.done_at = None
+        self.upload_bytes = 0
+        self.attachments = 0
+        self.images = 0
+        self.ok = False
+        self.rejected = False
+        self.degraded = False
+        self.reused = False
+        self.finished = asyncio.Event()
+        self.followup = None
+        self.preview_edits = 0
+
+
+class LoopLagProbe:
+    """定时唤醒并测量实际唤醒时间的偏差"""
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.samples: List[float] = []
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - expected))
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+
+
+class RssProbe:
+    """定时采样进程常驻内存（RSS），记录峰值"""
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.baseline = self.read()
+        self.peak = self.baseline
+        self._task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def read() -> int:
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError):
+            # 非Linux平台只能取到历史峰值
+            import resource
+            scale = 1 if sys.platform == 'darwin' else 1024
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+    async def _run(self):
+        while True:
+            self.peak = max(self.peak, self.read())
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+        self.peak = max(self.peak, self.read())
+
+
+def synthetic_trace(jobs: int, rate: float, sizes: List[str], users: int, steps: List[int],
+                    seed_pool: int = 0) -> List[dict]:
+    """泊松到达序列；seed_pool 大于0时每个任务从这么多个固定种子中选择，模拟重复请求"""
+    t = 0.0
+    trace = []
+    for i in range(jobs):
+        t += random.expovariate(rate) if rate > 0 else 0.0
+        entry = {'t': t, 'user': random.randint(1, users), 'size': random.choice(sizes),
+                 'steps': random.choice(steps)}
+        if seed_pool > 0:
+            entry['seed'] = random.randint(1, seed_pool)
+        trace.append(entry)
+    return trace
+
+
+def load_trace(path: str) -> List[dict]:
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+async def run_load(args) -> dict:
+    options = dict(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, payload=args.payload,
+                   preview_frames=args.preview_frames, scale_latency=args.scale_latency)
+    if args.memory_check:
+        from constants import SIZE_PRESETS
+        sizes = [(SIZE_PRESETS[name]['width'], SIZE_PRESETS[name]['height']) for name in args.sizes.split(',')]
+        server = ProcessServer(options, sizes)
+    else:
+        server = FakeNovelAIServer(**options)
+    await server.start()
+    FakeFollowup.upload_mbps = args.upload_mbps
+
+    # main.py在导入时读取这些环境变量
+    os.environ['NAI_API_BASE'] = server.base_url
+    os.environ.setdefault('DISCORD_TOKEN', 'loadtest')
+    os.environ.setdefault('NAI_API_KEY', 'loadtest')
+    if args.policy:
+        os.environ['QUEUE_POLICY'] = args.policy
+    # 生成历史、预设和运行配置写入临时目录，不会混入部署环境的数据
+    data_dir = tempfile.mkdtemp(prefix='nai-loadtest-')
+    os.environ['DATA_DIR'] = data_dir
+    import main
+
+    # 记录每个任务实际开始调用API的时间
+    started: Dict[int, JobRecord] = {}
+    original_generate = main.generate_image
+
+    async def timed_generate(params, *a, **kw):
+        record = started.get(id(params))
+        if record is not None and record.started_at is None:
+            record.started_at = time.monotonic()
+        return await original_generate(params, *a, **kw)
+
+    main.generate_image = timed_generate
+
+    # 队列中的任务只保存交互令牌，按令牌找到对应的模拟followup
+    followups: Dict[str, FakeFollowup] = {}
+    main.job_followup = lambda job: followups[job.token]
+
+    trace = load_trace(args.trace) if args.trace else synthetic_trace(
+        args.jobs, args.rate, args.sizes.split(','), args.users, [int(n) for n in args.steps.split(',')],
+        args.seed_pool
+    )
+    # 预先生成各尺寸的基础图片，避免模拟服务的生成时间计入事件循环延迟
+    from constants import SIZE_PRESETS
+    for entry in trace:
+        size = SIZE_PRESETS.get(entry.get('size', 'portrait_s'), SIZE_PRESETS['portrait_s'])
+        server.build_image(size['width'], size['height'])
+
+    probe = LoopLagProbe()
+    probe.start()
+    rss = RssProbe()
+    rss.start()
+
+    records: List[JobRecord] = []
+    begin = time.monotonic()
+    for entry in trace:
+        delay = begin + entry['t'] - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        record = JobRecord(entry.get('user', 1))
+        records.append(record)
+        interaction = FakeInteraction(record)
+        followups[interaction.token] = interaction.followup
+        await main.nai_command.callback(
+            interaction,
+            prompt=entry.get('prompt', '1girl, loadtest'),
+            model=entry.get('model', 'nai-diffusion-3'),
+            size=entry.get('size', 'portrait_s'),
+            steps=entry.get('steps'),
+            seed=entry.get('seed'),
+            remove_metadata=entry.get('remove_metadata', args.remove_metadata),
+            stream=entry.get('stream', args.stream),
+            n_samples=entry.get('n_samples', args.n_samples)
+        )
+        # 找到nai_command刚加入队列的任务
+        for job in main.task_queue:
+            if job.token == interaction.token:
+                started[id(job.params)] = record
+                break
+        else:
+            if not record.rejected:
+                record.started_at = time.monotonic()
+
+    await asyncio.wait_for(
+        asyncio.gather(*(r.finished.wait() for r in records)),
+        timeout=args.timeout
+    )
+    elapsed = time.monotonic() - begin
+    probe.stop()
+    rss.stop()
+    await server.stop()
+    shutil.rmtree(data_dir, ignore_errors=True)
+
+    ok = [r for r in records if r.ok]
+    rejected = sum(1 for r in records if r.rejected)
+    return {
+        'jobs': len(records),
+        'succeeded': len(ok),
+        'failed': len(records) - len(ok) - rejected,
+        'rejected': rejected,
+        'degraded': sum(1 for r in ok if r.degraded),
+        'reused': sum(1 for r in ok if r.reused),
+        'load_transitions': main.degradation.transitions,
+        'elapsed_s': elapsed,
+        'jobs_per_s': len(ok) / elapsed if elapsed else 0.0,
+        'images': sum(r.images for r in ok),
+        'images_per_s': sum(r.images for r in ok) / elapsed if elapsed else 0.0,
+        'api_requests': server.requests,
+        'upload_mb': sum(r.upload_bytes for r in records) / (1024 * 1024),
+        'attachments': sum(r.attachments for r in records),
+        'preview_edits': sum(r.preview_edits for r in records),
+        'queue_wait_s': summarize([r.started_at - r.submitted_at for r in records if r.started_at]),
+        'end_to_end_s': summarize([r.done_at - r.submitted_at for r in records if r.done_at]),
+        'loop_lag_ms': {k: v * 1000 for k, v in summarize(probe.samples).items()},
+        'memory': dict(main.memory_budget.stats(), rss_baseline=rss.baseline, rss_peak=rss.peak)
+    }
+
+
+class PanelResponse:
+    """面板点击的响应，只记录调用"""
+
+    def __init__(self):
+        self.edits = 0
+        self.messages = []
+
+    async def edit_message(self, *args, **kwargs):
+        self.edits += 1
+
+    async def send_message(self, content=None, **kwargs):
+        self.messages.append(content)
+
+
+class PanelInteraction:
+    """持久化面板组件的点击"""
+
+    def __init__(self, user_id: int, custom_id: str, values=None):
+        self.user = FakeUser(user_id)
+        self.data = {'custom_id': custom_id, 'component_type': 3 if values else 2}
+        if values:
+            self.data['values'] = values
+        self.response = PanelResponse()
+
+
+async def run_panel_restart(args) -> dict:
+    """
+    面板重启场景
+
+    为每个用户保存一份面板设置后换上空的会话存储（相当于进程重启），再通过启动时注册的
+    PanelView 的组件回调分发点击：第一次点击应从保存的设置惰性恢复状态，之后的点击命中会话，
+    最后保存的设置应包含恢复前的字段和点击后的修改。
+    """
+    os.environ.setdefault('DISCORD_TOKEN', 'loadtest')
+    os.environ.setdefault('NAI_API_KEY', 'loadtest')
+    data_dir = tempfile.mkdtemp(prefix='nai-loadtest-')
+    os.environ['DATA_DIR'] = data_dir
+    import main
+    from constants import MODELS, SAMPLER_OPTIONS, SIZE_OPTIONS
+    from panel_store import PanelSessionStore, PanelState
+
+    rng = random.Random(0)
+    user_ids = list(range(1, args.users + 1))
+    saved = {
+        str(user_id): PanelState(
+            model=rng.choice(list(MODELS)),
+            size=rng.choice(SIZE_OPTIONS)[1],
+            sampler=rng.choice(SAMPLER_OPTIONS)[1],
+            remove_metadata=rng.random() < 0.5,
+            n_samples=rng.randint(1, 4)
+        ).to_dict()
+        for user_id in user_ids
+    }
+    main.save_user_settings(saved)
+
+    # 启动时注册的视图：不带用户状态，所有组件都交给 handle_panel_interaction
+    view = main.PanelView()
+    items = {item.custom_id: item for item in view.children}
+    main.panel_sessions = PanelSessionStore()
+
+    restore_s, hit_s, mismatches = [], [], []
+    for user_id in user_ids:
+        clicks = (('metadata_button', None), ('size_select', ['square_m']), ('save_button', None))
+        for i, (custom_id, values) in enumerate(clicks):
+            interaction = PanelInteraction(user_id, custom_id, values)
+            start = time.perf_counter()
+            await items[custom_id].callback(interaction)
+            (restore_s if i == 0 else hit_s).append(time.perf_counter() - start)
+
+        expected = dict(saved[str(user_id)], remove_metadata=not saved[str(user_id)]['remove_metadata'],
+                        size='square_m', custom_width=768, custom_height=768)
+        if main.load_user_settings().get(str(user_id)) != expected:
+            mismatches.append(user_id)
+
+    shutil.rmtree(data_dir, ignore_errors=True)
+    return {
+        'scenario': 'panel-restart',
+        'users': len(user_ids),
+        'persistent': view.is_persistent(),
+        'sessions': main.panel_sessions.stats(),
+        'mismatches': mismatches,
+        'restore_ms': {k: v * 1000 for k, v in summarize(restore_s).items()},
+        'hit_ms': {k: v * 1000 for k, v in summarize(hit_s).items()}
+    }
+
+
+def panel_restart_passed(report: dict) -> bool:
+    sessions = report['sessions']
+    return (report['persistent'] and not report['mismatches']
+            and sessions['misses'] == report['users'] and sessions['hits'] == 2 * report['users'])
+
+
+def print_panel_report(report: dict):
+    sessions = report['sessions']
+    print('=' * 60)
+    print(f"用户数: {report['users']} | 持久化视图: {report['persistent']} | 设置不一致: {len(report['mismatches'])}")
+    print(f"会话: 恢复 {sessions['misses']} | 命中 {sessions['hits']} | 当前 {sessions['size']}")
+    for key, label in (('restore_ms', '恢复点击'), ('hit_ms', '命中点击')):
+        stats = report[key]
+        print(f"{label}: p50={stats['p50']:.3f}ms p90={stats['p90']:.3f}ms "
+              f"p99={stats['p99']:.3f}ms max={stats['max']:.3f}ms")
+    print('=' * 60)
+
+
+def print_report(report: dict):
+    print('=' * 60)
+    print(f"任务数: {report['jobs']} | 成功: {report['succeeded']} | 失败: {report['failed']} | 拒绝: {report['rejected']}")
+    print(f"降级完成: {report['degraded']} | 负载级别切换: {report['load_transitions']} | 复用附件: {report['reused']}")
+    print(f"总耗时: {report['elapsed_s']:.2f}s | 吞吐量: {report['jobs_per_s']:.2f} jobs/s, {report['images_per_s']:.2f} images/s | API请求: {report['api_requests']}")
+    print(f"图片: {report['images']} | 附件: {report['attachments']} | 上传: {report['upload_mb']:.1f} MB | 预览编辑: {report['preview_edits']} | 事件循环: {report['event_loop']}")
+    for key, label, unit in (('queue_wait_s', '排队等待', 's'), ('end_to_end_s', '端到端', 's'),
+                             ('loop_lag_ms', '事件循环延迟', 'ms')):
+        stats = report[key]
+        print(f"{label}: p50={stats['p50']:.3f}{unit} p90={stats['p90']:.3f}{unit} "
+              f"p99={stats['p99']:.3f}{unit} max={stats['max']:.3f}{unit}")
+    memory = report['memory']
+    mb = 1024 * 1024
+    print(f"内存预算: 上限 {memory['limit'] / mb:.0f} MB | 峰值占用 {memory['high_water'] / mb:.1f} MB | "
+          f"RSS: 启动 {memory['rss_baseline'] / mb:.0f} MB, 峰值 {memory['rss_peak'] / mb:.0f} MB, "
+          f"增长 {(memory['rss_peak'] - memory['rss_baseline']) / mb:.0f} MB")
+    print('=' * 60)
+
+
+def parse_args(argv=None):
+    from bench import BENCHMARKS
+    parser = argparse.ArgumentParser(description='NovelAI Bot 离线压力测试')
+    parser.add_argument('--bench', choices=sorted(BENCHMARKS), help='运行一项微基准测试（见 bench.py）而不是压力测试')
+    parser.add_argument('--bench-size', type=int, help='微基准测试的规模，省略时使用各项的默认值')
+    parser.add_argument('--scenario', choices=('queue', 'panel-restart'), default='queue',
+                        help='queue: 生成队列压力测试；panel-restart: 清空面板会话后检查持久化面板的惰性恢复')
+    parser.add_argument('--jobs', type=int, default=50, help='合成序列的任务数')
+    parser.add_argument('--rate', type=float, default=5.0, help='每秒到达的任务数（泊松分布）')
+    parser.add_argument('--users', type=int, default=20, help='模拟的用户数')
+    parser.add_argument('--sizes', default='portrait_s,portrait_m,square_m', help='随机选择的尺寸预设')
+    parser.add_argument('--steps', default='28', help='随机选择的步数')
+    parser.add_argument('--seed-pool', type=int, default=0, help='从N个固定种子中随机选择（模拟重复请求），0表示随机种子')
+    parser.add_argument('--trace', help='JSON Lines格式的到达序列文件 (t, user, size, steps, model, prompt)')
+    parser.add_argument('--latency', type=float, default=1.0, help='模拟API平均延迟（秒）')
+    parser.add_argument('--jitter', type=float, default=0.2, help='模拟API延迟标准差（秒）')
+    parser.add_argument('--scale-latency', action='store_true', help='模拟延迟按 像素×步数×数量 缩放')
+    parser.add_argument('--policy', choices=('sjf', 'fifo'), help='队列调度策略（默认使用QUEUE_POLICY环境变量）')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='模拟API错误率')
+    parser.add_argument('--upload-mbps', type=float, default=0.0, help='模拟Discord上传带宽（Mbps），0表示不限速')
+    parser.add_argument('--payload', choices=('noise', 'flat'), default='noise', help='返回图片内容')
+    parser.add_argument('--n-samples', type=int, default=1, help='每个任务生成的图片数量')
+    parser.add_argument('--stream', action='store_true', help='使用流式生成接口')
+    parser.add_argument('--preview-frames', type=int, default=28, help='流式模式下每个任务推送的预览帧数')
+    parser.add_argument('--remove-metadata', action='store_true', help='启用元数据清除')
+    parser.add_argument('--timeout', type=float, default=600.0, help='等待全部任务完成的超时时间')
+    parser.add_argument('--uvloop', action='store_true', help='使用uvloop事件循环（需已安装uvloop）')
+    parser.add_argument('--json', action='store_true', help='以JSON输出结果，便于与基线对比')
+    parser.add_argument('--memory-check', action='store_true',
+                        help='模拟服务在子进程中运行以测量RSS；RSS增长超过内存预算加 --rss-slack 时以非零状态退出')
+    parser.add_argument('--rss-slack', type=float, default=RSS_SLACK_MB,
+                        help='--memory-check 允许RSS增长超出内存预算的MB数（预算不统计的解释器和线程开销）')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.bench:
+        from bench import BENCHMARKS, print_bench_report
+        fn, size = BENCHMARKS[args.bench]
+        report = fn(args.bench_size or size)
+        if asyncio.iscoroutine(report):
+            report = asyncio.run(report)
+        if args.json:
+            json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+            print()
+        else:
+            print_bench_report(args.bench, report)
+        return
+
+    if args.scenario == 'panel-restart':
+        report = asyncio.run(run_panel_restart(args))
+        if args.json:
+            json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+            print()
+        else:
+            print_panel_report(report)
+        if not panel_restart_passed(report):
+            print('面板状态恢复检查失败', file=sys.stderr)
+            sys.exit(1)
+        return
+
+    from loop_monitor import install_event_loop_policy
+    loop_name = install_event_loop_policy(args.uvloop)
+    report = asyncio.run(run_load(args))
+    report['event_loop'] = loop_name
+    if args.json:
+        json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+    else:
+        print_report(report)
+    if args.memory_check:
+        # 单个任务的预估超过整个预算时会在没有其他占用时放行，此时以预算的峰值占用为准
+        memory = report['memory']
+        growth = memory['rss_peak'] - memory['rss_baseline']
+        budget = max(memory['limit'], memory['high_water'])
+        if growth > budget + args.rss_slack * 1024 * 1024:
+            print(f"RSS增长超出内存预算: {growth / 1024 / 1024:.0f} MB > 预算 {budget / 1024 / 1024:.0f} MB "
+                  f"+ 余量 {args.rss_slack:.0f} MB", file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+import atexit
+import json
+import logging
+import os
+import queue
+import sys
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional, Sequence
+
+LOG_FORMAT = '%(asctime)s [%(levelname)s] %(message)s'
+
+# 高频调试日志的前缀，按采样率输出
+SAMPLED_PREFIXES = ('[面板交互]',)
+
+_listener: Optional[QueueListener] = None
+
+
+class JsonFormatter(logging.Formatter):
+    """每条日志输出为一行JSON"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        if record.exc_info:
+            data['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False)
+
+
+class SamplingFilter(logging.Filter):
+    """对指定前缀的DEBUG日志每N条只保留一条"""
+
+    def __init__(self, every_n: int, prefixes: Sequence[str] = SAMPLED_PREFIXES):
+        super().__init__()
+        self.every_n = max(1, every_n)
+        self.prefixes = tuple(prefixes)
+        self._count = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.DEBUG or self.every_n == 1:
+            return True
+        if not isinstance(record.msg, str) or not record.msg.startswith(self.prefixes):
+            return True
+        self._count += 1
+        return self._count % self.every_n == 1
+
+
+def setup_logging(level: Optional[str] = None, json_output: Optional[bool] = None,
+                  sample_every: Optional[int] = None) -> QueueListener:
+    """
+    配置非阻塞日志：调用方只把记录放入队列，由后台线程写入stdout
+
+    可通过环境变量 LOG_LEVEL、LOG_JSON、LOG_SAMPLE_EVERY 配置。重复调用时直接返回已有的监听器。
+    """
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    level = level or os.getenv('LOG_LEVEL', 'INFO')
+    if json_output is None:
+        json_output = os.getenv('LOG_JSON', '').lower() in ('1', 'true', 'yes')
+    if sample_every is None:
+        sample_every = int(os.getenv('LOG_SAMPLE_EVERY', '10'))
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonFormatter() if json_output else logging.Formatter(LOG_FORMAT))
+
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    queue_handler = QueueHandler(log_queue)
+    # 在调用线程中丢弃被采样掉的记录，避免无谓的入队
+    queue_handler.addFilter(SamplingFilter(sample_every))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    _listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+    return _listener
+
+
+def stop_logging():
+    """停止后台线程并写出队列中剩余的日志"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import bisect
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# 探针唤醒间隔（秒）
+LOOP_PROBE_INTERVAL = 0.5
+# 超过该延迟（毫秒）时记录警告和事件循环线程的调用栈
+LOOP_LAG_THRESHOLD_MS = int(os.getenv('LOOP_LAG_THRESHOLD_MS', '250'))
+# 直方图桶上界（毫秒），最后一个桶收集超出范围的样本
+LAG_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+
+
+def install_event_loop_policy(use_uvloop: Optional[bool] = None) -> str:
+    """
+    按 USE_UVLOOP 环境变量选择事件循环实现，必须在创建事件循环之前调用
+
+    返回实际使用的实现名称；未安装uvloop时回退到asyncio默认实现。
+    """
+    if use_uvloop is None:
+        use_uvloop = os.getenv('USE_UVLOOP', '').lower() in ('1', 'true', 'yes')
+    if sys.platform == 'win32':
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+        return 'asyncio (selector)'
+    if use_uvloop:
+        try:
+            import uvloop
+        except ImportError:
+            logger.warning("[事件循环] 已设置USE_UVLOOP但未安装uvloop，使用asyncio默认实现")
+        else:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+            return f'uvloop {uvloop.__version__}'
+    return 'asyncio'
+
+
+class LoopLagMonitor:
+    """
+    事件循环延迟监控
+
+    探针协程每隔 interval 秒唤醒一次，实际唤醒时间与预期的差值即为其他回调阻塞事件循环的时长，
+    结果按桶计入直方图。探针本身无法在阻塞期间运行，因此另有一个看门狗线程检查心跳，
+    心跳超时时通过 sys._current_frames() 抓取事件循环线程当前的调用栈，定位阻塞的代码。
+    """
+
+    def __init__(self, interval: float = LOOP_PROBE_INTERVAL, threshold_ms: int = LOOP_LAG_THRESHOLD_MS):
+        self.interval = interval
+        self.threshold = threshold_ms / 1000
+        self.buckets: List[int] = [0] * (len(LAG_BUCKETS_MS) + 1)
+        self.samples = 0
+        self.total_lag = 0.0
+        self.max_lag = 0.0
+        self.stalls = 0
+        self._heartbeat = time.monotonic()
+        self._loop_thread_id: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        if self._task is not None:
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stopped.clear()
+        self._task = asyncio.create_task(self._probe())
+        self._watchdog = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+        self._watchdog.start()
+        logger.info(f"[事件循环] 延迟监控已启动 | 阈值: {int(self.threshold * 1000)}ms")
+
+    def stop(self):
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def record(self, lag: float):
+        lag_ms = lag * 1000
+        self.buckets[bisect.bisect_left(LAG_BUCKETS_MS, lag_ms)] += 1
+        self.samples += 1
+        self.total_lag += lag
+        if lag > self.max_lag:
+            self.max_lag = lag
+
+    async def _probe(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - expected)
+            self._heartbeat = time.monotonic()
+            self.record(lag)
+            if lag >= self.threshold:
+                logger.warning(f"[事件循环] 回调阻塞 {lag * 1000:.0f}ms")
+
+    def _watch(self):
+        """看门狗线程：心跳超时时记录事件循环线程的调用栈，每次阻塞只记录一次"""
+        reported = False
+        check_every = max(0.05, self.threshold / 2)
+        while not self._stopped.wait(check_every):
+            stalled = time.monotonic() - self._heartbeat - self.interval
+            if stalled < self.threshold:
+                reported = False
+                continue
+            if reported:
+                continue
+            reported = True
+            self.stalls += 1
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = ''.join(traceback.format_stack(frame)) if frame is not None else '（无法获取调用栈）'
+            logger.warning(f"[事件循环] 已阻塞 {stalled * 1000:.0f}ms，当前调用栈:\n{stack}")
+
+    def histogram(self) -> Dict[str, int]:
+        labels = [f'<{bound}ms' for bound in LAG_BUCKETS_MS] + [f'>={LAG_BUCKETS_MS[-1]}ms']
+        return dict(zip(labels, self.buckets))
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'samples': self.samples,
+            'mean_ms': self.total_lag / self.samples * 1000 if self.samples else 0.0,
+            'max_ms': self.max_lag * 1000,
+            'stalls': self.stalls
+        }
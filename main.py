@@ -1,258 +1,258 @@
 # -*- coding: utf-8 -*-
 import os
 import sys
-
-# 确保输出不被缓冲
-os.environ['PYTHONUNBUFFERED'] = '1'
 import json
 import random
 import io
 import zipfile
+import base64
 import asyncio
 import logging
+import time
 from datetime import datetime
 from typing import Dict, Optional, Any
-from collections import deque
 import discord
 from discord import app_commands
 from discord.ext import commands
 import aiohttp
 from dotenv import load_dotenv
-from utils import load_presets, save_presets, load_user_settings, save_user_settings
-from image_processor import process_image_metadata
-
-# 配置日志系统
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s [%(levelname)s] %(message)s',
-    handlers=[
-        logging.StreamHandler(sys.stdout)
-    ]
-)
-logger = logging.getLogger(__name__)
-
-# 配置日志 - 直接输出到stdout，无缓冲
-print("=" * 50, flush=True)
-print("Discord NovelAI Bot (Python Version)", flush=True)
-print(f"Python: {sys.version}", flush=True)
-print(f"Discord.py: {discord.__version__}", flush=True)
-print(f"Platform: {sys.platform}", flush=True)
-print(f"Working Dir: {os.getcwd()}", flush=True)
-print("=" * 50, flush=True)
+from utils import DATA_DIR, load_user_settings, save_user_settings
+from image_processor import process_image_metadata, compose_contact_sheet
+from memory_budget import (ByteBudget, BytesLRU, estimate_job_bytes, estimate_sheet_bytes, format_bytes,
+                           limit_allocator_retention)
+from panel_store import PanelState, PanelSessionStore
+from panel_renderer import build_panel_embed, add_panel_items
+from preset_index import PresetIndexStore
+from preset_library import PresetError, PresetLibrary
+from streaming import PreviewThrottler, iter_sse_events
+from input_cache import InputImageCache, InputImageError, validate_attachment, fit_size
+from constants import SIZE_LIMITS, SIZE_PRESETS, MODELS, SIZE_OPTIONS, SAMPLER_OPTIONS, MAX_SAMPLES
+from log_setup import setup_logging
+from loop_monitor import LoopLagMonitor, install_event_loop_policy
+from profiler import ProfilerBusy, profile_cpu, profile_memory, MAX_PROFILE_SECONDS
+from http_server import HttpServer
+from supervisor import Supervisor
+from scheduler import CostModel, CostAwareQueue
+from runtime_config import ConfigError, RuntimeConfigStore, config_fields
+from degradation import DegradationController, DEGRADED, SHED, LEVEL_NAMES, degrade_params
+from history_log import HistoryLog, HistoryRecord
+from delivery_index import DeliveryIndex, upload_key
+from jobs import Job, JobParams, TOKEN_LIFETIME
+from request_compiler import compile_request, get_model_defaults
+from prompt_tokens import PromptTooLong, load_tokenizers, validate_preset, validate_prompt
 
 load_dotenv()
 
+# 配置日志系统：记录先进入队列，由后台线程写入stdout，避免阻塞事件循环
+setup_logging()
+logger = logging.getLogger(__name__)
+
+logger.info("=" * 50)
+logger.info("Discord NovelAI Bot (Python Version)")
+logger.info(f"Python: {sys.version}")
+logger.info(f"Discord.py: {discord.__version__}")
+logger.info(f"Platform: {sys.platform}")
+logger.info(f"Working Dir: {os.getcwd()}")
+logger.info("=" * 50)
+
 DISCORD_TOKEN = os.getenv('DISCORD_TOKEN')
 NAI_API_KEY = os.getenv('NAI_API_KEY')
-NAI_API_BASE = 'https://image.novelai.net'
+NAI_API_BASE = os.getenv('NAI_API_BASE', 'https://image.novelai.net')
 
 # 检查环境变量
-print(f"Discord Token: {'✓ Found' if DISCORD_TOKEN else '✗ Missing'}", flush=True)
-print(f"NAI API Key: {'✓ Found' if NAI_API_KEY else '✗ Missing'}", flush=True)
-print(f"Environment: {'Zeabur' if os.getenv('ZEABUR') else 'Local/Docker'}", flush=True)
-
-if not DISCORD_TOKEN:
-    print("ERROR: DISCORD_TOKEN not found!", flush=True)
-    print("Please set DISCORD_TOKEN in environment variables", flush=True)
-    # 保持进程运行以便查看日志
-    import time
-    while True:
-        time.sleep(60)
-        print("Waiting for DISCORD_TOKEN...", flush=True)
-
-if not NAI_API_KEY:
-    print("ERROR: NAI_API_KEY not found!", flush=True)
-    print("Please set NAI_API_KEY in environment variables", flush=True)
-    # 保持进程运行以便查看日志
-    import time
-    while True:
-        time.sleep(60)
-        print("Waiting for NAI_API_KEY...", flush=True)
+logger.info(f"Discord Token: {'✓ Found' if DISCORD_TOKEN else '✗ Missing'}")
+logger.info(f"NAI API Key: {'✓ Found' if NAI_API_KEY else '✗ Missing'}")
+logger.info(f"Environment: {'Zeabur' if os.getenv('ZEABUR') else 'Local/Docker'}")
+
+# 缺少必需配置时不退出，由监督器保持进程和健康检查运行以便查看日志
+MISSING_CONFIG = [name for name, value in (('DISCORD_TOKEN', DISCORD_TOKEN), ('NAI_API_KEY', NAI_API_KEY)) if not value]
+for name in MISSING_CONFIG:
+    logger.error(f"ERROR: {name} not found!")
+    logger.error(f"Please set {name} in environment variables")
+if not MISSING_CONFIG:
+    logger.info("Configuration OK, starting bot...")
+
+# 运行中可调整的参数（并发数、超时、尺寸上限、编码设置等），见 runtime_config.py
+runtime_config = RuntimeConfigStore(DATA_DIR)
+runtime_config.load()
+
+# 任务队列：按成本模型预估的生成耗时排序（短任务优先，带老化）
+cost_model = CostModel()
+task_queue = CostAwareQueue(cost_model, runtime_config.current.queue_policy, runtime_config.current.queue_aging)
+# 高负载时自动降级（限制步数和尺寸、快速清除元数据），过载时暂停接收新任务
+degradation = DegradationController()
+queue_lock = asyncio.Lock()  # 添加队列锁以防止竞态条件
 
-print("Configuration OK, starting bot...", flush=True)
+# 交互令牌有效期15分钟，预估等待超过上限时拒绝（为生成和上传留出余量）
+MAX_ESTIMATED_WAIT = TOKEN_LIFETIME - 120
+# 预估等待超过该值时在回复中提醒
+WARN_ESTIMATED_WAIT = 5 * 60
 
-# 任务队列
-task_queue = deque()
-is_generating = False
-queue_lock = asyncio.Lock()  # 添加队列锁以防止竞态条件
+# 生成与上传分为两个阶段，各自有并发上限（runtime_config 中的 generation/delivery_concurrency）
+DELIVERY_RETRIES = 3
+active_generations = 0
+# 等待上传的结果，队列满时生成阶段会等待
+delivery_queue = asyncio.Queue(maxsize=int(os.getenv('DELIVERY_QUEUE_SIZE', '8')))
+delivery_workers = set()
+# 正在等待上传任务的协程，缩减并发时可以直接取消
+idle_delivery_workers = set()
+
+# 局部重绘模型
+INPAINTING_MODELS = ('nai-diffusion-3-inpainting',)
+
+# 在途图片缓冲区的内存预算（默认256MB）
+MEMORY_BUDGET_BYTES = int(os.getenv('MEMORY_BUDGET_MB', '256')) * 1024 * 1024
+memory_budget = ByteBudget(MEMORY_BUDGET_BYTES)
+# 预算只统计在途的缓冲区，释放后的内存要真正归还系统，RSS才会跟随预算
+limit_allocator_retention()
+
+# 图生图输入图片缓存，占用计入内存预算
+input_cache = InputImageCache(budget=memory_budget)
+
+# 面板会话缓存，过期后从已保存的设置中惰性恢复
+panel_sessions = PanelSessionStore()
+
+# 用户预设和服务器共享预设库，提示词按片段去重保存，首次访问时加载
+preset_library = PresetLibrary(DATA_DIR)
+
+# 预设名称索引，用于自动补全
+preset_index = PresetIndexStore(preset_library.names)
 
-# 面板状态缓存
-panel_states = {}
-
-# 尺寸步进值
-SIZE_STEP = 64
-
-# 尺寸限制
-SIZE_LIMITS = {
-    'maxPixels': 832 * 1216,
-    'maxWidth': 1216,
-    'maxHeight': 1216
-}
-
-# 尺寸预设
-SIZE_PRESETS = {
-    'portrait_s': {'width': 512, 'height': 768},
-    'portrait_m': {'width': 832, 'height': 1216},
-    'landscape_s': {'width': 768, 'height': 512},
-    'landscape_m': {'width': 1216, 'height': 832},
-    'square_s': {'width': 512, 'height': 512},
-    'square_m': {'width': 768, 'height': 768},
-    'square_l': {'width': 832, 'height': 832}
-}
-
-# 模型列表
-MODELS = {
-    'nai-diffusion-4-5-full': '🌟 V4.5 Full',
-    'nai-diffusion-4-5-curated': '✨ V4.5 Curated',
-    'nai-diffusion-4-full': '🎯 V4 Full',
-    'nai-diffusion-4-curated': '📌 V4 Curated',
-    'nai-diffusion-4-curated-preview': '👁️ V4 Preview',
-    'nai-diffusion-3': '🎨 V3 Anime',
-    'nai-diffusion-3-inpainting': '🔧 V3 Inpainting',
-    'nai-diffusion-2': '🌸 V2 Anime',
-    'nai-diffusion': '🎯 V1 Anime',
-    'safe-diffusion': '✅ V1 Curated',
-    'nai-diffusion-furry': '🦊 V1 Furry',
-    'nai-diffusion-furry-v3': '🐺 V3 Furry'
-}
+# 生成历史，用于 /history 和结果消息上的重新生成按钮
+history_log = HistoryLog(DATA_DIR)
+HISTORY_PAGE_SIZE = 10
+
+# 多张结果拼成一张网格图上传（runtime_config.contact_sheet），原图保存在有界缓存中按需获取
+# 缓存占用计入内存预算，预算紧张时先淘汰缓存
+originals_cache = BytesLRU(int(os.getenv('ORIGINALS_CACHE_MB', '128')) * 1024 * 1024, memory_budget)
+
+# 已上传结果的内容哈希 -> CDN附件链接，相同的结果再次发送时直接引用
+delivery_index = DeliveryIndex(int(os.getenv('DELIVERY_INDEX_SIZE', '1024')))
+
+# 事件循环延迟监控
+LOOP_MONITOR = os.getenv('LOOP_MONITOR', 'true').lower() not in ('0', 'false', 'no')
+loop_monitor = LoopLagMonitor()
+
+# 设置PORT时启动HTTP服务（健康检查，管理接口需要ADMIN_TOKEN）
+http_server = HttpServer(int(os.environ['PORT'])) if os.getenv('PORT') else None
+
+# 精简网关模式（默认开启）：只订阅斜杠命令需要的事件，不缓存成员和消息
+LEAN_GATEWAY = os.getenv('LEAN_GATEWAY', 'true').lower() not in ('0', 'false', 'no')
 
 class NovelAIBot(commands.Bot):
     def __init__(self):
-        print("Initializing NovelAIBot...", flush=True)
-        intents = discord.Intents.default()
-        intents.message_content = True
-        super().__init__(command_prefix='!', intents=intents)
-        print("NovelAIBot initialized", flush=True)
+        logger.info("Initializing NovelAIBot...")
+        if LEAN_GATEWAY:
+            # 交互事件不依赖任何intent，guilds用于维护服务器列表
+            super().__init__(
+                command_prefix='!',
+                intents=discord.Intents(guilds=True),
+                member_cache_flags=discord.MemberCacheFlags.none(),
+                max_messages=None,
+                chunk_guilds_at_startup=False,
+                # 不分块加载成员时，等待GUILD_CREATE只会推迟on_ready（重启后的就绪时间）
+                guild_ready_timeout=0.5
+            )
+        else:
+            intents = discord.Intents.default()
+            intents.message_content = True
+            super().__init__(command_prefix='!', intents=intents)
+        # 命令注册和后台任务只在第一次登录时进行
+        self.setup_done = False
+        logger.info("NovelAIBot initialized")
 
     async def setup_hook(self):
-        print("Setting up bot commands...", flush=True)
+        # 每次登录都会调用（包括监督器重启连接后）；bot.clear()会清空view store，需要重新注册
+        # 注册持久化面板视图，重启后旧面板仍可使用
+        self.add_view(PanelView())
+        logger.info("Registered persistent PanelView")
+        if self.setup_done:
+            return
+
+        logger.info("Setting up bot commands...")
         try:
             # 添加预设命令组
             self.tree.add_command(PresetGroup())
-            print("Added PresetGroup command", flush=True)
+            self.tree.add_command(AdminGroup())
+            logger.info("Added PresetGroup and AdminGroup commands")
+            # 启动上传协程和队列清理任务
+            ensure_delivery_workers()
+            asyncio.create_task(queue_cleanup_task())
             # 同步命令
             synced = await self.tree.sync()
-            print(f'Commands synced successfully! Synced {len(synced)} commands', flush=True)
+            logger.info(f'Commands synced successfully! Synced {len(synced)} commands')
+            self.setup_done = True
         except Exception as e:
-            print(f"Error in setup_hook: {e}", flush=True)
-            import traceback
-            traceback.print_exc()
+            logger.exception(f"Error in setup_hook: {e}")
 
 bot = NovelAIBot()
 
-def get_model_defaults(model: str) -> Dict[str, Any]:
-    """获取模型默认参数"""
-    base = {
-        'width': 832,
-        'height': 1216,
-        'scale': 5,
-        'sampler': 'k_euler_ancestral',
-        'steps': 28,
-        'n_samples': 1,
-        'ucPreset': 0,
-        'qualityToggle': False,
-        'negative_prompt': 'lowres, bad anatomy, bad hands, text, error, missing fingers, extra digit, fewer digits, cropped, worst quality, low quality, normal quality, jpeg artifacts, signature, watermark, username, blurry'
-    }
-
-    if model.startswith('nai-diffusion-4'):
-        base.update({
-            'params_version': 3,
-            'use_coords': True,
-            'sm': False,
-            'sm_dyn': False,
-            'noise_schedule': 'karras',
-            'scale': 7.0
-        })
-    else:
-        base.update({
-            'sm': True,
-            'sm_dyn': True
-        })
-
-    return base
-
-def build_v4_prompt(prompt: str, is_negative: bool = False) -> Dict:
-    """构建V4模型提示词格式"""
-    return {
-        'caption': {
-            'base_caption': prompt,
-            'char_captions': []
-        },
-        'use_coords': True,
-        'use_order': True
-    }
-
-async def generate_image(params: Dict[str, Any]) -> tuple[bytes, int]:
-    """调用NovelAI API生成图片"""
-    import zipfile
-    import io
+def apply_preset(user_id: str, preset_name: Optional[str], prompt: str, negative: Optional[str]) -> tuple[str, Optional[str]]:
+    """将用户预设的提示词合并到本次提示词前面"""
+    if not preset_name:
+        return prompt, negative
+
+    # 预设在这里才从片段展开
+    preset_data = preset_library.get(user_id, preset_name)
+    if preset_data is not None:
+        preset_prompt, preset_negative = preset_data
+        prompt = f"{preset_prompt}, {prompt}"
+        if preset_negative:
+            negative = f"{preset_negative}, {negative}" if negative else preset_negative
+    return prompt, negative
+
+async def preset_autocomplete(
+    interaction: discord.Interaction,
+    current: str
+) -> list[app_commands.Choice[str]]:
+    """预设名称自动补全：前缀匹配优先，其次模糊匹配"""
+    user_id = str(interaction.user.id)
+    return [
+        app_commands.Choice(name=name, value=name)
+        for name in preset_index.search(user_id, current, limit=25)
+    ]
 
+async def extract_images(zip_data: bytes, seed: int, remove_metadata: bool,
+                         fast: bool = False) -> list[tuple[bytes, int]]:
+    """一次性取出ZIP中的所有PNG，需要时并行清除元数据，返回 [(图片, seed), ...]"""
+    with zipfile.ZipFile(io.BytesIO(zip_data)) as zip_file:
+        # 按文件名排序，image_0.png 对应 seed，之后依次加一
+        names = sorted(name for name in zip_file.namelist() if name.endswith('.png'))
+        images = [zip_file.read(name) for name in names]
+
+    if not images:
+        raise Exception('No image found in ZIP')
+    logger.debug(f"找到 {len(images)} 张图片, 总大小: {sum(len(i) for i in images)/1024:.2f} KB")
+
+    return await postprocess_images(images, seed, remove_metadata, fast)
+
+async def postprocess_images(images: list[bytes], seed: int, remove_metadata: bool,
+                             fast: bool = False) -> list[tuple[bytes, int]]:
+    """在线程池中并行清除元数据，避免阻塞事件循环；fast 为降级模式下的快速清除"""
+    if remove_metadata:
+        logger.debug(f"正在清除元数据...")
+        config = runtime_config.current
+        images = await asyncio.gather(*(
+            asyncio.to_thread(process_image_metadata, img, config.metadata_quality,
+                              config.metadata_compress_level, fast)
+            for img in images
+        ))
+    return [(img, seed + i) for i, img in enumerate(images)]
+
+async def generate_image(params: JobParams, preview: Optional[PreviewThrottler] = None) -> list[tuple[bytes, int]]:
+    """
+    调用NovelAI API生成图片，传入preview时使用流式接口并推送中间预览
+
+    一次请求生成 n_samples 张图片，返回 [(图片, seed), ...]
+    """
     logger.debug(f"生成参数: model={params['model']}, size={params['width']}x{params['height']}, steps={params.get('steps', 28)}")
 
-    prompt = params['prompt']
-    negative_prompt = params.get('negative_prompt', '')
-    model = params['model']
-    width = params['width']
-    height = params['height']
-    steps = params.get('steps', 28)
-    cfg = params.get('cfg', 5)
-    sampler = params.get('sampler', 'k_euler_ancestral')
     seed = params.get('seed', -1)
-    smea = params.get('smea', False)
-    dyn = params.get('dyn', False)
     remove_metadata = params.get('remove_metadata', False)
+    fast_metadata = params.get('fast_metadata', False)
 
     actual_seed = seed if seed != -1 else random.randint(0, 2147483647)
-    defaults = get_model_defaults(model)
-
-    final_prompt = prompt
-    final_negative = negative_prompt or defaults['negative_prompt']
-
-    # 非V4模型添加质量标签
-    if not model.startswith('nai-diffusion-4'):
-        final_prompt = 'masterpiece, best quality, ' + prompt
-
-    # 构建参数
-    base_params = {
-        'width': width,
-        'height': height,
-        'scale': cfg if cfg else defaults['scale'],
-        'sampler': sampler if sampler else defaults['sampler'],
-        'steps': steps if steps else defaults['steps'],
-        'seed': actual_seed,
-        'n_samples': 1,
-        'ucPreset': 0,
-        'qualityToggle': False,
-        'dynamic_thresholding': False,
-        'controlnet_strength': 1,
-        'legacy': False,
-        'add_original_image': False,
-        'negative_prompt': final_negative
-    }
-
-    # 构建请求体
-    payload = {
-        'input': final_prompt,  # input总是使用字符串
-        'model': model,
-        'action': 'generate',
-        'parameters': base_params
-    }
-
-    # V4模型特殊处理
-    if model.startswith('nai-diffusion-4'):
-        base_params['params_version'] = 3
-        base_params['use_coords'] = True
-        base_params['sm'] = False
-        base_params['sm_dyn'] = False
-        base_params['noise_schedule'] = 'karras'
-
-        # V4使用特殊格式
-        base_params['v4_prompt'] = build_v4_prompt(final_prompt)
-        base_params['v4_negative_prompt'] = build_v4_prompt(final_negative, True)
-    else:
-        # 非V4模型
-        base_params['sm'] = smea if smea is not None else defaults.get('sm', True)
-        base_params['sm_dyn'] = dyn if dyn is not None else defaults.get('sm_dyn', True)
+    request = compile_request(params, actual_seed, stream=preview is not None)
 
     headers = {
         'Authorization': f'Bearer {NAI_API_KEY}',
@@ -260,61 +260,36 @@ async def generate_image(params: Dict[str, Any]) -> tuple[bytes, int]:
         'Accept': 'application/zip'  # 期望返回ZIP文件
     }
 
+    if preview is not None:
+        return await generate_image_stream(request.body, headers, actual_seed, remove_metadata, preview, fast_metadata)
+
     async with aiohttp.ClientSession() as session:
         try:
             async with session.post(
                 f'{NAI_API_BASE}/ai/generate-image',
-                json=payload,
+                data=request.body,
                 headers=headers,
-                timeout=aiohttp.ClientTimeout(total=60)
+                timeout=aiohttp.ClientTimeout(total=runtime_config.current.api_timeout)
             ) as response:
                 if response.status == 200:
                     logger.debug(f"API响应成功，开始处理图片数据")
                     zip_data = await response.read()
-
-                    # 解压ZIP文件
-                    with zipfile.ZipFile(io.BytesIO(zip_data)) as zip_file:
-                        # 找到PNG文件
-                        for filename in zip_file.namelist():
-                            if filename.endswith('.png'):
-                                image_data = zip_file.read(filename)
-                                logger.debug(f"找到图片文件: {filename}, 大小: {len(image_data)/1024:.2f} KB")
-
-                                # 如果需要清除元数据
-                                if remove_metadata:
-                                    logger.debug(f"正在清除元数据...")
-                                    image_data = process_image_metadata(image_data)
-
-                                return image_data, actual_seed
-
-                    raise Exception('No image found in ZIP')
+                    return await extract_images(zip_data, actual_seed, remove_metadata, fast_metadata)
 
                 # V4模型500错误时重试
-                elif response.status == 500 and model.startswith('nai-diffusion-4'):
+                elif response.status == 500 and request.fallback_body is not None:
                     logger.warning(f"V4模型500错误，尝试使用简化参数重试")
 
-                    # 移除V4特殊字段重试
-                    if 'v4_prompt' in base_params:
-                        del base_params['v4_prompt']
-                    if 'v4_negative_prompt' in base_params:
-                        del base_params['v4_negative_prompt']
-
+                    # 不含V4特殊字段的请求体已在编译时生成
                     async with session.post(
                         f'{NAI_API_BASE}/ai/generate-image',
-                        json=payload,
+                        data=request.fallback_body,
                         headers=headers,
-                        timeout=aiohttp.ClientTimeout(total=60)
+                        timeout=aiohttp.ClientTimeout(total=runtime_config.current.api_timeout)
                     ) as retry_response:
                         if retry_response.status == 200:
                             zip_data = await retry_response.read()
-
-                            with zipfile.ZipFile(io.BytesIO(zip_data)) as zip_file:
-                                for filename in zip_file.namelist():
-                                    if filename.endswith('.png'):
-                                        image_data = zip_file.read(filename)
-                                        if remove_metadata:
-                                            image_data = process_image_metadata(image_data)
-                                        return image_data, actual_seed
+                            return await extract_images(zip_data, actual_seed, remove_metadata, fast_metadata)
                         else:
                             error_text = await retry_response.text()
                             raise Exception(f'API Error: {retry_response.status} - {error_text}')
@@ -329,81 +304,374 @@ async def generate_image(params: Dict[str, Any]) -> tuple[bytes, int]:
             logger.error(f"生成图片失败: {str(e)}")
             raise e
 
+async def generate_image_stream(body: bytes, headers: Dict[str, str], seed: int,
+                                remove_metadata: bool, preview: PreviewThrottler,
+                                fast_metadata: bool = False) -> list[tuple[bytes, int]]:
+    """调用流式接口，逐条处理中间预览事件，返回所有最终图片"""
+    headers = dict(headers, Accept='text/event-stream')
+
+    async with aiohttp.ClientSession() as session:
+        try:
+            async with session.post(
+                f'{NAI_API_BASE}/ai/generate-image-stream',
+                data=body,
+                headers=headers,
+                timeout=aiohttp.ClientTimeout(total=runtime_config.current.api_timeout)
+            ) as response:
+                if response.status != 200:
+                    error_text = await response.text()
+                    raise Exception(f'API Error: {response.status} - {error_text}')
+
+                finals = {}
+                async for event, data in iter_sse_events(response):
+                    if event == 'intermediate':
+                        # 只记录base64字符串，由preview决定是否解码（只预览第一张）
+                        if data.get('samp_ix', 0) == 0:
+                            preview.offer(data.get('step_ix', 0), data['image'])
+                    elif event == 'final':
+                        finals[data.get('samp_ix', len(finals))] = base64.b64decode(data['image'])
+                    elif event == 'error':
+                        raise Exception(f"API Error: {data.get('message', data)}")
+
+                if not finals:
+                    raise Exception('No final image in stream')
+                logger.debug(f"流式生成完成，图片数: {len(finals)} | 收到预览: {preview.received}")
+                return await postprocess_images([finals[i] for i in sorted(finals)], seed, remove_metadata, fast_metadata)
+
+        except aiohttp.ClientError as e:
+            logger.error(f"网络错误: {str(e)}")
+            raise Exception(f'网络错误: {str(e)}')
+
+def enqueue_task(task: Job) -> tuple[bool, str]:
+    """
+    按预估耗时加入队列，返回 (是否已加入, 回复内容)
+
+    预估等待加上自身耗时超过交互令牌有效期时拒绝，否则结果将无法发送。
+    高负载时按降级策略修改任务参数，过载时直接拒绝。
+    """
+    config = runtime_config.current
+    level = update_load_level()
+    if level == SHED:
+        degradation.rejected_jobs += 1
+        backlog = task_queue.backlog(config.generation_concurrency)
+        logger.warning(f"[过载拒绝] 用户: {task.user_name} | 队列: {len(task_queue)} | 预估清空: {backlog:.0f}秒")
+        return False, f'❌ 当前负载过高，暂停接收新任务。队列中的任务预计约 {max(1, round(backlog / 60))} 分钟后处理完，请稍后再试。'
+    if level == DEGRADED:
+        changes = degrade_params(task.params, config)
+        if changes:
+            task.degraded = changes
+            degradation.degraded_jobs += 1
+
+    wait = task_queue.estimate_wait(task, config.generation_concurrency)
+    if wait + task.predicted > MAX_ESTIMATED_WAIT:
+        logger.warning(f"[队列拒绝] 用户: {task.user_name} | 预估等待: {wait:.0f}秒 | 预估耗时: {task.predicted:.0f}秒")
+        return False, f'❌ 当前队列繁忙，预计需要等待约 {wait / 60:.0f} 分钟，超过了Discord交互的15分钟有效期，请稍后再试或使用更小的尺寸/步数。'
+
+    queue_position = task_queue.append(task)
+    logger.info(f"[队列添加] 用户: {task.user_name} (ID: {task.user_id}) | 队列位置: {queue_position} | 预估等待: {wait:.0f}秒")
+
+    message = f'✅ 您的请求已加入队列，当前排在第 {queue_position} 位。'
+    if task.degraded:
+        message += f"\n⚡ 当前为高峰降级模式：{'，'.join(task.degraded)}"
+    if wait >= WARN_ESTIMATED_WAIT:
+        message += f'\n⚠️ 预计需要等待约 {wait / 60:.0f} 分钟，高峰期结果可能发送失败。'
+    elif wait >= 60:
+        message += f' 预计等待约 {wait / 60:.0f} 分钟。'
+    return True, message
+
+def update_load_level() -> int:
+    """按当前队列长度和预估清空时间更新负载级别"""
+    config = runtime_config.current
+    return degradation.update(config, len(task_queue), task_queue.backlog(config.generation_concurrency))
+
 async def process_queue():
-    """处理任务队列"""
-    global is_generating
+    """处理任务队列：生成阶段，拿到图片后交给上传阶段并立即释放生成槽位"""
+    global active_generations
+
+    ensure_delivery_workers()
 
     async with queue_lock:
-        if is_generating or not task_queue:
+        if active_generations >= runtime_config.current.generation_concurrency or not task_queue:
             return
 
-        is_generating = True
+        active_generations += 1
         task = task_queue.popleft()
 
-    interaction = task['interaction']
-    params = task['params']
-    user_id = interaction.user.id
-    user_name = str(interaction.user)
+    params = task.params
+    user_id = task.user_id
+    user_name = task.user_name
     start_time = datetime.now()
+    queue_wait = time.monotonic() - task.enqueued_at
+
+    if task.expired:
+        # 交互令牌已过期，结果无法发送，不再调用API
+        logger.warning(f"[任务过期] 用户: {user_name} (ID: {user_id}) | 等待: {queue_wait:.0f}秒 | 已跳过")
+        task_queue.finish(task)
+        async with queue_lock:
+            active_generations -= 1
+        if task_queue:
+            asyncio.create_task(process_queue())
+        return
 
-    logger.info(f"[生成开始] 用户: {user_name} (ID: {user_id}) | 模型: {params['model']} | 尺寸: {params['width']}x{params['height']} | 队列剩余: {len(task_queue)}")
+    logger.info(f"[生成开始] 用户: {user_name} (ID: {user_id}) | 模型: {params['model']} | 尺寸: {params['width']}x{params['height']} | 预估: {task.predicted:.1f}秒 | 等待: {queue_wait:.2f}秒 | 队列剩余: {len(task_queue)}")
+
+    # 按预估大小申请内存额度，额度不足时在此等待，对后续分发形成反压
+    # 额度一直持有到上传完成；拼图的解码也在这里一并申请，之后不再等待额度，
+    # 避免持有额度的任务互相等待
+    n_samples = params.get('n_samples', 1)
+    job_bytes = estimate_job_bytes(params['width'], params['height'], params.get('remove_metadata', False), n_samples)
+    if n_samples > 1 and runtime_config.current.contact_sheet:
+        job_bytes += estimate_sheet_bytes(params['width'], params['height'], n_samples)
+    reservation = memory_budget.reserve(job_bytes)
+    delivery = {
+        'job': task,
+        'reservation': reservation,
+        'start_time': start_time
+    }
 
+    preview = None
+    api_seconds = None
+    job_timeout = runtime_config.current.job_timeout
     try:
-        # 设置超时时间为90秒
-        async with asyncio.timeout(90):
+        await reservation.acquire()
+        if params.get('stream'):
+            preview = await start_preview(task, delivery)
+        # 超时时间见 runtime_config.job_timeout
+        async with asyncio.timeout(job_timeout):
             # 生成图片
             logger.info(f"[API调用] 用户: {user_name} | 正在调用NovelAI API...")
-            image_data, seed = await generate_image(params)
-
-            # 发送图片
-            file = discord.File(
-                fp=io.BytesIO(image_data),
-                filename=f'nai_{seed}.png'
-            )
-
-            embed = discord.Embed(
-                title='✅ 生成完成',
-                color=discord.Color.green()
-            )
-            embed.add_field(name='Seed', value=str(seed), inline=True)
-            embed.add_field(name='Model', value=MODELS.get(params['model'], params['model']), inline=True)
-            embed.add_field(name='Size', value=f"{params['width']}x{params['height']}", inline=True)
-            if params.get('remove_metadata'):
-                embed.add_field(name='元数据', value='已清除', inline=True)
+            api_start = time.monotonic()
+            images = await generate_image(params, preview)
+            api_seconds = time.monotonic() - api_start
+            # 预估额度一直保留到上传完成（清除元数据、拼图和上传缓冲区都在之后），
+            # 只在实际图片超出预估时增加
+            reservation.resize(max(reservation.nbytes, sum(len(image_data) for image_data, _ in images)))
 
-            await interaction.followup.send(embed=embed, file=file)
-
-            elapsed_time = (datetime.now() - start_time).total_seconds()
-            logger.info(f"[生成成功] 用户: {user_name} | Seed: {seed} | 耗时: {elapsed_time:.2f}秒 | 队列剩余: {len(task_queue)}")
+        delivery['images'] = images
 
     except asyncio.TimeoutError:
-        logger.error(f"[生成超时] 用户: {user_name} | 超过90秒未响应")
-        error_embed = discord.Embed(
+        logger.error(f"[生成超时] 用户: {user_name} | 超过{job_timeout:.0f}秒未响应")
+        delivery['error'] = discord.Embed(
             title='❌ 生成超时',
-            description='生成请求超过90秒未响应，请稍后重试',
+            description=f'生成请求超过{job_timeout:.0f}秒未响应，请稍后重试',
             color=discord.Color.red()
         )
-        await interaction.followup.send(embed=error_embed)
 
     except Exception as e:
         logger.error(f"[生成失败] 用户: {user_name} | 错误: {str(e)}")
-        error_embed = discord.Embed(
+        delivery['error'] = discord.Embed(
             title='❌ 生成失败',
             description=str(e),
             color=discord.Color.red()
         )
-        try:
-            await interaction.followup.send(embed=error_embed)
-        except:
-            logger.error(f"[发送失败] 无法向用户 {user_name} 发送错误消息")
 
     finally:
-        is_generating = False
+        if preview is not None:
+            await preview.close()
+        # 成功时用实际API耗时修正成本模型
+        task_queue.finish(task, api_seconds)
+        async with queue_lock:
+            active_generations -= 1
+        update_load_level()
         # 继续处理队列中的下一个任务
         if task_queue:
             logger.info(f"[队列处理] 继续处理队列，剩余任务: {len(task_queue)}")
             asyncio.create_task(process_queue())
 
+    # 上传队列已满时在此等待，对生成阶段形成反压（此时已不占用生成槽位）
+    await delivery_queue.put(delivery)
+
+def job_followup(job: Job) -> discord.Webhook:
+    """
+    按应用ID和交互令牌构建followup webhook
+
+    每次发送时重新构建，使用bot当前的HTTP会话（进程内重启后会话会重建）。
+    """
+    return discord.Webhook.partial(job.application_id, job.token, client=bot)
+
+async def start_preview(job: Job, delivery: Dict[str, Any]) -> PreviewThrottler:
+    """发送一条占位消息，之后按节奏用中间预览编辑它"""
+    message = await job_followup(job).send(content='🎨 生成中...', wait=True)
+    delivery['preview_message'] = message
+    steps = job.params.get('steps', 28)
+
+    async def push(image_bytes: bytes, step: int):
+        await message.edit(
+            content=f'🎨 生成中... 步骤 {step + 1}/{steps}',
+            attachments=[discord.File(fp=io.BytesIO(image_bytes), filename='preview.jpg')]
+        )
+
+    throttler = PreviewThrottler(push)
+    throttler.start()
+    return throttler
+
+async def deliver_result(delivery: Dict[str, Any]):
+    """上传阶段：发送结果或错误消息，网络错误和Discord 5xx时重试"""
+    job = delivery['job']
+    params = job.params
+    user_name = job.user_name
+
+    embed = delivery.get('error')
+    images = delivery.get('images') or []
+    seeds = ', '.join(str(seed) for _, seed in images)
+    if embed is None:
+        embed = discord.Embed(
+            title='✅ 生成完成',
+            color=discord.Color.green()
+        )
+        embed.add_field(name='Seed', value=seeds, inline=True)
+        embed.add_field(name='Model', value=MODELS.get(params['model'], params['model']), inline=True)
+        embed.add_field(name='Size', value=f"{params['width']}x{params['height']}", inline=True)
+        if params.get('remove_metadata'):
+            embed.add_field(name='元数据', value='已清除', inline=True)
+        if job.degraded:
+            embed.add_field(name='⚡ 高峰降级', value='，'.join(job.degraded), inline=False)
+
+    # 记录到生成历史，结果消息附带基于该记录的重新生成按钮
+    record_id = None
+    if images:
+        try:
+            record_id = await asyncio.to_thread(history_log.append, job.user_id, params, images[0][1])
+        except OSError as e:
+            logger.error(f"[历史记录] 写入失败: {e}")
+
+    # 多张结果只上传一张拼图，原图留在缓存中，点击按钮时再发送
+    uploads = [(image_data, f'nai_{seed}.png') for image_data, seed in images]
+    sheet = False
+    sheet_quality = runtime_config.current.sheet_quality
+    use_sheet = runtime_config.current.contact_sheet and len(images) > 1 and record_id is not None
+
+    # 与之前完全相同的结果（只有一个附件时）引用已上传的附件，不再重新上传
+    reuse_key = reused = None
+    if delivery_index.enabled and (use_sheet or len(images) == 1):
+        reuse_key = await asyncio.to_thread(
+            upload_key, [image_data for image_data, _ in images], sheet_quality if use_sheet else None, job.channel_id
+        )
+        reused = delivery_index.get(reuse_key)
+
+    if use_sheet:
+        try:
+            if reused is None:
+                sheet_data = await asyncio.to_thread(compose_contact_sheet, images, sheet_quality)
+                uploads = [(sheet_data, f'nai_sheet_{images[0][1]}.jpg')]
+            # 原图转交给缓存，由缓存计入内存预算，任务的额度相应减少
+            originals_bytes = sum(len(image_data) for image_data, _ in images)
+            delivery['reservation'].resize(max(0, delivery['reservation'].nbytes - originals_bytes))
+            originals_cache.put(record_id, images, originals_bytes)
+            sheet = True
+        except Exception as e:
+            reuse_key = None
+            logger.error(f"[拼图失败] 用户: {user_name} | 错误: {e}")
+
+    if reused is not None:
+        url, jump_url = reused
+        uploads = []
+        embed.set_image(url=url)
+        embed.add_field(name='📎 结果相同', value=f'与[之前的结果]({jump_url})完全相同，已直接引用', inline=False)
+        logger.info(f"[附件复用] 用户: {user_name} | Seed: {seeds} | 引用: {jump_url}")
+
+    view = None
+    if record_id is not None and (sheet or not params.get('image')):
+        view = build_history_buttons(record_id, reroll=not params.get('image'), originals=sheet)
+    extra = {} if view is None else {'view': view}
+
+    try:
+        if job.expired:
+            logger.warning(f"[发送跳过] 用户: {user_name} | 交互令牌已过期，无法发送结果")
+            return
+        followup = job_followup(job)
+        for attempt in range(1, DELIVERY_RETRIES + 1):
+            try:
+                # 每次尝试都要新建File，上传后其内部缓冲区会被关闭
+                files = [
+                    discord.File(fp=io.BytesIO(data), filename=filename)
+                    for data, filename in uploads
+                ]
+                # 429限流由discord.py按路由bucket自动等待
+                preview_message = delivery.get('preview_message')
+                message = None
+                if preview_message is not None:
+                    # 流式模式下把预览消息替换为最终结果
+                    message = await preview_message.edit(content=None, embed=embed, attachments=files, **extra)
+                elif files:
+                    message = await followup.send(embed=embed, files=files, wait=True, **extra)
+                else:
+                    await followup.send(embed=embed, **extra)
+                break
+            except (discord.DiscordServerError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt == DELIVERY_RETRIES:
+                    raise
+                logger.warning(f"[上传重试] 用户: {user_name} | 第{attempt}次失败: {e}")
+                await asyncio.sleep(2 ** attempt)
+
+        if reuse_key is not None and reused is None and message is not None and message.attachments:
+            attachment = message.attachments[0]
+            delivery_index.put(reuse_key, attachment.url, message.jump_url, attachment.size)
+
+        if images:
+            elapsed_time = (datetime.now() - delivery['start_time']).total_seconds()
+            logger.info(f"[生成成功] 用户: {user_name} | Seed: {seeds} | 图片数: {len(images)} | 耗时: {elapsed_time:.2f}秒 | 队列剩余: {len(task_queue)}")
+
+    except Exception as e:
+        logger.error(f"[发送失败] 无法向用户 {user_name} 发送消息: {e}")
+
+    finally:
+        delivery['reservation'].close()
+
+async def delivery_worker():
+    """上传工作协程，从上传队列中取出结果并发送；协程数超过配置时在完成当前上传后退出"""
+    worker = asyncio.current_task()
+    try:
+        while len(delivery_workers) <= runtime_config.current.delivery_concurrency:
+            idle_delivery_workers.add(worker)
+            try:
+                delivery = await delivery_queue.get()
+            finally:
+                idle_delivery_workers.discard(worker)
+            try:
+                await deliver_result(delivery)
+            except Exception as e:
+                logger.error(f"[上传异常] {e}")
+            finally:
+                delivery_queue.task_done()
+    finally:
+        delivery_workers.discard(worker)
+
+def ensure_delivery_workers():
+    """
+    使上传协程数与配置一致
+
+    增加时立即启动新协程；减少时先取消空闲的协程（取消等待中的get不会丢失结果），
+    其余正在上传的协程在完成当前上传后自行退出。
+    """
+    target = runtime_config.current.delivery_concurrency
+    before = len(delivery_workers)
+    while len(delivery_workers) < target:
+        delivery_workers.add(asyncio.create_task(delivery_worker()))
+    for worker in list(idle_delivery_workers)[:max(0, len(delivery_workers) - target)]:
+        delivery_workers.discard(worker)
+        idle_delivery_workers.discard(worker)
+        worker.cancel()
+    if len(delivery_workers) != before:
+        logger.info(f"[上传阶段] 上传协程: {before} -> {len(delivery_workers)} | 目标: {target}")
+
+def apply_runtime_config(old, new):
+    """配置变化时调整正在运行的组件，在同一次调度中完成，不丢弃已排队或进行中的任务"""
+    SIZE_LIMITS.update(maxPixels=new.max_pixels, maxWidth=new.max_width, maxHeight=new.max_height)
+    if old is None:
+        return
+    if (new.queue_policy, new.queue_aging) != (old.queue_policy, old.queue_aging):
+        task_queue.configure(new.queue_policy, new.queue_aging)
+    if new.delivery_concurrency != old.delivery_concurrency and delivery_workers:
+        ensure_delivery_workers()
+    # 并发上限提高时立即用新增的槽位处理排队任务；降低时进行中的任务照常完成
+    for _ in range(max(0, new.generation_concurrency - old.generation_concurrency)):
+        if task_queue:
+            asyncio.create_task(process_queue())
+
+apply_runtime_config(None, runtime_config.current)
+runtime_config.subscribe(apply_runtime_config)
+
 @bot.tree.command(name='nai', description='使用NovelAI生成图片')
 @app_commands.describe(
     prompt='正向提示词',
@@ -418,7 +686,14 @@ async def process_queue():
     seed='种子',
     smea='SMEA',
     dyn='SMEA DYN',
-    remove_metadata='清除元数据'
+    remove_metadata='清除元数据',
+    preset='使用预设',
+    stream='生成过程中显示实时预览',
+    n_samples='一次生成的图片数量',
+    image='图生图/局部重绘的输入图片',
+    mask='局部重绘蒙版（白色为重绘区域）',
+    strength='图生图强度 (0-1)',
+    noise='图生图噪声 (0-1)'
 )
 @app_commands.choices(
     model=[
@@ -426,21 +701,12 @@ async def process_queue():
         for value, name in MODELS.items()
     ],
     size=[
-        app_commands.Choice(name='📱 竖图 832×1216', value='portrait_m'),
-        app_commands.Choice(name='📱 竖图小 512×768', value='portrait_s'),
-        app_commands.Choice(name='🖼️ 横图 1216×832', value='landscape_m'),
-        app_commands.Choice(name='🖼️ 横图小 768×512', value='landscape_s'),
-        app_commands.Choice(name='⬜ 方图 512×512', value='square_s'),
-        app_commands.Choice(name='◻️ 方图 768×768', value='square_m'),
-        app_commands.Choice(name='◼ 方图 832×832', value='square_l')
+        app_commands.Choice(name=name, value=value)
+        for name, value in SIZE_OPTIONS
     ],
     sampler=[
-        app_commands.Choice(name='Euler Ancestral', value='k_euler_ancestral'),
-        app_commands.Choice(name='Euler', value='k_euler'),
-        app_commands.Choice(name='DPM++ 2M', value='k_dpmpp_2m'),
-        app_commands.Choice(name='DPM++ 2S Ancestral', value='k_dpmpp_2s_ancestral'),
-        app_commands.Choice(name='DPM++ SDE', value='k_dpmpp_sde'),
-        app_commands.Choice(name='DDIM V3', value='ddim_v3')
+        app_commands.Choice(name=name, value=value)
+        for name, value in SAMPLER_OPTIONS
     ]
 )
 async def nai_command(
@@ -457,8 +723,18 @@ async def nai_command(
     seed: Optional[int] = None,
     smea: Optional[bool] = None,
     dyn: Optional[bool] = None,
-    remove_metadata: Optional[bool] = False
+    remove_metadata: Optional[bool] = False,
+    preset: Optional[str] = None,
+    stream: Optional[bool] = None,
+    n_samples: Optional[app_commands.Range[int, 1, MAX_SAMPLES]] = 1,
+    image: Optional[discord.Attachment] = None,
+    mask: Optional[discord.Attachment] = None,
+    strength: Optional[app_commands.Range[float, 0.0, 1.0]] = 0.7,
+    noise: Optional[app_commands.Range[float, 0.0, 1.0]] = 0.0
 ):
+    if preset:
+        prompt, negative = apply_preset(str(interaction.user.id), preset, prompt, negative)
+
     # 确定尺寸
     if size and size in SIZE_PRESETS:
         final_width = SIZE_PRESETS[size]['width']
@@ -476,43 +752,92 @@ async def nai_command(
         final_width > SIZE_LIMITS['maxWidth'] or
         final_height > SIZE_LIMITS['maxHeight']):
         await interaction.response.send_message(
-            '❌ 尺寸超限！最大832×1216',
+            f"❌ 尺寸超限！最大 {SIZE_LIMITS['maxWidth']}×{SIZE_LIMITS['maxHeight']}，总像素不超过 {SIZE_LIMITS['maxPixels']:,}",
             ephemeral=True
         )
         return
 
-    # 准备任务
-    task = {
-        'interaction': interaction,
-        'params': {
-            'prompt': prompt,
-            'negative_prompt': negative,
-            'model': model,
-            'width': final_width,
-            'height': final_height,
-            'steps': steps or 28,
-            'cfg': cfg or 5,
-            'sampler': sampler or 'k_euler_ancestral',
-            'seed': seed or -1,
-            'smea': smea or False,
-            'dyn': dyn or False,
-            'remove_metadata': remove_metadata
-        }
-    }
+    # 验证提示词长度，超限的任务不进入队列
+    try:
+        token_warning = validate_prompt(model, prompt, negative)
+    except PromptTooLong as e:
+        await interaction.response.send_message(f'❌ {e}', ephemeral=True)
+        return
 
-    # 加入队列
-    task_queue.append(task)
-    queue_position = len(task_queue)
+    # 图生图/局部重绘：先只用附件元数据校验，再下载并准备输入
+    image_b64 = mask_b64 = None
+    deferred = False
+    if image is not None or mask is not None or model in INPAINTING_MODELS:
+        try:
+            if image is None:
+                raise InputImageError('局部重绘需要上传输入图片和蒙版')
+            if (mask is not None) != (model in INPAINTING_MODELS):
+                raise InputImageError('局部重绘需要选择 V3 Inpainting 模型并同时上传蒙版')
+            # 输出尺寸跟随输入图片
+            final_width, final_height = validate_attachment(image)
+            if mask is not None:
+                validate_attachment(mask)
+        except InputImageError as e:
+            await interaction.response.send_message(f'❌ {e}', ephemeral=True)
+            return
 
-    logger.info(f"[队列添加] 用户: {interaction.user} (ID: {interaction.user.id}) | 队列位置: {queue_position}")
+        # 下载和缩放可能超过3秒，先延迟响应
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        deferred = True
+        try:
+            image_b64 = await input_cache.prepare(image, final_width, final_height)
+            if mask is not None:
+                mask_b64 = await input_cache.prepare(mask, final_width, final_height, is_mask=True)
+        except Exception as e:
+            logger.error(f"[输入图片失败] 用户: {interaction.user} | 错误: {e}")
+            await interaction.followup.send(f'❌ 输入图片处理失败: {e}', ephemeral=True)
+            return
 
-    await interaction.response.send_message(
-        f'✅ 您的请求已加入队列，当前排在第 {queue_position} 位。',
-        ephemeral=True
+    # 准备任务
+    params = JobParams(
+        prompt=prompt,
+        negative_prompt=negative,
+        model=model,
+        width=final_width,
+        height=final_height,
+        steps=steps or 28,
+        cfg=cfg or 5,
+        sampler=sampler or 'k_euler_ancestral',
+        seed=seed or -1,
+        smea=smea or False,
+        dyn=dyn or False,
+        remove_metadata=remove_metadata,
+        stream=runtime_config.current.stream_preview if stream is None else stream,
+        n_samples=n_samples or 1
     )
+    if image_b64 is not None:
+        params.update({
+            'image': image_b64,
+            'mask': mask_b64,
+            'strength': strength if strength is not None else 0.7,
+            'noise': noise or 0.0
+        })
+    task = Job.from_interaction(interaction, params)
+
+    # 加入队列
+    queued, message = enqueue_task(task)
+    if queued and token_warning:
+        message += f'\n⚠️ {token_warning}'
+    if deferred:
+        await interaction.followup.send(message, ephemeral=True)
+    else:
+        await interaction.response.send_message(message, ephemeral=True)
 
     # 处理队列
-    asyncio.create_task(process_queue())
+    if queued:
+        asyncio.create_task(process_queue())
+
+@nai_command.autocomplete('preset')
+async def nai_preset_autocomplete(
+    interaction: discord.Interaction,
+    current: str
+) -> list[app_commands.Choice[str]]:
+    return await preset_autocomplete(interaction, current)
 
 @bot.tree.command(name='queue', description='查看当前队列状态')
 async def queue_command(interaction: discord.Interaction):
@@ -526,19 +851,28 @@ async def queue_command(interaction: discord.Interaction):
         color=discord.Color.blue()
     )
 
-    if is_generating:
-        embed.add_field(name='状态', value='🎨 正在生成中...', inline=False)
+    if degradation.level:
+        embed.add_field(name='负载', value=f'⚡ {LEVEL_NAMES[degradation.level]}模式', inline=False)
+
+    if active_generations:
+        embed.add_field(name='状态', value=f'🎨 正在生成中... ({active_generations}/{runtime_config.current.generation_concurrency}) | 待上传: {delivery_queue.qsize()}', inline=False)
     else:
         embed.add_field(name='状态', value='✅ 空闲中', inline=False)
 
+    budget = memory_budget.stats()
+    embed.add_field(
+        name='内存预算',
+        value=f"使用中: {format_bytes(budget['used'])} / {format_bytes(budget['limit'])} | 峰值: {format_bytes(budget['high_water'])}",
+        inline=False
+    )
+
     # 显示队列中的前5个任务
     queue_list = list(task_queue)[:5]
     for i, task in enumerate(queue_list, 1):
-        user_name = task['interaction'].user.name
-        model = MODELS.get(task['params']['model'], task['params']['model'])
+        model = MODELS.get(task.params.model, task.params.model)
         embed.add_field(
             name=f'位置 {i}',
-            value=f'用户: {user_name}\n模型: {model}',
+            value=f'用户: {task.user_name}\n模型: {model}\n预估: {task.predicted:.0f}秒',
             inline=True
         )
 
@@ -554,159 +888,22 @@ async def panel_command(interaction: discord.Interaction):
 
     # 获取或创建用户设置
     if user_id not in user_settings:
-        user_settings[user_id] = {
-            'model': 'nai-diffusion-3',
-            'size': 'portrait_s',
-            'sampler': 'k_euler_ancestral',
-            'preset': None,
-            'remove_metadata': False
-        }
+        user_settings[user_id] = PanelState().to_dict()
         save_user_settings(user_settings)
 
-    state = user_settings[user_id]
-    # 确保有自定义尺寸的默认值
-    if 'custom_width' not in state:
-        state['custom_width'] = 512
-    if 'custom_height' not in state:
-        state['custom_height'] = 768
-    panel_states[user_id] = state
+    state = PanelState.from_dict(user_settings[user_id])
+    panel_sessions.put(user_id, state)
 
     # 构建面板
-    embed = discord.Embed(
-        title='🎨 NovelAI 绘图面板',
-        description='使用下方的菜单和按钮来配置您的图片生成参数',
-        color=discord.Color.blue()
-    )
-
-    embed.add_field(name='模型', value=MODELS.get(state['model'], state['model']), inline=True)
-
-    # 显示尺寸信息
-    if state['size'] == 'custom':
-        size_display = f"自定义: {state.get('custom_width', 512)}×{state.get('custom_height', 768)}"
-    else:
-        size_preset = SIZE_PRESETS.get(state['size'], {'width': 512, 'height': 768})
-        size_display = f"{state['size']} ({size_preset['width']}×{size_preset['height']})"
-
-    embed.add_field(name='尺寸', value=size_display, inline=True)
-    embed.add_field(name='采样器', value=state['sampler'], inline=True)
-    embed.add_field(name='预设', value=state.get('preset', '未选择'), inline=True)
-    embed.add_field(name='清除元数据', value='✅ 开启' if state.get('remove_metadata', False) else '❌ 关闭', inline=True)
-
-    # 显示当前自定义尺寸
-    if state['size'] == 'custom':
-        pixels = state.get('custom_width', 512) * state.get('custom_height', 768)
-        embed.add_field(
-            name='📏 当前自定义尺寸',
-            value=f"宽度: {state.get('custom_width', 512)} | 高度: {state.get('custom_height', 768)} | 总像素: {pixels:,}",
-            inline=False
-        )
-
-    # 创建选择菜单 - 每个Select占整行
-    model_select = discord.ui.Select(
-        placeholder='选择模型',
-        options=[
-            discord.SelectOption(label=name, value=value, default=value==state['model'])
-            for value, name in MODELS.items()
-        ],
-        custom_id='model_select',
-        row=0
-    )
-
-    size_select = discord.ui.Select(
-        placeholder='选择尺寸',
-        options=[
-            discord.SelectOption(label='📱 竖图 832×1216', value='portrait_m', default='portrait_m'==state['size']),
-            discord.SelectOption(label='📱 竖图小 512×768', value='portrait_s', default='portrait_s'==state['size']),
-            discord.SelectOption(label='🖼️ 横图 1216×832', value='landscape_m', default='landscape_m'==state['size']),
-            discord.SelectOption(label='🖼️ 横图小 768×512', value='landscape_s', default='landscape_s'==state['size']),
-            discord.SelectOption(label='⬜ 方图 512×512', value='square_s', default='square_s'==state['size']),
-            discord.SelectOption(label='◻️ 方图 768×768', value='square_m', default='square_m'==state['size']),
-            discord.SelectOption(label='◼ 方图 832×832', value='square_l', default='square_l'==state['size']),
-            discord.SelectOption(label='🔧 自定义尺寸', value='custom', default='custom'==state['size'])
-        ],
-        custom_id='size_select',
-        row=1
-    )
-
-    sampler_select = discord.ui.Select(
-        placeholder='选择采样器',
-        options=[
-            discord.SelectOption(label='Euler Ancestral', value='k_euler_ancestral', default='k_euler_ancestral'==state['sampler']),
-            discord.SelectOption(label='Euler', value='k_euler', default='k_euler'==state['sampler']),
-            discord.SelectOption(label='DPM++ 2M', value='k_dpmpp_2m', default='k_dpmpp_2m'==state['sampler']),
-            discord.SelectOption(label='DPM++ 2S Ancestral', value='k_dpmpp_2s_ancestral', default='k_dpmpp_2s_ancestral'==state['sampler']),
-            discord.SelectOption(label='DPM++ SDE', value='k_dpmpp_sde', default='k_dpmpp_sde'==state['sampler']),
-            discord.SelectOption(label='DDIM V3', value='ddim_v3', default='ddim_v3'==state['sampler'])
-        ],
-        custom_id='sampler_select',
-        row=2
-    )
-
-    # 创建预设选择菜单
-    presets = load_presets()
-    user_presets = presets.get(user_id, {})
-
-    preset_options = [discord.SelectOption(label='不使用预设', value='none', default=state.get('preset') is None)]
-    preset_options.extend([
-        discord.SelectOption(label=name, value=name, default=name==state.get('preset'))
-        for name in user_presets.keys()
-    ])
-
-    preset_select = discord.ui.Select(
-        placeholder='选择预设',
-        options=preset_options,
-        custom_id='preset_select',
-        row=3
-    )
-
-    # 创建按钮 - 第4行：主要操作和尺寸调整
-    generate_button = discord.ui.Button(
-        label='🎨 生成图片',
-        style=discord.ButtonStyle.primary,
-        custom_id='generate_button',
-        row=4
-    )
-
-    metadata_button = discord.ui.Button(
-        label='🔄 元数据清除',
-        style=discord.ButtonStyle.secondary,
-        custom_id='metadata_button',
-        row=4
-    )
-
-    save_button = discord.ui.Button(
-        label='💾 保存设置',
-        style=discord.ButtonStyle.success,
-        custom_id='save_button',
-        row=4
-    )
-
-    custom_size_button = discord.ui.Button(
-        label='📐 自定义尺寸',
-        style=discord.ButtonStyle.secondary,
-        custom_id='custom_size_input',
-        row=4
-    )
-
-    # 创建视图
-    view = discord.ui.View(timeout=300)
-    # 添加Select菜单
-    view.add_item(model_select)    # row 0
-    view.add_item(size_select)     # row 1
-    view.add_item(sampler_select)  # row 2
-    view.add_item(preset_select)   # row 3
-    # 添加按钮 - 第4行
-    view.add_item(generate_button)
-    view.add_item(metadata_button)
-    view.add_item(save_button)
-    view.add_item(custom_size_button)
+    embed = build_panel_embed(state)
+    view = PanelView(state, preset_library.names(user_id))
 
     await interaction.response.send_message(embed=embed, view=view, ephemeral=True)
 
 # 创建预设命令组
 class PresetGroup(app_commands.Group):
     def __init__(self):
-        super().__init__(name='preset', description='管理你的个人提示词预设')
+        super().__init__(name='preset', description='管理你的提示词预设和服务器共享预设')
 
     @app_commands.command(name='save', description='保存一个新的预设')
     async def save_preset(
@@ -716,30 +913,26 @@ class PresetGroup(app_commands.Group):
         prompt: str,
         negative: Optional[str] = None
     ):
-        user_id = str(interaction.user.id)
-        presets = load_presets()
-
-        if user_id not in presets:
-            presets[user_id] = {}
-
-        presets[user_id][name] = {
-            'prompt': prompt,
-            'negative': negative or ''
-        }
+        try:
+            token_warning = validate_preset(prompt, negative)
+        except PromptTooLong as e:
+            await interaction.response.send_message(f'❌ {e}', ephemeral=True)
+            return
 
-        save_presets(presets)
-        await interaction.response.send_message(
-            f"✅ 预设 '{name}' 已保存！",
-            ephemeral=True
-        )
+        user_id = str(interaction.user.id)
+        preset_library.put(user_id, name, prompt, negative or '')
+        preset_index.add(user_id, name)
+        message = f"✅ 预设 '{name}' 已保存！"
+        if token_warning:
+            message += f'\n⚠️ {token_warning}'
+        await interaction.response.send_message(message, ephemeral=True)
 
     @app_commands.command(name='list', description='查看你所有的预设')
     async def list_presets(self, interaction: discord.Interaction):
         user_id = str(interaction.user.id)
-        presets = load_presets()
-        user_presets = presets.get(user_id, {})
+        names = preset_library.names(user_id)
 
-        if not user_presets:
+        if not names:
             await interaction.response.send_message(
                 '你还没有保存任何预设。',
                 ephemeral=True
@@ -751,10 +944,16 @@ class PresetGroup(app_commands.Group):
             color=discord.Color.blue()
         )
 
-        for name, data in user_presets.items():
-            value = f"**正面:** {data['prompt'][:100]}..."
-            if data.get('negative'):
-                value += f"\n**负面:** {data['negative'][:100]}..."
+        for name in names:
+            data = preset_library.get(user_id, name)
+            if data is None:
+                value = '⚠️ 订阅的共享预设已被取消发布'
+            else:
+                value = f"**正面:** {data[0][:100]}..."
+                if data[1]:
+                    value += f"\n**负面:** {data[1][:100]}..."
+            if preset_library.is_subscription(user_id, name):
+                name += '（订阅）'
             embed.add_field(name=name, value=value, inline=False)
 
         await interaction.response.send_message(embed=embed, ephemeral=True)
@@ -762,11 +961,9 @@ class PresetGroup(app_commands.Group):
     @app_commands.command(name='delete', description='删除一个预设')
     async def delete_preset(self, interaction: discord.Interaction, name: str):
         user_id = str(interaction.user.id)
-        presets = load_presets()
 
-        if user_id in presets and name in presets[user_id]:
-            del presets[user_id][name]
-            save_presets(presets)
+        if preset_library.delete(user_id, name):
+            preset_index.remove(user_id, name)
             await interaction.response.send_message(
                 f"🗑️ 预设 '{name}' 已删除。",
                 ephemeral=True
@@ -783,34 +980,225 @@ class PresetGroup(app_commands.Group):
         interaction: discord.Interaction,
         current: str
     ) -> list[app_commands.Choice[str]]:
+        return await preset_autocomplete(interaction, current)
+
+    @staticmethod
+    async def guild_id_or_reply(interaction: discord.Interaction) -> Optional[str]:
+        """共享库按服务器区分，私信中使用时回复错误并返回None"""
+        if interaction.guild_id is None:
+            await interaction.response.send_message('❌ 共享预设只能在服务器中使用。', ephemeral=True)
+            return None
+        return str(interaction.guild_id)
+
+    @app_commands.command(name='publish', description='把你的预设发布到本服务器的共享库')
+    @app_commands.describe(name='要发布的个人预设', shared_name='在共享库中的名称（默认与预设名称相同）')
+    async def publish_preset(self, interaction: discord.Interaction, name: str, shared_name: Optional[str] = None):
+        guild_id = await self.guild_id_or_reply(interaction)
+        if guild_id is None:
+            return
+        try:
+            shared_name = preset_library.publish(guild_id, str(interaction.user.id), name, shared_name)
+        except PresetError as e:
+            await interaction.response.send_message(f'❌ {e}', ephemeral=True)
+            return
+        logger.info(f"[预设发布] 用户: {interaction.user} | 服务器: {guild_id} | 预设: {name} -> {shared_name}")
+        await interaction.response.send_message(
+            f"✅ 已发布为 '{shared_name}'，其他成员可以用 /preset subscribe 订阅。再次发布会更新所有订阅者的预设。",
+            ephemeral=True
+        )
+
+    @publish_preset.autocomplete('name')
+    async def publish_preset_autocomplete(
+        self,
+        interaction: discord.Interaction,
+        current: str
+    ) -> list[app_commands.Choice[str]]:
+        return await preset_autocomplete(interaction, current)
+
+    @app_commands.command(name='unpublish', description='从本服务器的共享库中移除预设（发布者或服务器管理者）')
+    async def unpublish_preset(self, interaction: discord.Interaction, shared_name: str):
+        guild_id = await self.guild_id_or_reply(interaction)
+        if guild_id is None:
+            return
+        try:
+            preset_library.unpublish(guild_id, shared_name, str(interaction.user.id),
+                                     moderator=interaction.permissions.manage_guild)
+        except PresetError as e:
+            await interaction.response.send_message(f'❌ {e}', ephemeral=True)
+            return
+        logger.info(f"[预设取消发布] 用户: {interaction.user} | 服务器: {guild_id} | 预设: {shared_name}")
+        await interaction.response.send_message(f"🗑️ 已从共享库移除 '{shared_name}'。", ephemeral=True)
+
+    @app_commands.command(name='subscribe', description='订阅本服务器共享库中的预设')
+    @app_commands.describe(shared_name='共享库中的预设', name='保存为自己的预设名称（默认与共享名称相同）')
+    async def subscribe_preset(self, interaction: discord.Interaction, shared_name: str, name: Optional[str] = None):
+        guild_id = await self.guild_id_or_reply(interaction)
+        if guild_id is None:
+            return
         user_id = str(interaction.user.id)
-        presets = load_presets()
-        user_presets = presets.get(user_id, {})
+        try:
+            name = preset_library.subscribe(user_id, guild_id, shared_name, name)
+        except PresetError as e:
+            await interaction.response.send_message(f'❌ {e}', ephemeral=True)
+            return
+        preset_index.add(user_id, name)
+        await interaction.response.send_message(
+            f"✅ 已订阅 '{shared_name}'，可以在 /nai 和面板中以预设 '{name}' 使用。",
+            ephemeral=True
+        )
 
-        return [
-            app_commands.Choice(name=name, value=name)
-            for name in user_presets.keys()
-            if current.lower() in name.lower()
-        ][:25]
+    @unpublish_preset.autocomplete('shared_name')
+    @subscribe_preset.autocomplete('shared_name')
+    async def shared_preset_autocomplete(
+        self,
+        interaction: discord.Interaction,
+        current: str
+    ) -> list[app_commands.Choice[str]]:
+        if interaction.guild_id is None:
+            return []
+        current = current.lower()
+        names = sorted(name for name in preset_library.shared(str(interaction.guild_id)) if current in name.lower())
+        return [app_commands.Choice(name=name, value=name) for name in names[:25]]
+
+    @app_commands.command(name='shared', description='查看本服务器共享库中的预设')
+    async def shared_presets(self, interaction: discord.Interaction):
+        guild_id = await self.guild_id_or_reply(interaction)
+        if guild_id is None:
+            return
+        library = preset_library.shared(guild_id)
+        if not library:
+            await interaction.response.send_message('本服务器的共享库还没有预设，可以用 /preset publish 发布。', ephemeral=True)
+            return
+
+        embed = discord.Embed(
+            title='共享预设',
+            description=f'共 {len(library)} 个，用 /preset subscribe 订阅',
+            color=discord.Color.blue()
+        )
+        # 嵌入最多25个字段
+        for shared_name in sorted(library)[:25]:
+            prompt, negative = preset_library.expand_shared(guild_id, shared_name)
+            value = f"发布者: <@{library[shared_name]['author']}>\n**正面:** {prompt[:100]}..."
+            if negative:
+                value += f"\n**负面:** {negative[:100]}..."
+            embed.add_field(name=shared_name, value=value, inline=False)
 
+        await interaction.response.send_message(embed=embed, ephemeral=True)
 
 
-@bot.event
-async def on_interaction(interaction: discord.Interaction):
-    if interaction.type != discord.InteractionType.component:
-        return
+class AdminGroup(app_commands.Group):
+    """仅限Bot所有者使用的管理命令"""
+
+    def __init__(self):
+        super().__init__(name='admin', description='Bot管理命令（仅所有者）')
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        if await bot.is_owner(interaction.user):
+            return True
+        await interaction.response.send_message("❌ 只有Bot所有者可以使用此命令。", ephemeral=True)
+        return False
+
+    @app_commands.command(name='profile', description='对运行中的进程进行性能采样')
+    @app_commands.describe(
+        seconds='采样时长（秒）',
+        mode='cpu: 调用栈采样（折叠栈格式）；memory: tracemalloc内存分配差异'
+    )
+    @app_commands.choices(mode=[
+        app_commands.Choice(name='CPU调用栈', value='cpu'),
+        app_commands.Choice(name='内存分配', value='memory')
+    ])
+    async def profile(
+        self,
+        interaction: discord.Interaction,
+        seconds: app_commands.Range[int, 1, MAX_PROFILE_SECONDS] = 10,
+        mode: str = 'cpu'
+    ):
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        logger.info(f"[性能采样] 用户: {interaction.user} | 模式: {mode} | 时长: {seconds}s")
+        try:
+            report = await (profile_cpu(seconds) if mode == 'cpu' else profile_memory(seconds))
+        except ProfilerBusy:
+            await interaction.followup.send("⏳ 已有采样正在进行，请稍后再试。", ephemeral=True)
+            return
+        filename = f"profile-{mode}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.{'folded' if mode == 'cpu' else 'txt'}"
+        await interaction.followup.send(
+            f"✅ 采样完成（{seconds}秒）",
+            file=discord.File(io.BytesIO(report.encode('utf-8')), filename=filename),
+            ephemeral=True
+        )
+
+    @app_commands.command(name='config', description='查看或修改运行配置（立即生效）')
+    @app_commands.describe(
+        key='配置项，不填时列出所有配置',
+        value='新的值，填 default 恢复默认值'
+    )
+    @app_commands.choices(key=[app_commands.Choice(name=f.name, value=f.name) for f in config_fields()])
+    async def config(self, interaction: discord.Interaction, key: Optional[str] = None, value: Optional[str] = None):
+        current = runtime_config.current
+        if key is None or value is None:
+            fields = [f for f in config_fields() if key is None or f.name == key]
+            lines = []
+            for f in fields:
+                marker = '✏️' if f.name in runtime_config.overrides else '▫️'
+                lines.append(f"{marker} `{f.name}` = **{getattr(current, f.name)}**"
+                             f"（默认 {getattr(runtime_config.defaults, f.name)}）{f.metadata['description']}")
+            await interaction.response.send_message(
+                '\n'.join(lines) + '\n\n✏️ 表示已修改，配置保存在 runtime_config.json',
+                ephemeral=True
+            )
+            return
+
+        try:
+            new = await runtime_config.update({key: None if value.strip().lower() == 'default' else value})
+        except ConfigError as e:
+            await interaction.response.send_message(f"❌ {e}", ephemeral=True)
+            return
+        except OSError as e:
+            logger.error(f"[运行配置] 写入 {runtime_config.path} 失败: {e}")
+            await interaction.response.send_message(f"❌ 无法保存配置文件，配置未修改: {e}", ephemeral=True)
+            return
+        logger.info(f"[运行配置] 用户: {interaction.user} | {key}: {getattr(current, key)} -> {getattr(new, key)}")
+        await interaction.response.send_message(
+            f"✅ `{key}`: {getattr(current, key)} -> **{getattr(new, key)}**",
+            ephemeral=True
+        )
+
 
+class PanelView(discord.ui.View):
+    """
+    持久化面板视图
+
+    不设超时并在启动时通过bot.add_view注册，所有组件的点击都交给
+    handle_panel_interaction处理，用户状态在首次点击时惰性恢复。
+    """
+
+    def __init__(self, state: Optional[PanelState] = None, preset_names=()):
+        super().__init__(timeout=None)
+        add_panel_items(self, state or PanelState(), preset_names)
+        for item in self.children:
+            item.callback = handle_panel_interaction
+
+async def get_panel_state(user_id: str) -> PanelState:
+    """获取面板状态，会话过期或重启后从已保存的设置中恢复（文件读取放到线程中）"""
+    state = panel_sessions.get(user_id)
+    if state is None:
+        user_settings = await asyncio.to_thread(load_user_settings)
+        # 读取期间同一用户的另一次点击可能已经恢复了状态
+        state = panel_sessions.get(user_id, count=False)
+        if state is None:
+            state = PanelState.from_dict(user_settings.get(user_id, {}))
+            panel_sessions.put(user_id, state)
+            logger.info(f"[面板恢复] 用户ID: {user_id} | 已从保存的设置恢复面板状态")
+    return state
+
+async def handle_panel_interaction(interaction: discord.Interaction):
     custom_id = interaction.data.get('custom_id', '')
     user_id = str(interaction.user.id)
     user_name = str(interaction.user)
 
     logger.debug(f"[面板交互] 用户: {user_name} | 组件: {custom_id}")
 
-    if user_id not in panel_states:
-        await interaction.response.send_message('会话已过期，请重新打开面板', ephemeral=True)
-        return
-
-    state = panel_states[user_id]
+    state = await get_panel_state(user_id)
 
     # 处理选择菜单
     if custom_id.endswith('_select'):
@@ -818,27 +1206,27 @@ async def on_interaction(interaction: discord.Interaction):
         value = interaction.data['values'][0]
 
         if field == 'model':
-            state['model'] = value
+            state.model = value
         elif field == 'size':
-            state['size'] = value
+            state.size = value
             # 如果选择了预设尺寸，更新自定义尺寸值
             if value != 'custom' and value in SIZE_PRESETS:
-                state['custom_width'] = SIZE_PRESETS[value]['width']
-                state['custom_height'] = SIZE_PRESETS[value]['height']
+                state.custom_width = SIZE_PRESETS[value]['width']
+                state.custom_height = SIZE_PRESETS[value]['height']
         elif field == 'sampler':
-            state['sampler'] = value
+            state.sampler = value
         elif field == 'preset':
             if value == 'none':
-                state['preset'] = None
+                state.preset = None
             else:
-                state['preset'] = value
+                state.preset = value
 
         # 更新面板
         await update_panel(interaction, state)
 
     # 处理按钮
     elif custom_id == 'metadata_button':
-        state['remove_metadata'] = not state.get('remove_metadata', False)
+        state.remove_metadata = not state.remove_metadata
         await update_panel(interaction, state)
 
     # 处理自定义尺寸输入按钮
@@ -849,7 +1237,7 @@ async def on_interaction(interaction: discord.Interaction):
         width_input = discord.ui.TextInput(
             label='宽度',
             placeholder=f'输入宽度 (320-{SIZE_LIMITS["maxWidth"]})',
-            default=str(state.get('custom_width', 512)),
+            default=str(state.custom_width),
             required=True,
             max_length=4
         )
@@ -857,7 +1245,7 @@ async def on_interaction(interaction: discord.Interaction):
         height_input = discord.ui.TextInput(
             label='高度',
             placeholder=f'输入高度 (320-{SIZE_LIMITS["maxHeight"]})',
-            default=str(state.get('custom_height', 768)),
+            default=str(state.custom_height),
             required=True,
             max_length=4
         )
@@ -896,9 +1284,9 @@ async def on_interaction(interaction: discord.Interaction):
                 new_width = (new_width // 64) * 64
                 new_height = (new_height // 64) * 64
 
-                state['size'] = 'custom'
-                state['custom_width'] = new_width
-                state['custom_height'] = new_height
+                state.size = 'custom'
+                state.custom_width = new_width
+                state.custom_height = new_height
 
                 await update_panel(modal_interaction, state)
 
@@ -913,7 +1301,7 @@ async def on_interaction(interaction: discord.Interaction):
 
     elif custom_id == 'save_button':
         user_settings = load_user_settings()
-        user_settings[user_id] = state
+        user_settings[user_id] = state.to_dict()
         save_user_settings(user_settings)
         logger.info(f"[设置保存] 用户: {user_name} 保存了面板设置")
         await interaction.response.send_message('✅ 设置已保存！', ephemeral=True)
@@ -936,105 +1324,216 @@ async def on_interaction(interaction: discord.Interaction):
             style=discord.TextStyle.paragraph
         )
 
+        samples_input = discord.ui.TextInput(
+            label='数量',
+            placeholder=f'一次生成的图片数量 (1-{MAX_SAMPLES})',
+            default=str(state.n_samples),
+            required=False,
+            max_length=1
+        )
+
         modal.add_item(prompt_input)
         modal.add_item(negative_input)
+        modal.add_item(samples_input)
 
         async def modal_submit(modal_interaction: discord.Interaction):
             prompt = prompt_input.value
             negative = negative_input.value
 
+            try:
+                n_samples = int(samples_input.value or 1)
+            except ValueError:
+                n_samples = 0
+            if not 1 <= n_samples <= MAX_SAMPLES:
+                await modal_interaction.response.send_message(
+                    f'❌ 数量必须在 1 到 {MAX_SAMPLES} 之间',
+                    ephemeral=True
+                )
+                return
+            state.n_samples = n_samples
+
             # 如果选择了预设，合并提示词
-            if state.get('preset'):
-                presets = load_presets()
-                user_presets = presets.get(user_id, {})
-                if state['preset'] in user_presets:
-                    preset_data = user_presets[state['preset']]
-                    prompt = f"{preset_data['prompt']}, {prompt}"
-                    if preset_data.get('negative'):
-                        negative = f"{preset_data['negative']}, {negative}" if negative else preset_data['negative']
+            prompt, negative = apply_preset(user_id, state.preset, prompt, negative)
+            try:
+                token_warning = validate_prompt(state.model, prompt, negative)
+            except PromptTooLong as e:
+                await modal_interaction.response.send_message(f'❌ {e}', ephemeral=True)
+                return
 
             # 获取尺寸
-            if state['size'] == 'custom':
-                width = state.get('custom_width', 512)
-                height = state.get('custom_height', 768)
+            if state.size == 'custom':
+                width = state.custom_width
+                height = state.custom_height
             else:
-                size_data = SIZE_PRESETS.get(state['size'], SIZE_PRESETS['portrait_s'])
+                size_data = SIZE_PRESETS.get(state.size, SIZE_PRESETS['portrait_s'])
                 width = size_data['width']
                 height = size_data['height']
 
             # 准备任务
-            task = {
-                'interaction': modal_interaction,
-                'params': {
-                    'prompt': prompt,
-                    'negative_prompt': negative,
-                    'model': state['model'],
-                    'width': width,
-                    'height': height,
-                    'sampler': state['sampler'],
-                    'steps': 28,
-                    'cfg': 5,
-                    'seed': -1,
-                    'smea': False,
-                    'dyn': False,
-                    'remove_metadata': state.get('remove_metadata', False)
-                }
-            }
-
-            task_queue.append(task)
-            queue_position = len(task_queue)
-
-            logger.info(f"[队列添加-面板] 用户: {modal_interaction.user} (ID: {modal_interaction.user.id}) | 队列位置: {queue_position}")
-
-            await modal_interaction.response.send_message(
-                f'✅ 您的请求已加入队列，当前排在第 {queue_position} 位。',
-                ephemeral=True
-            )
-
-            asyncio.create_task(process_queue())
+            task = Job.from_interaction(modal_interaction, JobParams(
+                prompt=prompt,
+                negative_prompt=negative,
+                model=state.model,
+                width=width,
+                height=height,
+                sampler=state.sampler,
+                remove_metadata=state.remove_metadata,
+                n_samples=n_samples
+            ))
+
+            queued, message = enqueue_task(task)
+            if queued and token_warning:
+                message += f'\n⚠️ {token_warning}'
+            await modal_interaction.response.send_message(message, ephemeral=True)
+
+            if queued:
+                asyncio.create_task(process_queue())
 
         modal.on_submit = modal_submit
         await interaction.response.send_modal(modal)
 
-async def update_panel(interaction: discord.Interaction, state: Dict):
+async def update_panel(interaction: discord.Interaction, state: PanelState):
     """更新面板显示"""
-    embed = discord.Embed(
-        title='🎨 NovelAI 绘图面板',
-        description='使用下方的菜单和按钮来配置您的图片生成参数',
-        color=discord.Color.blue()
-    )
-
-    embed.add_field(name='模型', value=MODELS.get(state['model'], state['model']), inline=True)
+    await interaction.response.edit_message(embed=build_panel_embed(state))
+
+def build_history_buttons(record_id: int, reroll: bool = True, originals: bool = False) -> discord.ui.View:
+    """
+    结果消息上的重新生成按钮（以及拼图结果的原图按钮）
+
+    custom_id中带有历史记录号，点击由on_interaction按前缀分发；视图在发送前即结束，
+    不会注册到ViewStore，因此不受超时和重启影响。
+    """
+    view = discord.ui.View(timeout=None)
+    if reroll:
+        view.add_item(discord.ui.Button(label='重新生成', emoji='🔁', style=discord.ButtonStyle.primary,
+                                        custom_id=f'hist:reroll:{record_id}'))
+        view.add_item(discord.ui.Button(label='Seed -1', style=discord.ButtonStyle.secondary,
+                                        custom_id=f'hist:seed-:{record_id}'))
+        view.add_item(discord.ui.Button(label='Seed +1', style=discord.ButtonStyle.secondary,
+                                        custom_id=f'hist:seed+:{record_id}'))
+        view.add_item(discord.ui.Button(label='放大尺寸', emoji='🔍', style=discord.ButtonStyle.secondary,
+                                        custom_id=f'hist:upscale:{record_id}'))
+    if originals:
+        view.add_item(discord.ui.Button(label='原图', emoji='🖼️', style=discord.ButtonStyle.secondary,
+                                        custom_id=f'hist:originals:{record_id}'))
+    view.stop()
+    return view
+
+async def build_history_page(user_id: int, before: Optional[int] = None) -> tuple[discord.Embed, Optional[discord.ui.View]]:
+    """生成历史的一页，只读取本页的记录（文件读取放到线程中）"""
+    records = await asyncio.to_thread(history_log.page, user_id, before=before, limit=HISTORY_PAGE_SIZE)
+    embed = discord.Embed(title='🕘 生成历史', color=discord.Color.blue())
+    if not records:
+        embed.description = '暂无更多记录' if before is not None else '还没有生成记录'
+        return embed, None
+
+    for record in records:
+        prompt = record.prompt if len(record.prompt) <= 100 else record.prompt[:100] + '...'
+        tag = ' | 图生图' if record.is_img2img else ''
+        embed.add_field(
+            name=f"#{record.record_id} | <t:{int(record.created)}:R>",
+            value=f"{MODELS.get(record.model, record.model)} | {record.width}x{record.height} | Seed: {record.seed}{tag}\n{prompt}",
+            inline=False
+        )
 
-    # 显示尺寸信息
-    if state['size'] == 'custom':
-        size_display = f"自定义: {state.get('custom_width', 512)}×{state.get('custom_height', 768)}"
+    view = discord.ui.View(timeout=None)
+    if not records[0].is_img2img:
+        view.add_item(discord.ui.Button(label=f'重新生成 #{records[0].record_id}', emoji='🔁',
+                                        custom_id=f'hist:reroll:{records[0].record_id}'))
+    if await asyncio.to_thread(history_log.has_more, user_id, records[-1].record_id):
+        view.add_item(discord.ui.Button(label='更早', emoji='⬇️', custom_id=f'hist:page:{records[-1].record_id}'))
+    view.stop()
+    return embed, view
+
+def history_task_params(record: HistoryRecord, action: str) -> Optional[JobParams]:
+    """根据历史记录和按钮动作生成新任务的参数，无法执行时返回None"""
+    params = JobParams.from_dict(record.to_params())
+    if action == 'reroll':
+        params['seed'] = -1
+    elif action == 'seed+':
+        params['seed'] = (record.seed + 1) % 4294967296
+    elif action == 'seed-':
+        params['seed'] = (record.seed - 1) % 4294967296
+    elif action == 'upscale':
+        width, height = fit_size(record.width, record.height, allow_upscale=True)
+        if width * height <= record.width * record.height:
+            return None
+        params['width'], params['height'] = width, height
     else:
-        size_preset = SIZE_PRESETS.get(state['size'], {'width': 512, 'height': 768})
-        size_display = f"{state['size']} ({size_preset['width']}×{size_preset['height']})"
+        return None
+    params['stream'] = runtime_config.current.stream_preview
+    return params
+
+@bot.listen('on_interaction')
+async def on_history_interaction(interaction: discord.Interaction):
+    """处理 hist: 前缀的按钮：翻页和基于历史记录重新生成"""
+    if interaction.type != discord.InteractionType.component:
+        return
+    custom_id = (interaction.data or {}).get('custom_id', '')
+    if not custom_id.startswith('hist:'):
+        return
+    try:
+        _, action, record_id = custom_id.split(':')
+        record_id = int(record_id)
+    except ValueError:
+        return
 
-    embed.add_field(name='尺寸', value=size_display, inline=True)
-    embed.add_field(name='采样器', value=state['sampler'], inline=True)
-    embed.add_field(name='预设', value=state.get('preset', '未选择'), inline=True)
-    embed.add_field(name='清除元数据', value='✅ 开启' if state.get('remove_metadata', False) else '❌ 关闭', inline=True)
+    if action == 'page':
+        embed, view = await build_history_page(interaction.user.id, before=record_id)
+        await interaction.response.edit_message(embed=embed, view=view)
+        return
 
-    # 显示当前自定义尺寸
-    if state['size'] == 'custom':
-        pixels = state.get('custom_width', 512) * state.get('custom_height', 768)
-        embed.add_field(
-            name='📏 当前自定义尺寸',
-            value=f"宽度: {state.get('custom_width', 512)} | 高度: {state.get('custom_height', 768)} | 总像素: {pixels:,}",
-            inline=False
-        )
+    if action == 'originals':
+        await send_originals(interaction, record_id)
+        return
 
-    await interaction.response.edit_message(embed=embed)
+    record = await asyncio.to_thread(history_log.get, record_id)
+    if record is None:
+        await interaction.response.send_message('❌ 找不到这条生成记录。', ephemeral=True)
+        return
+    if record.user_id != interaction.user.id:
+        await interaction.response.send_message('❌ 只能基于自己的生成记录重新生成。', ephemeral=True)
+        return
+    params = history_task_params(record, action)
+    if params is None:
+        await interaction.response.send_message('❌ 已经是允许的最大尺寸。', ephemeral=True)
+        return
+
+    logger.info(f"[历史操作] 用户: {interaction.user} | 动作: {action} | 记录: #{record_id}")
+    task = Job.from_interaction(interaction, params)
+    queued, message = enqueue_task(task)
+    await interaction.response.send_message(message, ephemeral=True)
+    if queued:
+        asyncio.create_task(process_queue())
+
+async def send_originals(interaction: discord.Interaction, record_id: int):
+    """发送拼图结果对应的原图（仅点击者可见）"""
+    images = originals_cache.get(record_id)
+    if images is None:
+        await interaction.response.send_message('❌ 原图已过期，可以使用 🔁 重新生成。', ephemeral=True)
+        return
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    files = [discord.File(fp=io.BytesIO(image_data), filename=f'nai_{seed}.png') for image_data, seed in images]
+    await interaction.followup.send(files=files, ephemeral=True)
+    logger.info(f"[原图发送] 用户: {interaction.user} | 记录: #{record_id} | 图片数: {len(files)}")
+
+@bot.tree.command(name='history', description='查看你的生成历史')
+async def history_command(interaction: discord.Interaction):
+    embed, view = await build_history_page(interaction.user.id)
+    await interaction.response.send_message(embed=embed, ephemeral=True, **({} if view is None else {'view': view}))
 
 @bot.event
 async def on_ready():
     logger.info(f'[Bot启动] 登录为: {bot.user} (ID: {bot.user.id})')
-    logger.info(f'[Bot启动] 连接到 {len(bot.guilds)} 个服务器')
-    for guild in bot.guilds:
-        logger.info(f'  - {guild.name} (ID: {guild.id}) | 成员数: {guild.member_count}')
+    guilds = bot.guilds
+    if guilds:
+        total_members = sum(guild.member_count or 0 for guild in guilds)
+        largest = max(guilds, key=lambda guild: guild.member_count or 0)
+        logger.info(f'[Bot启动] 连接到 {len(guilds)} 个服务器 | 总成员数: {total_members} | 最大: {largest.name} ({largest.member_count})')
+    else:
+        logger.info('[Bot启动] 尚未加入任何服务器')
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('[Bot启动] 服务器列表: ' + ', '.join(f'{guild.name}({guild.id})' for guild in guilds))
     logger.info('[Bot启动] Bot准备就绪!')
 
     # 设置状态
@@ -1053,46 +1552,65 @@ async def on_error(event, *args, **kwargs):
 async def queue_cleanup_task():
     """定期清理过期队列任务"""
     while True:
-        await asyncio.sleep(300)  # 每5分钟检查一次
-        if len(task_queue) > 10:
-            logger.warning(f"[队列警告] 队列过长，当前有 {len(task_queue)} 个任务")
-        if not is_generating and task_queue:
+        await asyncio.sleep(runtime_config.current.cleanup_interval)
+        update_load_level()
+        load = degradation.stats()
+        reuse = delivery_index.stats()
+        logger.info(f"[附件复用] 索引: {reuse['size']} | 命中: {reuse['hits']} | 未命中: {reuse['misses']} | 节省上传: {format_bytes(reuse['saved_bytes'])}")
+        logger.info(f"[负载级别] 当前: {load['level']} ({load['seconds']:.0f}秒) | 切换次数: {load['transitions']} | 降级任务: {load['degraded_jobs']} | 拒绝任务: {load['rejected_jobs']}")
+        budget = memory_budget.stats()
+        logger.info(f"[内存预算] 使用中: {format_bytes(budget['used'])} | 峰值: {format_bytes(budget['high_water'])} | 上限: {format_bytes(budget['limit'])} | 等待中: {budget['waiting']}")
+        if LOOP_MONITOR:
+            lag = loop_monitor.stats()
+            logger.info(f"[事件循环] 平均延迟: {lag['mean_ms']:.1f}ms | 最大: {lag['max_ms']:.0f}ms | 阻塞次数: {lag['stalls']} | 分布: {loop_monitor.histogram()}")
+        logger.info(f"[成本模型] 观测次数: {cost_model.observations} | " + ', '.join(f'{model}: {intercept:.1f}s + {slope:.3f}s/单位' for model, (intercept, slope) in cost_model.stats().items()))
+        panel_sessions.evict_expired()
+        sessions = panel_sessions.stats()
+        logger.info(f"[面板会话] 活跃: {sessions['size']} | 命中: {sessions['hits']} | 未命中: {sessions['misses']} | 淘汰: {sessions['evictions']}")
+        if active_generations < runtime_config.current.generation_concurrency and task_queue:
             logger.info(f"[队列检查] 检测到队列未处理，尝试重启队列处理")
             asyncio.create_task(process_queue())
 
+async def start_services():
+    """进程级服务，不随Discord连接重启"""
+    # 记录较多时重建索引需要一些时间，放到线程中完成
+    await asyncio.to_thread(history_log.open)
+    await asyncio.to_thread(load_tokenizers)
+    # 预设库的加载、旧文件迁移和日志压缩同样可能较慢
+    await asyncio.to_thread(preset_library.ensure_loaded)
+    runtime_config.start()
+    if LOOP_MONITOR:
+        loop_monitor.start()
+    if http_server is not None:
+        await http_server.start()
+
+async def stop_services():
+    runtime_config.stop()
+    loop_monitor.stop()
+    if http_server is not None:
+        await http_server.stop()
+    await input_cache.close()
+    history_log.close()
+
 async def main_async():
-    """异步主函数"""
-    async with bot:
-        # 启动队列清理任务
-        asyncio.create_task(queue_cleanup_task())
-        await bot.start(DISCORD_TOKEN)
+    """异步主函数：启动进程级服务后由监督器运行bot，崩溃时在进程内重启"""
+    supervisor = Supervisor(bot, DISCORD_TOKEN, http_server, missing=MISSING_CONFIG)
+    await start_services()
+    try:
+        await supervisor.run()
+    finally:
+        await stop_services()
 
-if __name__ == '__main__':
+def run():
+    """启动入口，start.py 和直接运行 main.py 共用"""
     logger.info("正在启动Bot...")
     logger.info(f"Token长度: {len(DISCORD_TOKEN) if DISCORD_TOKEN else 0}")
-
+    # 在创建事件循环之前选择实现（USE_UVLOOP）
+    logger.info(f"[事件循环] 使用: {install_event_loop_policy()}")
     try:
-        import asyncio
-        # Windows 环境特殊处理
-        if sys.platform == 'win32':
-            asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
-
-        # 添加优雅关闭处理
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-
-        # 直接运行 bot，启用重连
-        bot.run(DISCORD_TOKEN, reconnect=True, log_handler=None)
+        asyncio.run(main_async())
     except KeyboardInterrupt:
         logger.info("用户停止了Bot")
-    except Exception as e:
-        logger.error(f"启动Bot失败: {e}")
-        import traceback
-        traceback.print_exc()
-        # 在 Zeabur 环境中保持进程运行以查看错误
-        if os.getenv('ZEABUR'):
-            import time
-            while True:
-                time.sleep(60)
-                print(f"Waiting after error: {e}", flush=True)
-        sys.exit(1)
\ No newline at end of file
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import ctypes
+import logging
+import os
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Pillow在内存中按每像素4字节保存RGB图像
+DECODED_PIXEL_BYTES = 4
+# 不小于该大小的内存块直接用mmap分配，释放后立即归还系统（仅glibc，0表示保持默认行为）
+MMAP_THRESHOLD_BYTES = int(os.getenv('MMAP_THRESHOLD_KB', '128')) * 1024
+# glibc mallopt 的参数编号
+_M_MMAP_THRESHOLD = -3
+
+
+class ByteBudget:
+    """
+    按字节计数的信号量，限制同时驻留在内存中的图片缓冲区总量
+
+    每个任务在进入 生成 → 后处理 → 上传 流程前按预估大小申请额度，
+    拿到实际数据后再按真实大小调整。额度耗尽时新的申请会被挂起，
+    从而对队列分发形成反压。
+
+    缓存（原图缓存、输入图片缓存）也计入额度，但只使用任务剩余的部分：
+    申请额度不足时先调用缓存注册的回收函数淘汰条目，仍然不足才等待。
+    """
+
+    def __init__(self, limit_bytes: int):
+        self.limit = limit_bytes
+        self.used = 0
+        self.high_water = 0
+        self.waiting = 0
+        self._cond = asyncio.Condition()
+        self._reclaimers: List[Callable[[int], int]] = []
+
+    def _record(self):
+        if self.used > self.high_water:
+            self.high_water = self.used
+
+    def _can_grant(self, nbytes: int) -> bool:
+        # 单个任务超过总额度时，只要当前没有其他占用就放行，避免永久阻塞
+        return self.used + nbytes <= self.limit or self.used == 0
+
+    def add_reclaimer(self, reclaim: Callable[[int], int]):
+        """reclaim(nbytes) 释放至少 nbytes 的可丢弃数据（不足时尽量释放），返回实际释放的字节数"""
+        self._reclaimers.append(reclaim)
+
+    def _reclaim(self, nbytes: int) -> bool:
+        """额度不足时让缓存淘汰条目，返回之后能否放行"""
+        for reclaim in self._reclaimers:
+            if self._can_grant(nbytes):
+                break
+            reclaim(self.used + nbytes - self.limit)
+        return self._can_grant(nbytes)
+
+    async def acquire(self, nbytes: int):
+        """申请额度，不足时先回收缓存，仍然不足时等待"""
+        async with self._cond:
+            if not self._reclaim(nbytes):
+                self.waiting += 1
+                try:
+                    await self._cond.wait_for(lambda: self._reclaim(nbytes))
+                finally:
+                    self.waiting -= 1
+            self.used += nbytes
+            self._record()
+
+    def release(self, nbytes: int):
+        """归还额度并唤醒等待者"""
+        self.used = max(0, self.used - nbytes)
+        if self.waiting:
+            asyncio.ensure_future(self._notify())
+
+    def adjust(self, delta: int):
+        """按实际缓冲区大小修正已占用额度（不会阻塞）"""
+        if delta >= 0:
+            self.used += delta
+            self._record()
+        else:
+            self.release(-delta)
+
+    async def _notify(self):
+        async with self._cond:
+            self._cond.notify_all()
+
+    def reserve(self, nbytes: int) -> 'Reservation':
+        return Reservation(self, nbytes)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'limit': self.limit,
+            'used': self.used,
+            'high_water': self.high_water,
+            'waiting': self.waiting
+        }
+
+
+class Reservation:
+    """一个任务持有的额度，可在流程中按实际大小调整"""
+
+    def __init__(self, budget: ByteBudget, nbytes: int):
+        self.budget = budget
+        self.nbytes = nbytes
+        self._held = False
+
+    async def acquire(self):
+        await self.budget.acquire(self.nbytes)
+        self._held = True
+
+    async def __aenter__(self) -> 'Reservation':
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.close()
+
+    def resize(self, nbytes: int):
+        """将持有的额度调整为 nbytes"""
+        if not self._held:
+            self.nbytes = nbytes
+            return
+        self.budget.adjust(nbytes - self.nbytes)
+        self.nbytes = nbytes
+
+    def close(self):
+        if self._held:
+            self._held = False
+            self.budget.release(self.nbytes)
+
+
+class BytesLRU:
+    """
+    按总字节数限制容量的LRU缓存，值为若干段bytes
+
+    超过上限时淘汰最久未使用的条目（至少保留最新的一条）。
+    传入 budget 时缓存的字节数计入该额度，额度不足时缓存先被淘汰。
+    """
+
+    def __init__(self, max_bytes: int, budget: Optional[ByteBudget] = None):
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.budget = budget
+        self._entries: 'OrderedDict[Hashable, tuple[int, Any]]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if budget is not None:
+            budget.add_reclaimer(self.shrink)
+
+    def _evict(self) -> int:
+        _, (size, _) = self._entries.popitem(last=False)
+        self.used_bytes -= size
+        if self.budget is not None:
+            self.budget.release(size)
+        return size
+
+    def put(self, key: Hashable, value: Any, nbytes: int):
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.used_bytes -= old[0]
+            if self.budget is not None:
+                self.budget.release(old[0])
+        if self.budget is not None and self.budget.used - self.used_bytes + nbytes > self.budget.limit:
+            # 清空缓存也放不下时不缓存，调用方之后重新计算即可
+            return
+        while self._entries and (self.used_bytes + nbytes > self.max_bytes or
+                                 (self.budget is not None and self.budget.used + nbytes > self.budget.limit)):
+            self._evict()
+        self._entries[key] = (nbytes, value)
+        self.used_bytes += nbytes
+        if self.budget is not None:
+            self.budget.adjust(nbytes)
+
+    def shrink(self, nbytes: int) -> int:
+        """淘汰最久未使用的条目，直到释放了 nbytes 或缓存已空"""
+        freed = 0
+        while freed < nbytes and self._entries:
+            freed += self._evict()
+        return freed
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'entries': len(self._entries),
+            'bytes': self.used_bytes,
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+
+def estimate_job_bytes(width: int, height: int, remove_metadata: bool = False, n_samples: int = 1) -> int:
+    """
+    预估一个任务在流程中同时持有的缓冲区大小
+
+    PNG按未压缩RGB的大小计算（噪点多的图片几乎无法压缩，预算要覆盖最坏情况）。
+    读取响应时分块缓冲区和拼接出的ZIP各一份，之后ZIP、解压出的PNG和交给discord.File的缓冲区
+    最多同时存在三份。清除元数据时ZIP仍未释放，每张图再多一份Pillow解码出的像素和重新编码的PNG。
+    """
+    n = max(1, n_samples)
+    png_bytes = width * height * 3
+    job_bytes = png_bytes * 3 * n
+    if remove_metadata:
+        job_bytes += (png_bytes + width * height * DECODED_PIXEL_BYTES) * n
+    return job_bytes
+
+
+def estimate_sheet_bytes(width: int, height: int, n_samples: int) -> int:
+    """拼图时Pillow解码出的各个格子，加上同样大小的画布"""
+    return width * height * DECODED_PIXEL_BYTES * 2 * n_samples
+
+
+def limit_allocator_retention(threshold: int = MMAP_THRESHOLD_BYTES) -> bool:
+    """
+    固定glibc的mmap阈值，让图片大小的缓冲区释放后立即归还系统
+
+    glibc默认在释放一块mmap内存后把阈值提高到该大小（最高32MB），之后的图片缓冲区改在
+    各线程的堆中分配，释放后仍留在进程里，RSS会比内存预算高出一倍以上。
+    返回是否设置成功；非glibc平台不做任何事。
+    """
+    if threshold <= 0:
+        return False
+    try:
+        libc = ctypes.CDLL('libc.so.6')
+        return bool(libc.mallopt(_M_MMAP_THRESHOLD, threshold))
+    except (OSError, AttributeError):
+        return False
+
+
+def format_bytes(nbytes: Optional[int]) -> str:
+    return f"{(nbytes or 0) / (1024 * 1024):.1f} MB"
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+from functools import lru_cache
+from typing import Iterable, Tuple
+
+import discord
+
+from constants import MODELS, SIZE_PRESETS, SIZE_OPTIONS, SAMPLER_OPTIONS
+from panel_store import PanelState
+
+# 静态选项列表在导入时构建一次 (显示名称, 值)
+_STATIC_OPTIONS = {
+    'model': tuple((name, value) for value, name in MODELS.items()),
+    'size': SIZE_OPTIONS + (('🔧 自定义尺寸', 'custom'),),
+    'sampler': SAMPLER_OPTIONS
+}
+
+_PLACEHOLDERS = {
+    'model': '选择模型',
+    'size': '选择尺寸',
+    'sampler': '选择采样器'
+}
+
+
+@lru_cache(maxsize=None)
+def select_options(kind: str, selected: str) -> Tuple[discord.SelectOption, ...]:
+    """获取某个下拉菜单的选项，仅根据当前值设置default标记"""
+    return tuple(
+        discord.SelectOption(label=label, value=value, default=value == selected)
+        for label, value in _STATIC_OPTIONS[kind]
+    )
+
+
+@lru_cache(maxsize=1024)
+def preset_options(names: Tuple[str, ...], selected: str) -> Tuple[discord.SelectOption, ...]:
+    """构建预设下拉菜单的选项（Discord限制最多25项）"""
+    options = [discord.SelectOption(label='不使用预设', value='none', default=selected is None)]
+    options.extend(
+        discord.SelectOption(label=name, value=name, default=name == selected)
+        for name in names[:24]
+    )
+    return tuple(options)
+
+
+def size_display(state: PanelState) -> str:
+    """面板上显示的尺寸描述"""
+    if state.size == 'custom':
+        return f"自定义: {state.custom_width}×{state.custom_height}"
+    size_preset = SIZE_PRESETS.get(state.size, {'width': 512, 'height': 768})
+    return f"{state.size} ({size_preset['width']}×{size_preset['height']})"
+
+
+@lru_cache(maxsize=4096)
+def _render_embed(key: tuple) -> discord.Embed:
+    state = PanelState(*key)
+    embed = discord.Embed(
+        title='🎨 NovelAI 绘图面板',
+        description='使用下方的菜单和按钮来配置您的图片生成参数',
+        color=discord.Color.blue()
+    )
+
+    embed.add_field(name='模型', value=MODELS.get(state.model, state.model), inline=True)
+    embed.add_field(name='尺寸', value=size_display(state), inline=True)
+    embed.add_field(name='采样器', value=state.sampler, inline=True)
+    embed.add_field(name='预设', value=state.preset or '未选择', inline=True)
+    embed.add_field(name='清除元数据', value='✅ 开启' if state.remove_metadata else '❌ 关闭', inline=True)
+    embed.add_field(name='数量', value=str(state.n_samples), inline=True)
+
+    # 显示当前自定义尺寸
+    if state.size == 'custom':
+        pixels = state.custom_width * state.custom_height
+        embed.add_field(
+            name='📏 当前自定义尺寸',
+            value=f"宽度: {state.custom_width} | 高度: {state.custom_height} | 总像素: {pixels:,}",
+            inline=False
+        )
+
+    return embed
+
+
+def build_panel_embed(state: PanelState) -> discord.Embed:
+    """
+    构建面板Embed
+
+    相同状态返回同一个缓存对象，调用方不能修改返回的Embed。
+    """
+    return _render_embed(state.key())
+
+
+def add_panel_items(view: discord.ui.View, state: PanelState, preset_names: Iterable[str]) -> discord.ui.View:
+    """
+    向视图中添加面板组件（4个下拉菜单 + 一行按钮）
+
+    所有组件使用固定的custom_id，以便重启后由持久化视图继续处理。
+    """
+    # 每个Select占整行
+    for row, kind in enumerate(('model', 'size', 'sampler')):
+        view.add_item(discord.ui.Select(
+            placeholder=_PLACEHOLDERS[kind],
+            options=list(select_options(kind, getattr(state, kind))),
+            custom_id=f'{kind}_select',
+            row=row
+        ))
+
+    view.add_item(discord.ui.Select(
+        placeholder='选择预设',
+        options=list(preset_options(tuple(preset_names), state.preset)),
+        custom_id='preset_select',
+        row=3
+    ))
+
+    # 第4行：主要操作和尺寸调整
+    view.add_item(discord.ui.Button(label='🎨 生成图片', style=discord.ButtonStyle.primary, custom_id='generate_button', row=4))
+    view.add_item(discord.ui.Button(label='🔄 元数据清除', style=discord.ButtonStyle.secondary, custom_id='metadata_button', row=4))
+    view.add_item(discord.ui.Button(label='💾 保存设置', style=discord.ButtonStyle.success, custom_id='save_button', row=4))
+    view.add_item(discord.ui.Button(label='📐 自定义尺寸', style=discord.ButtonStyle.secondary, custom_id='custom_size_input', row=4))
+
+    return view
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, asdict
+from typing import Any, Dict, Optional
+
+# 与交互令牌的有效期（15分钟）保持一致，过期后从已保存的设置中恢复
+PANEL_TTL = 900
+PANEL_MAX_SESSIONS = 10000
+
+
+@dataclass(slots=True)
+class PanelState:
+    """单个用户的面板状态"""
+    model: str = 'nai-diffusion-3'
+    size: str = 'portrait_s'
+    sampler: str = 'k_euler_ancestral'
+    preset: Optional[str] = None
+    remove_metadata: bool = False
+    custom_width: int = 512
+    custom_height: int = 768
+    n_samples: int = 1
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'PanelState':
+        """从保存的用户设置构建状态，忽略未知字段"""
+        state = cls()
+        for field in cls.__slots__:
+            if field in data and data[field] is not None:
+                setattr(state, field, data[field])
+        # 预设允许为None
+        state.preset = data.get('preset')
+        return state
+
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+    def key(self) -> tuple:
+        """用于缓存渲染结果的状态元组（字段顺序与构造函数一致）"""
+        return (self.model, self.size, self.sampler, self.preset,
+                self.remove_metadata, self.custom_width, self.custom_height, self.n_samples)
+
+
+class PanelSessionStore:
+    """
+    面板会话存储
+
+    按最近使用顺序保存PanelState，超过TTL或容量上限的会话会被淘汰。
+    """
+
+    def __init__(self, ttl: float = PANEL_TTL, max_size: int = PANEL_MAX_SESSIONS):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._sessions: 'OrderedDict[str, tuple[float, PanelState]]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def __contains__(self, user_id: str) -> bool:
+        return self.get(user_id, count=False) is not None
+
+    def get(self, user_id: str, count: bool = True) -> Optional[PanelState]:
+        """获取会话并刷新其过期时间"""
+        entry = self._sessions.get(user_id)
+        now = time.monotonic()
+        if entry is None or now - entry[0] > self.ttl:
+            if entry is not None:
+                del self._sessions[user_id]
+                self.evictions += 1
+            if count:
+                self.misses += 1
+            return None
+
+        state = entry[1]
+        self._sessions[user_id] = (now, state)
+        self._sessions.move_to_end(user_id)
+        if count:
+            self.hits += 1
+        return state
+
+    def put(self, user_id: str, state: PanelState):
+        self._sessions[user_id] = (time.monotonic(), state)
+        self._sessions.move_to_end(user_id)
+        while len(self._sessions) > self.max_size:
+            self._sessions.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, user_id: str) -> Optional[PanelState]:
+        entry = self._sessions.pop(user_id, None)
+        return entry[1] if entry else None
+
+    def evict_expired(self) -> int:
+        """清理所有过期会话，返回清理数量"""
+        cutoff = time.monotonic() - self.ttl
+        removed = 0
+        # 按最近使用顺序排列，最旧的在前
+        while self._sessions:
+            user_id, (touched, _) = next(iter(self._sessions.items()))
+            if touched > cutoff:
+                break
+            del self._sessions[user_id]
+            removed += 1
+        self.evictions += removed
+        return removed
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'size': len(self._sessions),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
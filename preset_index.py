@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+from bisect import bisect_left, insort
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, List, Optional, Set
+
+# 名称少于该数量时不建三元组索引，模糊匹配逐个计算重合度（每个三元组一个集合，小索引的内存主要花在这里）
+TRIGRAM_INDEX_MIN = 64
+
+
+def _trigrams(text: str) -> Set[str]:
+    if len(text) < 3:
+        return {text} if text else set()
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class PresetIndex:
+    """
+    单个用户的预设名称索引
+
+    维护按小写名称排序的列表用于前缀查找，名称较多时另建三元组倒排索引用于模糊匹配。
+    """
+
+    __slots__ = ('_sorted', '_lower', '_trigrams')
+
+    def __init__(self, names: Iterable[str] = ()):
+        self._lower: Dict[str, str] = {name: name.lower() for name in names}
+        self._sorted = sorted((lower, name) for name, lower in self._lower.items())
+        self._trigrams: Optional[Dict[str, Set[str]]] = None
+        if len(self._lower) >= TRIGRAM_INDEX_MIN:
+            self._build_trigrams()
+
+    def __len__(self) -> int:
+        return len(self._lower)
+
+    def _build_trigrams(self):
+        self._trigrams = defaultdict(set)
+        for name, lower in self._lower.items():
+            for gram in _trigrams(lower):
+                self._trigrams[gram].add(name)
+
+    def add(self, name: str):
+        if name in self._lower:
+            return
+        lower = name.lower()
+        self._lower[name] = lower
+        insort(self._sorted, (lower, name))
+        if self._trigrams is not None:
+            for gram in _trigrams(lower):
+                self._trigrams[gram].add(name)
+        elif len(self._lower) >= TRIGRAM_INDEX_MIN:
+            self._build_trigrams()
+
+    def remove(self, name: str):
+        lower = self._lower.pop(name, None)
+        if lower is None:
+            return
+        pos = bisect_left(self._sorted, (lower, name))
+        if pos < len(self._sorted) and self._sorted[pos] == (lower, name):
+            del self._sorted[pos]
+        if self._trigrams is None:
+            return
+        for gram in _trigrams(lower):
+            bucket = self._trigrams.get(gram)
+            if bucket is not None:
+                bucket.discard(name)
+                if not bucket:
+                    del self._trigrams[gram]
+
+    def search(self, query: str, limit: int = 25) -> List[str]:
+        """先返回前缀匹配，不足时按三元组重合度补充模糊匹配"""
+        query = query.lower().strip()
+        if not query:
+            return [name for _, name in self._sorted[:limit]]
+
+        results = []
+        pos = bisect_left(self._sorted, (query, ''))
+        while pos < len(self._sorted) and len(results) < limit:
+            lower, name = self._sorted[pos]
+            if not lower.startswith(query):
+                break
+            results.append(name)
+            pos += 1
+
+        if len(results) >= limit:
+            return results
+
+        seen = set(results)
+        grams = _trigrams(query)
+        if len(query) < 3:
+            # 查询过短时没有可用的三元组，退化为子串匹配
+            candidates = [name for lower, name in self._sorted if query in lower and name not in seen]
+            return results + candidates[:limit - len(results)]
+
+        scores: Dict[str, int] = defaultdict(int)
+        if self._trigrams is None:
+            for lower, name in self._sorted:
+                score = len(grams & _trigrams(lower))
+                if score and name not in seen:
+                    scores[name] = score
+        else:
+            for gram in grams:
+                for name in self._trigrams.get(gram, ()):
+                    if name not in seen:
+                        scores[name] += 1
+
+        # 子串匹配优先，其次按重合的三元组数量和名称长度排序
+        ranked = sorted(
+            scores.items(),
+            key=lambda item: (query not in self._lower[item[0]], -item[1], len(item[0]), item[0])
+        )
+        # 至少要有一半的三元组命中才算模糊匹配
+        threshold = max(1, len(grams) // 2)
+        for name, score in ranked:
+            if len(results) >= limit:
+                break
+            if score >= threshold or query in self._lower[name]:
+                results.append(name)
+        return results
+
+
+class PresetIndexStore:
+    """所有用户的预设索引，某个用户首次访问时用 loader(user_id) 返回的名称构建，保存/删除时增量维护"""
+
+    def __init__(self, loader: Callable[[str], Iterable[str]]):
+        self._loader = loader
+        self._indexes: Dict[str, PresetIndex] = {}
+
+    def get(self, user_id: str) -> PresetIndex:
+        index = self._indexes.get(user_id)
+        if index is None:
+            index = PresetIndex(self._loader(user_id))
+            self._indexes[user_id] = index
+        return index
+
+    def add(self, user_id: str, name: str):
+        self.get(user_id).add(name)
+
+    def remove(self, user_id: str, name: str):
+        self.get(user_id).remove(name)
+
+    def search(self, user_id: str, query: str, limit: int = 25) -> List[str]:
+        return self.get(user_id).search(query, limit)
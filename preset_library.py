@@ -0,0 +1,415 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import logging
+import os
+import re
+import zlib
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+LIBRARY_FILE_NAME = 'preset_library.log'
+# 旧版按用户保存完整提示词的预设文件，首次加载时迁移
+LEGACY_FILE_NAME = 'user_presets.json'
+LIBRARY_VERSION = '1'
+
+# 片段引用为内容哈希（blake2b 8字节）的十六进制，一段文本的引用直接拼接成一个字符串
+REF_LENGTH = 16
+# 按标签内容决定切分点：标签的CRC低位为0时在其后切分，平均每个片段4个标签，
+# 只有少量标签不同的提示词仍然共用其余的片段
+CHUNK_MASK = 0b11
+MAX_CHUNK_TAGS = 16
+# 逗号分隔的标签，逗号保留在前一个标签末尾，拼接后与原文完全一致
+_TAG = re.compile(r'[^,]*,|[^,]+$')
+
+# 日志文件每行一条记录: 类型\t键\tJSON
+# f: 片段引用 -> 片段文本；u: 用户ID -> 个人预设；s: 用户ID -> 订阅；g: 服务器ID -> 共享库
+# 同一个键的后一行覆盖前一行；失效行超过有效行时在加载时压缩
+RECORD_FRAGMENT = 'f'
+TABLES = ('u', 's', 'g')
+
+
+class PresetError(ValueError):
+    """预设不存在或操作不允许"""
+
+
+def split_fragments(text: str) -> List[str]:
+    """把提示词切分为片段；切分点只取决于标签本身，与所在位置无关"""
+    fragments = []
+    start = 0
+    count = 0
+    for match in _TAG.finditer(text):
+        count += 1
+        tag = match.group().strip(' ,').encode('utf-8')
+        if count >= MAX_CHUNK_TAGS or zlib.crc32(tag) & CHUNK_MASK == 0:
+            fragments.append(text[start:match.end()])
+            start = match.end()
+            count = 0
+    if start < len(text):
+        fragments.append(text[start:])
+    return fragments
+
+
+def iter_refs(refs: str) -> Iterator[str]:
+    return (refs[i:i + REF_LENGTH] for i in range(0, len(refs), REF_LENGTH))
+
+
+def _line(kind: str, key: str, value: Any) -> str:
+    return f"{kind}\t{key}\t{json.dumps(value, ensure_ascii=False, separators=(',', ':'))}\n"
+
+
+class FragmentStore:
+    """
+    内容哈希 -> 提示词片段，相同的片段只保存一份
+
+    从文件加载的片段保持JSON原文，第一次展开时才解码。
+    """
+
+    def __init__(self):
+        self._texts: Dict[str, str] = {}
+        self._raw: Dict[str, str] = {}
+        # 新增但还没有写入文件的片段
+        self.pending: List[Tuple[str, str]] = []
+
+    def __len__(self) -> int:
+        return len(self._texts) + len(self._raw)
+
+    def __contains__(self, ref: str) -> bool:
+        return ref in self._texts or ref in self._raw
+
+    def load_raw(self, ref: str, raw: str):
+        self._raw[ref] = raw
+
+    def intern(self, text: str) -> str:
+        """保存文本的各个片段，返回拼接的片段引用"""
+        refs = []
+        for fragment in split_fragments(text):
+            ref = hashlib.blake2b(fragment.encode('utf-8'), digest_size=REF_LENGTH // 2).hexdigest()
+            if ref not in self:
+                self._texts[ref] = fragment
+                self.pending.append((ref, fragment))
+            refs.append(ref)
+        return ''.join(refs)
+
+    def text(self, ref: str) -> str:
+        text = self._texts.get(ref)
+        if text is None:
+            text = self._texts[ref] = json.loads(self._raw.pop(ref))
+        return text
+
+    def expand(self, refs: str) -> str:
+        return ''.join(self.text(ref) for ref in iter_refs(refs))
+
+    def prune(self, referenced: Set[str]) -> int:
+        """删除不再被引用的片段，返回删除的数量"""
+        removed = 0
+        for table in (self._texts, self._raw):
+            unused = [ref for ref in table if ref not in referenced]
+            for ref in unused:
+                del table[ref]
+            removed += len(unused)
+        return removed
+
+    def lines(self) -> Iterator[str]:
+        for ref, text in self._texts.items():
+            yield _line(RECORD_FRAGMENT, ref, text)
+        for ref, raw in self._raw.items():
+            yield f'{RECORD_FRAGMENT}\t{ref}\t{raw}\n'
+
+
+class LazyTable:
+    """键 -> dict，从文件加载的值保持JSON原文，第一次访问时才解析"""
+
+    def __init__(self):
+        self._values: Dict[str, Dict] = {}
+        self._raw: Dict[str, str] = {}
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._values or key in self._raw
+
+    def __len__(self) -> int:
+        return len(self._values) + len(self._raw)
+
+    def load_raw(self, key: str, raw: str):
+        self._values.pop(key, None)
+        if raw == '{}':
+            # 已被清空的键
+            self._raw.pop(key, None)
+        else:
+            self._raw[key] = raw
+
+    def get(self, key: str) -> Dict:
+        """返回键对应的dict（不存在时为空dict，修改后需要调用 set 保存）"""
+        value = self._values.get(key)
+        if value is None:
+            raw = self._raw.pop(key, None)
+            value = json.loads(raw) if raw is not None else {}
+            if raw is not None:
+                self._values[key] = value
+        return value
+
+    def set(self, key: str, value: Dict):
+        self._raw.pop(key, None)
+        if value:
+            self._values[key] = value
+        else:
+            self._values.pop(key, None)
+
+    def items(self) -> Iterator[Tuple[str, Dict]]:
+        for key in list(self._raw):
+            self.get(key)
+        return iter(list(self._values.items()))
+
+
+class PresetLibrary:
+    """
+    用户预设和服务器共享预设库
+
+    预设只保存提示词和负面提示词的片段引用，文本存放在共用的 FragmentStore 中，
+    生成时才展开。用户可以把自己的预设发布到所在服务器的共享库，其他成员订阅后
+    以自己的名称使用；订阅只记录 (服务器, 共享名称)，发布者重新发布后订阅者随之更新。
+
+    数据保存在 DATA_DIR 下的追加日志中，每次修改只追加变化的那个用户/服务器的一行。
+    启动时由 start_services 在线程中加载（迁移和压缩也在此完成），只按行切分出键和
+    JSON原文，各用户的预设在用到时才解析；未预先加载时首次访问会同步加载。
+    """
+
+    def __init__(self, directory, name: str = LIBRARY_FILE_NAME, legacy_name: str = LEGACY_FILE_NAME):
+        self.path = Path(directory) / name
+        self.legacy_path = Path(directory) / legacy_name
+        self._loaded = False
+        self.fragments = FragmentStore()
+        # u: 用户ID -> {预设名称: [提示词引用, 负面提示词引用]}
+        # s: 用户ID -> {预设名称: [服务器ID, 共享名称]}
+        # g: 服务器ID -> {共享名称: {'prompt', 'negative', 'author'}}
+        self._tables: Dict[str, LazyTable] = {kind: LazyTable() for kind in TABLES}
+
+    def ensure_loaded(self):
+        """尚未加载时加载，启动时放到线程中调用以免阻塞事件循环"""
+        if not self._loaded:
+            self.load()
+
+    def load(self):
+        self._loaded = True
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                content = f.read()
+        except FileNotFoundError:
+            self._migrate_legacy()
+            return
+        except OSError as e:
+            logger.error(f"[预设库] 无法加载 {self.path}: {e}")
+            return
+
+        lines = content.split('\n')
+        # 最后一行没有换行符时是中途中断的写入，丢弃并在下面重写文件，之后的追加不会接在它后面
+        torn = lines.pop() != ''
+        records = stale = 0
+        for line in lines:
+            parts = line.split('\t', 2)
+            if len(parts) != 3:
+                continue
+            kind, key, raw = parts
+            if kind == RECORD_FRAGMENT:
+                self.fragments.load_raw(key, raw)
+                continue
+            table = self._tables.get(kind)
+            if table is None:
+                continue
+            if key in table or raw == '{}':
+                stale += 1
+            else:
+                records += 1
+            table.load_raw(key, raw)
+        if torn or stale > records:
+            self.compact()
+
+    def _migrate_legacy(self):
+        """从旧版预设文件迁移，旧文件保留不动"""
+        try:
+            with open(self.legacy_path, 'r', encoding='utf-8') as f:
+                legacy = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.error(f"[预设库] 无法读取旧版预设 {self.legacy_path}: {e}")
+            return
+        users = self._tables['u']
+        # 大量用户保存了完全相同的文本，同一段文本只切分一次
+        interned: Dict[str, str] = {}
+
+        def intern(text: str) -> str:
+            refs = interned.get(text)
+            if refs is None:
+                refs = interned[text] = self.fragments.intern(text)
+            return refs
+
+        count = 0
+        for user_id, user_presets in legacy.items():
+            users.set(user_id, {
+                name: [intern(data.get('prompt') or ''), intern(data.get('negative') or '')]
+                for name, data in user_presets.items()
+            })
+            count += len(user_presets)
+        self.compact()
+        logger.info(f"[预设库] 已从 {self.legacy_path.name} 迁移 {count} 个预设 | 片段: {len(self.fragments)}")
+
+    def _referenced(self) -> Set[str]:
+        refs = set()
+        for _, user_presets in self._tables['u'].items():
+            for prompt_refs, negative_refs in user_presets.values():
+                refs.update(iter_refs(prompt_refs))
+                refs.update(iter_refs(negative_refs))
+        for _, library in self._tables['g'].items():
+            for shared in library.values():
+                refs.update(iter_refs(shared['prompt']))
+                refs.update(iter_refs(shared['negative']))
+        return refs
+
+    def compact(self):
+        """清理无用片段和被覆盖的行，整体重写日志文件"""
+        removed = self.fragments.prune(self._referenced())
+        self.fragments.pending.clear()
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            # 先写临时文件再替换，中途失败时原文件不受影响
+            tmp_path = self.path.with_suffix('.tmp')
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(_line('v', LIBRARY_VERSION, {}))
+                f.writelines(self.fragments.lines())
+                for kind, table in self._tables.items():
+                    f.writelines(_line(kind, key, value) for key, value in table.items())
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.error(f"[预设库] 压缩失败: {e}")
+            return
+        logger.info(f"[预设库] 已压缩 | 片段: {len(self.fragments)}（清理 {removed}）| "
+                    f"用户: {len(self._tables['u'])} | 共享库: {len(self._tables['g'])}")
+
+    def _commit(self, kind: str, key: str, value: Dict):
+        """更新内存中的值，并把新片段和这一行追加到日志"""
+        self._tables[kind].set(key, value)
+        lines = [_line(RECORD_FRAGMENT, ref, text) for ref, text in self.fragments.pending]
+        self.fragments.pending.clear()
+        lines.append(_line(kind, key, value))
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            if not self.path.exists():
+                lines.insert(0, _line('v', LIBRARY_VERSION, {}))
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.writelines(lines)
+        except OSError as e:
+            logger.error(f"[预设库] 保存失败: {e}")
+
+    # ---- 用户预设 ----
+
+    def names(self, user_id: str) -> List[str]:
+        """用户自己的预设和订阅的预设名称"""
+        self.ensure_loaded()
+        return list(self._tables['u'].get(user_id)) + list(self._tables['s'].get(user_id))
+
+    def get(self, user_id: str, name: str) -> Optional[Tuple[str, str]]:
+        """展开预设为 (提示词, 负面提示词)；不存在或订阅的共享预设已取消发布时返回None"""
+        self.ensure_loaded()
+        entry = self._tables['u'].get(user_id).get(name)
+        if entry is None:
+            link = self._tables['s'].get(user_id).get(name)
+            if link is None:
+                return None
+            return self.expand_shared(*link)
+        return self.fragments.expand(entry[0]), self.fragments.expand(entry[1])
+
+    def is_subscription(self, user_id: str, name: str) -> bool:
+        self.ensure_loaded()
+        return name in self._tables['s'].get(user_id)
+
+    def put(self, user_id: str, name: str, prompt: str, negative: str):
+        """保存个人预设，同名的订阅被取消"""
+        self.ensure_loaded()
+        subscriptions = self._tables['s'].get(user_id)
+        if name in subscriptions:
+            del subscriptions[name]
+            self._commit('s', user_id, subscriptions)
+        user_presets = self._tables['u'].get(user_id)
+        user_presets[name] = [self.fragments.intern(prompt), self.fragments.intern(negative)]
+        self._commit('u', user_id, user_presets)
+
+    def delete(self, user_id: str, name: str) -> bool:
+        """删除预设或取消订阅，不存在时返回False"""
+        self.ensure_loaded()
+        for kind in ('u', 's'):
+            entries = self._tables[kind].get(user_id)
+            if name in entries:
+                del entries[name]
+                self._commit(kind, user_id, entries)
+                return True
+        return False
+
+    # ---- 服务器共享库 ----
+
+    def shared(self, guild_id: str) -> Dict[str, Dict[str, str]]:
+        """共享名称 -> {'prompt', 'negative', 'author'}（引用未展开）"""
+        self.ensure_loaded()
+        return self._tables['g'].get(guild_id)
+
+    def expand_shared(self, guild_id: str, name: str) -> Optional[Tuple[str, str]]:
+        shared = self.shared(guild_id).get(name)
+        if shared is None:
+            return None
+        return self.fragments.expand(shared['prompt']), self.fragments.expand(shared['negative'])
+
+    def publish(self, guild_id: str, user_id: str, name: str, shared_name: Optional[str] = None) -> str:
+        """
+        把用户自己的预设发布到服务器共享库，返回共享名称
+
+        发布的是当前内容的快照（只复制片段引用），之后修改个人预设不影响共享库，重新发布即可更新。
+        同名的共享预设只有原发布者可以覆盖。
+        """
+        self.ensure_loaded()
+        entry = self._tables['u'].get(user_id).get(name)
+        if entry is None:
+            raise PresetError(f"未找到名为 '{name}' 的个人预设")
+        shared_name = shared_name or name
+        library = self.shared(guild_id)
+        existing = library.get(shared_name)
+        if existing is not None and existing['author'] != user_id:
+            raise PresetError(f"共享库中已有其他人发布的 '{shared_name}'")
+        library[shared_name] = {'prompt': entry[0], 'negative': entry[1], 'author': user_id}
+        self._commit('g', guild_id, library)
+        return shared_name
+
+    def unpublish(self, guild_id: str, shared_name: str, user_id: str, moderator: bool = False):
+        """取消发布，只有发布者或服务器管理者可以操作；订阅者的预设随之失效"""
+        self.ensure_loaded()
+        library = self.shared(guild_id)
+        existing = library.get(shared_name)
+        if existing is None:
+            raise PresetError(f"共享库中没有 '{shared_name}'")
+        if existing['author'] != user_id and not moderator:
+            raise PresetError('只有发布者或服务器管理者可以取消发布')
+        del library[shared_name]
+        self._commit('g', guild_id, library)
+
+    def subscribe(self, user_id: str, guild_id: str, shared_name: str, name: Optional[str] = None) -> str:
+        """订阅共享预设，以 name（默认与共享名称相同）作为自己的预设名称，返回该名称"""
+        self.ensure_loaded()
+        if shared_name not in self.shared(guild_id):
+            raise PresetError(f"共享库中没有 '{shared_name}'")
+        name = name or shared_name
+        if name in self._tables['u'].get(user_id):
+            raise PresetError(f"你已经有名为 '{name}' 的预设，请换一个名称")
+        subscriptions = self._tables['s'].get(user_id)
+        subscriptions[name] = [guild_id, shared_name]
+        self._commit('s', user_id, subscriptions)
+        return name
+
+    def stats(self) -> Dict[str, int]:
+        self.ensure_loaded()
+        return {
+            'users': len(self._tables['u']),
+            'shared_libraries': len(self._tables['g']),
+            'subscribers': len(self._tables['s']),
+            'fragments': len(self.fragments)
+        }
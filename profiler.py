@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from typing import Dict
+
+# 采样间隔（秒）
+PROFILE_INTERVAL = 0.005
+# 单次采样的最长时间（秒）
+MAX_PROFILE_SECONDS = 120
+# 内存快照保存的调用栈深度
+TRACEMALLOC_FRAMES = 10
+
+# 同一时间只允许一次采样
+_profile_lock = asyncio.Lock()
+
+
+class ProfilerBusy(Exception):
+    """已有采样正在进行"""
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})'
+
+
+def _sample_stacks(seconds: float, interval: float) -> Dict[str, int]:
+    """
+    在独立线程中周期性读取所有线程的调用栈，按折叠栈格式计数
+
+    只在读取栈时短暂持有GIL，对事件循环的影响与一次普通的线程切换相当。
+    """
+    own_id = threading.get_ident()
+    names = {}
+    counts: Counter = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frames = sys._current_frames()
+        if len(names) != len(frames):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in frames.items():
+            if thread_id == own_id:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame))
+                frame = frame.f_back
+            stack.append(names.get(thread_id, str(thread_id)))
+            counts[';'.join(reversed(stack))] += 1
+        time.sleep(interval)
+    return counts
+
+
+def format_collapsed(counts: Dict[str, int]) -> str:
+    """输出flamegraph.pl / speedscope 可直接读取的折叠栈文本"""
+    return '\n'.join(f'{stack} {count}' for stack, count in
+                     sorted(counts.items(), key=lambda item: item[1], reverse=True)) + '\n'
+
+
+async def profile_cpu(seconds: float, interval: float = PROFILE_INTERVAL) -> str:
+    """
+    对当前进程的所有线程（包括事件循环线程和线程池）采样 seconds 秒，返回折叠栈文本
+    """
+    if _profile_lock.locked():
+        raise ProfilerBusy()
+    async with _profile_lock:
+        seconds = min(seconds, MAX_PROFILE_SECONDS)
+        counts = await asyncio.to_thread(_sample_stacks, seconds, interval)
+        return format_collapsed(counts)
+
+
+async def profile_memory(seconds: float, top: int = 50) -> str:
+    """
+    在开始和结束时各取一次tracemalloc快照，返回按分配增量排序的报告
+
+    如果tracemalloc之前未开启，会在采样期间临时开启并在结束后关闭。
+    """
+    if _profile_lock.locked():
+        raise ProfilerBusy()
+    async with _profile_lock:
+        seconds = min(seconds, MAX_PROFILE_SECONDS)
+        started_here = not tracemalloc.is_tracing()
+        if started_here:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        try:
+            before = await asyncio.to_thread(tracemalloc.take_snapshot)
+            await asyncio.sleep(seconds)
+            after = await asyncio.to_thread(tracemalloc.take_snapshot)
+        finally:
+            if started_here:
+                tracemalloc.stop()
+
+        ignore = (tracemalloc.Filter(False, tracemalloc.__file__),)
+        stats = await asyncio.to_thread(
+            lambda: after.filter_traces(ignore).compare_to(before.filter_traces(ignore), 'traceback')
+        )
+        total = sum(stat.size_diff for stat in stats)
+        lines = [f'# tracemalloc 差异 | 时长: {seconds:.0f}s | 净增: {total / 1024:.1f} KiB', '']
+        for stat in stats[:top]:
+            lines.append(f'{stat.size_diff / 1024:+.1f} KiB | {stat.count_diff:+d} 个块 | 当前 {stat.size / 1024:.1f} KiB')
+            lines.extend(f'    {line}' for line in stat.traceback.format())
+        return '\n'.join(lines) + '\n'
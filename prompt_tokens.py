@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+import gzip
+import logging
+import os
+import re
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from constants import MODELS
+from request_compiler import QUALITY_TAGS, get_template
+from utils import DATA_DIR
+
+logger = logging.getLogger(__name__)
+
+# V3使用CLIP分词（3段×75），V4/V4.5使用T5分词
+CLIP_TOKEN_LIMIT = 225
+T5_TOKEN_LIMIT = 512
+TOKEN_LIMITS = {'clip': CLIP_TOKEN_LIMIT, 't5': T5_TOKEN_LIMIT}
+
+# 词表文件目录：CLIP的 bpe_simple_vocab_16e6.txt.gz，T5的 spiece.model（需要安装sentencepiece）
+TOKENIZER_DIR = Path(os.getenv('TOKENIZER_DIR', str(Path(DATA_DIR) / 'tokenizers')))
+CLIP_VOCAB_FILE = 'bpe_simple_vocab_16e6.txt.gz'
+T5_MODEL_FILE = 'spiece.model'
+# 提示词片段的分词结果缓存条数
+TOKEN_CACHE_SIZE = int(os.getenv('TOKEN_CACHE_SIZE', '4096'))
+
+# CLIP的预分词规则：连续字母、单个数字、连续的其他符号，空白不产生token
+PRETOKENIZE = re.compile(r"'s|'t|'re|'ve|'m|'ll|'d|[^\W\d_]+|\d|(?:[^\s\w]|_)+", re.IGNORECASE)
+# 在逗号后的空白处切分片段：预分词结果不会跨越空白，各片段token数之和等于整段的token数
+FRAGMENT_SPLIT = re.compile(r'(?<=,)\s+')
+
+
+class PromptTooLong(Exception):
+    """提示词超出模型的token上限"""
+
+
+def _bytes_to_unicode() -> Dict[int, str]:
+    """CLIP字节级BPE使用的 字节 -> 可见字符 映射"""
+    visible = list(range(ord('!'), ord('~') + 1)) + list(range(ord('¡'), ord('¬') + 1)) + list(range(ord('®'), ord('ÿ') + 1))
+    chars = visible[:]
+    n = 0
+    for b in range(256):
+        if b not in visible:
+            visible.append(b)
+            chars.append(256 + n)
+            n += 1
+    return dict(zip(visible, map(chr, chars)))
+
+
+class ClipTokenizer:
+    """CLIP的BPE分词，只计算token数量，不需要词表ID"""
+
+    def __init__(self, path: Path):
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            merges = f.read().split('\n')[1:49152 - 256 - 2 + 1]
+        self.ranks = {tuple(merge.split()): i for i, merge in enumerate(merges)}
+        self.byte_encoder = _bytes_to_unicode()
+        self._bpe = lru_cache(maxsize=TOKEN_CACHE_SIZE)(self._bpe_word)
+
+    def _bpe_word(self, token: str) -> int:
+        word = ''.join(self.byte_encoder[b] for b in token.encode('utf-8'))
+        parts = list(word[:-1]) + [word[-1] + '</w>']
+        while len(parts) > 1:
+            pairs = {(parts[i], parts[i + 1]) for i in range(len(parts) - 1)}
+            best = min(pairs, key=lambda pair: self.ranks.get(pair, float('inf')))
+            if best not in self.ranks:
+                break
+            merged = []
+            i = 0
+            while i < len(parts):
+                if i < len(parts) - 1 and (parts[i], parts[i + 1]) == best:
+                    merged.append(parts[i] + parts[i + 1])
+                    i += 2
+                else:
+                    merged.append(parts[i])
+                    i += 1
+            parts = merged
+        return len(parts)
+
+    def count(self, text: str) -> int:
+        return sum(map(self._bpe, PRETOKENIZE.findall(text.lower())))
+
+
+class SentencePieceTokenizer:
+    """T5的sentencepiece分词"""
+
+    def __init__(self, path: Path):
+        import sentencepiece
+        self.processor = sentencepiece.SentencePieceProcessor(model_file=str(path))
+
+    def count(self, text: str) -> int:
+        return len(self.processor.encode(text))
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    没有词表时的估算：常见英文单词按1个token，长单词按长度增加，
+    数字和符号逐个计数，非ASCII字符按每字1个token
+    """
+    total = 0
+    for token in PRETOKENIZE.findall(text):
+        if token.isascii():
+            total += 1 + len(token) // 8 if token.isalpha() else len(token)
+        else:
+            total += len(token)
+    return total
+
+
+def _load_tokenizers() -> Dict[str, object]:
+    tokenizers = {}
+    clip_path = TOKENIZER_DIR / CLIP_VOCAB_FILE
+    if clip_path.exists():
+        tokenizers['clip'] = ClipTokenizer(clip_path)
+    t5_path = TOKENIZER_DIR / T5_MODEL_FILE
+    if t5_path.exists():
+        try:
+            tokenizers['t5'] = SentencePieceTokenizer(t5_path)
+        except ImportError:
+            logger.warning(f"[分词] 找到 {T5_MODEL_FILE} 但未安装sentencepiece，V4模型使用估算")
+    logger.info(f"[分词] 精确分词: {', '.join(tokenizers) or '无'} | 其余使用估算")
+    return tokenizers
+
+
+_tokenizers: Optional[Dict[str, object]] = None
+
+
+def load_tokenizers() -> Dict[str, object]:
+    """加载词表（约需0.1秒，可在线程中预先调用）"""
+    global _tokenizers
+    if _tokenizers is None:
+        _tokenizers = _load_tokenizers()
+    return _tokenizers
+
+
+@lru_cache(maxsize=TOKEN_CACHE_SIZE)
+def _fragment_tokens(family: str, fragment: str) -> int:
+    tokenizer = load_tokenizers().get(family)
+    return tokenizer.count(fragment) if tokenizer is not None else estimate_tokens(fragment)
+
+
+def count_tokens(family: str, text: str) -> int:
+    """
+    按逗号分段计数并缓存每段的结果
+
+    预设合并后的提示词为 "预设, 提示词"，预设部分直接命中缓存。
+    """
+    return sum(_fragment_tokens(family, fragment) for fragment in FRAGMENT_SPLIT.split(text) if fragment)
+
+
+def is_exact(family: str) -> bool:
+    return family in load_tokenizers()
+
+
+def model_family(model: str) -> str:
+    return 't5' if get_template(model).is_v4 else 'clip'
+
+
+@dataclass(frozen=True, slots=True)
+class TokenCheck:
+    """一次提示词长度检查的结果"""
+    prompt_tokens: int
+    negative_tokens: int
+    limit: int
+    exact: bool
+
+    @property
+    def over_limit(self) -> bool:
+        return max(self.prompt_tokens, self.negative_tokens) > self.limit
+
+    def describe(self) -> str:
+        approx = '' if self.exact else '约 '
+        return (f'正面 {approx}{self.prompt_tokens} / 负面 {approx}{self.negative_tokens} tokens，'
+                f'上限 {self.limit}')
+
+
+def check_prompt(model: str, prompt: str, negative: Optional[str]) -> TokenCheck:
+    """按实际发送的内容计数：非V4模型会加上质量标签，未填负面提示词时使用默认值"""
+    template = get_template(model)
+    family = model_family(model)
+    final_prompt = prompt if template.is_v4 else QUALITY_TAGS + prompt
+    final_negative = negative or template.defaults['negative_prompt']
+    return TokenCheck(
+        count_tokens(family, final_prompt),
+        count_tokens(family, final_negative),
+        TOKEN_LIMITS[family],
+        is_exact(family)
+    )
+
+
+def validate_prompt(model: str, prompt: str, negative: Optional[str]) -> Optional[str]:
+    """
+    精确计数超限时抛出 PromptTooLong；只能估算时不拒绝，返回警告文本
+    """
+    check = check_prompt(model, prompt, negative)
+    if not check.over_limit:
+        return None
+    name = MODELS.get(model, model)
+    if check.exact:
+        raise PromptTooLong(f'提示词超出 {name} 的长度上限（{check.describe()}），请删减后重试')
+    return f'提示词可能超出 {name} 的长度上限（{check.describe()}），超出部分会被截断'
+
+
+def validate_preset(prompt: str, negative: Optional[str]) -> Optional[str]:
+    """
+    预设会和其他提示词合并后用于任意模型：所有模型都精确超限时拒绝，部分超限时返回警告
+    """
+    over: Dict[str, Tuple[int, bool]] = {}
+    for family, limit in TOKEN_LIMITS.items():
+        tokens = max(count_tokens(family, prompt), count_tokens(family, negative or ''))
+        if tokens > limit:
+            over[family] = (tokens, is_exact(family))
+    if not over:
+        return None
+    if len(over) == len(TOKEN_LIMITS) and all(exact for _, exact in over.values()):
+        raise PromptTooLong(f'预设超出所有模型的长度上限（{over["t5"][0]} / {T5_TOKEN_LIMIT} tokens）')
+    label = {'clip': 'V3', 't5': 'V4'}
+    details = '，'.join(f'{label[family]} {"" if exact else "约 "}{tokens} / {TOKEN_LIMITS[family]} tokens'
+                        for family, (tokens, exact) in over.items())
+    return f'预设较长，用于部分模型时可能被截断（{details}）'
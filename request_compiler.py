@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+import json
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Any, Dict, Mapping, Optional
+
+from constants import MODELS
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+DEFAULT_NEGATIVE_PROMPT = 'lowres, bad anatomy, bad hands, text, error, missing fingers, extra digit, fewer digits, cropped, worst quality, low quality, normal quality, jpeg artifacts, signature, watermark, username, blurry'
+# 非V4模型自动添加的质量标签
+QUALITY_TAGS = 'masterpiece, best quality, '
+V4_PREFIX = 'nai-diffusion-4'
+
+# 所有请求共用的固定参数
+COMMON_PARAMETERS = {
+    'ucPreset': 0,
+    'qualityToggle': False,
+    'dynamic_thresholding': False,
+    'controlnet_strength': 1,
+    'legacy': False,
+    'add_original_image': False
+}
+# V4模型的固定参数
+V4_PARAMETERS = {
+    'params_version': 3,
+    'use_coords': True,
+    'sm': False,
+    'sm_dyn': False,
+    'noise_schedule': 'karras'
+}
+
+
+def dumps(obj: Any) -> bytes:
+    """序列化为紧凑的UTF-8 JSON，安装了orjson时使用orjson"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def _v4_caption(key: str) -> tuple[bytes, bytes]:
+    """v4_prompt / v4_negative_prompt 字段除提示词外的部分，拆成前后两段"""
+    marker = '\x00'
+    fragment = dumps({key: {
+        'caption': {'base_caption': marker, 'char_captions': []},
+        'use_coords': True,
+        'use_order': True
+    }})[1:-1]
+    head, tail = fragment.split(dumps(marker))
+    return head, tail
+
+
+V4_PROMPT_HEAD, V4_PROMPT_TAIL = _v4_caption('v4_prompt')
+V4_NEGATIVE_HEAD, V4_NEGATIVE_TAIL = _v4_caption('v4_negative_prompt')
+
+
+@dataclass(frozen=True, slots=True)
+class ModelTemplate:
+    """单个模型的请求模板，导入时生成，之后只读"""
+    model: str
+    is_v4: bool
+    defaults: Mapping[str, Any]
+    parameters: Mapping[str, Any]
+
+
+def _build_template(model: str) -> ModelTemplate:
+    is_v4 = model.startswith(V4_PREFIX)
+    defaults = {
+        'width': 832,
+        'height': 1216,
+        'scale': 7.0 if is_v4 else 5,
+        'sampler': 'k_euler_ancestral',
+        'steps': 28,
+        'n_samples': 1,
+        'ucPreset': 0,
+        'qualityToggle': False,
+        'negative_prompt': DEFAULT_NEGATIVE_PROMPT
+    }
+    if is_v4:
+        defaults.update(V4_PARAMETERS)
+    else:
+        defaults.update({'sm': True, 'sm_dyn': True})
+    parameters = dict(COMMON_PARAMETERS, **V4_PARAMETERS) if is_v4 else dict(COMMON_PARAMETERS)
+    return ModelTemplate(model, is_v4, MappingProxyType(defaults), MappingProxyType(parameters))
+
+
+TEMPLATES: Dict[str, ModelTemplate] = {model: _build_template(model) for model in MODELS}
+
+
+def get_template(model: str) -> ModelTemplate:
+    template = TEMPLATES.get(model)
+    if template is None:
+        # 列表外的模型（如局部重绘模型）首次使用时生成
+        template = TEMPLATES[model] = _build_template(model)
+    return template
+
+
+def get_model_defaults(model: str) -> Dict[str, Any]:
+    """获取模型默认参数（返回副本，可以修改）"""
+    return dict(get_template(model).defaults)
+
+
+@dataclass(frozen=True, slots=True)
+class CompiledRequest:
+    """
+    序列化完成的请求体
+
+    V4模型的 body 在 fallback_body 的基础上插入 v4_prompt 字段，
+    因此500错误时的简化重试直接使用 fallback_body，不需要再次序列化。
+    """
+    body: bytes
+    fallback_body: Optional[bytes]
+    seed: int
+    action: str
+
+
+def compile_request(params: Dict[str, Any], seed: int, stream: bool = False) -> CompiledRequest:
+    """
+    按模板生成请求体，seed 为已确定的实际种子
+
+    图生图的base64图片可能有数MB，整个请求体只序列化一次。
+    """
+    template = get_template(params['model'])
+    defaults = template.defaults
+
+    prompt = params['prompt'] if template.is_v4 else QUALITY_TAGS + params['prompt']
+    negative = params.get('negative_prompt') or defaults['negative_prompt']
+
+    parameters = {
+        'width': params['width'],
+        'height': params['height'],
+        'scale': params.get('cfg', 5) or defaults['scale'],
+        'sampler': params.get('sampler', 'k_euler_ancestral') or defaults['sampler'],
+        'steps': params.get('steps', 28) or defaults['steps'],
+        'seed': seed,
+        'n_samples': params.get('n_samples', 1),
+        'negative_prompt': negative
+    }
+    parameters.update(template.parameters)
+    if not template.is_v4:
+        smea = params.get('smea', False)
+        dyn = params.get('dyn', False)
+        parameters['sm'] = smea if smea is not None else defaults['sm']
+        parameters['sm_dyn'] = dyn if dyn is not None else defaults['sm_dyn']
+
+    action = 'generate'
+    if params.get('image'):
+        parameters['image'] = params['image']
+        parameters['strength'] = params.get('strength', 0.7)
+        parameters['noise'] = params.get('noise', 0.0)
+        parameters['extra_noise_seed'] = seed
+        if params.get('mask'):
+            action = 'infill'
+            parameters['mask'] = params['mask']
+        else:
+            action = 'img2img'
+    if stream:
+        parameters['stream'] = 'sse'
+
+    # parameters 必须是最后一个字段，请求体以 }} 结尾，V4字段插入在这之前
+    body = dumps({
+        'input': prompt,
+        'model': template.model,
+        'action': action,
+        'parameters': parameters
+    })
+    if not template.is_v4:
+        return CompiledRequest(body, None, seed, action)
+
+    full = b''.join((
+        body[:-2], b',',
+        V4_PROMPT_HEAD, dumps(prompt), V4_PROMPT_TAIL, b',',
+        V4_NEGATIVE_HEAD, dumps(negative), V4_NEGATIVE_TAIL,
+        b'}}'
+    ))
+    return CompiledRequest(full, body, seed, action)
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import dataclasses
+import json
+import logging
+import os
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 检查配置文件是否变化的间隔（秒）
+CONFIG_POLL_INTERVAL = 5.0
+CONFIG_FILE_NAME = 'runtime_config.json'
+
+
+class ConfigError(ValueError):
+    """配置项不存在或取值不合法"""
+
+
+def _option(default, description: str, env: Optional[str] = None, low=None, high=None, choices: Tuple = ()):
+    return field(default=default, metadata={
+        'description': description, 'env': env, 'low': low, 'high': high, 'choices': choices
+    })
+
+
+@dataclass(frozen=True, slots=True)
+class RuntimeConfig:
+    """
+    可在运行中调整的参数
+
+    默认值来自环境变量，配置文件和 /admin config 的修改覆盖默认值。
+    对象不可变，修改时整体替换，读取方每次使用时取 store.current。
+    """
+    generation_concurrency: int = _option(1, '同时进行的NovelAI请求数', 'GENERATION_CONCURRENCY', 1, 16)
+    delivery_concurrency: int = _option(4, '同时进行的Discord上传数', 'DELIVERY_CONCURRENCY', 1, 32)
+    job_timeout: float = _option(90.0, '单个任务的生成超时（秒）', 'JOB_TIMEOUT', 10, 600)
+    api_timeout: float = _option(60.0, 'NovelAI单次请求超时（秒）', 'API_TIMEOUT', 5, 600)
+    cleanup_interval: float = _option(300.0, '队列检查和统计日志的间隔（秒）', 'CLEANUP_INTERVAL', 10, 3600)
+    max_pixels: int = _option(832 * 1216, '最大像素数', 'MAX_PIXELS', 64 * 64, 2048 * 2048)
+    max_width: int = _option(1216, '最大宽度', 'MAX_WIDTH', 64, 2048)
+    max_height: int = _option(1216, '最大高度', 'MAX_HEIGHT', 64, 2048)
+    metadata_quality: int = _option(95, '清除元数据时JPEG/WebP的质量', 'METADATA_QUALITY', 50, 100)
+    metadata_compress_level: int = _option(9, '清除元数据时PNG的压缩级别', 'METADATA_COMPRESS_LEVEL', 0, 9)
+    sheet_quality: int = _option(90, '拼图的JPEG质量', 'SHEET_QUALITY', 50, 100)
+    contact_sheet: bool = _option(True, '多张结果拼成一张网格图上传', 'CONTACT_SHEET')
+    stream_preview: bool = _option(False, '默认使用流式生成显示实时预览', 'STREAM_PREVIEW')
+    queue_policy: str = _option('sjf', '队列调度策略', 'QUEUE_POLICY', choices=('sjf', 'fifo'))
+    queue_aging: float = _option(0.5, '每等待1秒提升的优先级（秒）', 'QUEUE_AGING', 0, 100)
+    degrade_queue_depth: int = _option(8, '排队任务数达到该值时进入降级模式', 'DEGRADE_QUEUE_DEPTH', 1, 1000)
+    degrade_wait: float = _option(180.0, '预估等待达到该值（秒）时进入降级模式', 'DEGRADE_WAIT', 10, 3600)
+    shed_queue_depth: int = _option(50, '排队任务数达到该值时暂停接收新任务', 'SHED_QUEUE_DEPTH', 1, 1000)
+    shed_wait: float = _option(600.0, '预估等待达到该值（秒）时暂停接收新任务', 'SHED_WAIT', 10, 3600)
+    degrade_hold: float = _option(60.0, '负载级别至少保持多久（秒）才会降回', 'DEGRADE_HOLD', 0, 3600)
+    degrade_max_steps: int = _option(20, '降级模式下的最大步数', 'DEGRADE_MAX_STEPS', 1, 50)
+    degrade_max_pixels: int = _option(768 * 768, '降级模式下文生图的最大像素数', 'DEGRADE_MAX_PIXELS', 64 * 64, 2048 * 2048)
+
+    @classmethod
+    def from_env(cls) -> 'RuntimeConfig':
+        values = {}
+        for f in dataclasses.fields(cls):
+            raw = os.getenv(f.metadata['env'] or '')
+            if raw:
+                try:
+                    values[f.name] = parse_value(f, raw)
+                except ConfigError as e:
+                    logger.error(f"[运行配置] 环境变量 {f.metadata['env']} 无效，使用默认值: {e}")
+        return cls(**values)
+
+    def replace(self, changes: Dict[str, Any]) -> 'RuntimeConfig':
+        """校验所有修改后返回新对象，任何一项不合法时整体不生效"""
+        known = {f.name: f for f in dataclasses.fields(self)}
+        checked = {}
+        for name, value in changes.items():
+            if name not in known:
+                raise ConfigError(f'未知的配置项: {name}')
+            checked[name] = parse_value(known[name], value)
+        return dataclasses.replace(self, **checked)
+
+    def diff(self, other: 'RuntimeConfig') -> Dict[str, Tuple[Any, Any]]:
+        return {f.name: (getattr(self, f.name), getattr(other, f.name))
+                for f in dataclasses.fields(self) if getattr(self, f.name) != getattr(other, f.name)}
+
+
+def config_fields() -> List[dataclasses.Field]:
+    return list(dataclasses.fields(RuntimeConfig))
+
+
+def parse_value(f: dataclasses.Field, value: Any) -> Any:
+    """把字符串或JSON值转换为字段类型并检查范围"""
+    kind = f.type
+    try:
+        if kind is bool:
+            if isinstance(value, str):
+                lowered = value.strip().lower()
+                if lowered not in ('1', 'true', 'yes', 'on', '0', 'false', 'no', 'off'):
+                    raise ValueError(value)
+                value = lowered in ('1', 'true', 'yes', 'on')
+            elif not isinstance(value, bool):
+                raise ValueError(value)
+        elif kind is int:
+            if isinstance(value, bool) or (isinstance(value, float) and not value.is_integer()):
+                raise ValueError(value)
+            value = int(value)
+        elif kind is float:
+            if isinstance(value, bool):
+                raise ValueError(value)
+            value = float(value)
+        else:
+            value = str(value).strip().lower()
+    except (TypeError, ValueError):
+        raise ConfigError(f'{f.name} 需要 {kind.__name__} 类型的值，收到: {value!r}')
+
+    meta = f.metadata
+    if meta['choices'] and value not in meta['choices']:
+        raise ConfigError(f"{f.name} 只能是 {', '.join(meta['choices'])}")
+    if meta['low'] is not None and not meta['low'] <= value <= meta['high']:
+        raise ConfigError(f"{f.name} 必须在 {meta['low']} 到 {meta['high']} 之间")
+    return value
+
+
+class RuntimeConfigStore:
+    """
+    持有当前配置，从 DATA_DIR 下的JSON文件加载覆盖值并监视文件变化
+
+    文件只保存与环境变量默认值不同的项。修改通过 update() 或编辑文件进行，
+    新配置整体校验后替换 current，并在同一次事件循环调度中依次通知订阅者，
+    其他协程不会看到只应用了一部分的配置。
+    """
+
+    def __init__(self, directory, defaults: Optional[RuntimeConfig] = None, name: str = CONFIG_FILE_NAME):
+        self.path = Path(directory) / name
+        self.defaults = defaults or RuntimeConfig.from_env()
+        self.current = self.defaults
+        self.overrides: Dict[str, Any] = {}
+        self._listeners: List[Callable[[RuntimeConfig, RuntimeConfig], None]] = []
+        self._stamp = None
+        self._task: Optional[asyncio.Task] = None
+
+    def subscribe(self, listener: Callable[[RuntimeConfig, RuntimeConfig], None]):
+        """listener(old, new) 在配置变化时同步调用，不能包含await"""
+        self._listeners.append(listener)
+
+    def _file_stamp(self):
+        try:
+            stat = self.path.stat()
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _apply(self, overrides: Dict[str, Any], source: str) -> RuntimeConfig:
+        new = self.defaults.replace(overrides)
+        old = self.current
+        changes = old.diff(new)
+        self.current = new
+        self.overrides = {name: getattr(new, name) for name in overrides}
+        if changes:
+            logger.info(f"[运行配置] 来源: {source} | " + ', '.join(f'{name}: {a} -> {b}' for name, (a, b) in changes.items()))
+            for listener in self._listeners:
+                try:
+                    listener(old, new)
+                except Exception as e:
+                    logger.exception(f"[运行配置] 应用失败: {e}")
+        return new
+
+    def load(self) -> RuntimeConfig:
+        """读取配置文件；文件内容不合法时保留当前配置"""
+        stamp = self._file_stamp()
+        self._stamp = stamp
+        if stamp is None:
+            return self._apply({}, 'default') if self.overrides else self.current
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                overrides = json.load(f)
+            if not isinstance(overrides, dict):
+                raise ConfigError('配置文件必须是JSON对象')
+            return self._apply(overrides, str(self.path))
+        except (OSError, ValueError) as e:
+            logger.error(f"[运行配置] 无法加载 {self.path}，保留当前配置: {e}")
+            return self.current
+
+    def _write(self, overrides: Dict[str, Any]):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # 先写临时文件再替换，监视方不会读到写了一半的文件
+        tmp_path = self.path.with_suffix('.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(overrides, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.path)
+
+    async def update(self, changes: Dict[str, Any]) -> RuntimeConfig:
+        """
+        修改配置并写回文件；值为None表示恢复默认值
+
+        先校验并在线程中写入文件，成功后才应用（监听器在事件循环中运行）。
+        校验失败时抛出 ConfigError，写入失败时抛出 OSError，文件和当前配置都不变。
+        """
+        overrides = dict(self.overrides)
+        for name, value in changes.items():
+            if value is None:
+                overrides.pop(name, None)
+            else:
+                overrides[name] = value
+        checked = self.defaults.replace(overrides)
+        overrides = {name: getattr(checked, name) for name in overrides}
+        await asyncio.to_thread(self._write, overrides)
+        new = self._apply(overrides, 'update')
+        self._stamp = self._file_stamp()
+        return new
+
+    async def _watch(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            if self._file_stamp() != self._stamp:
+                self.load()
+
+    def start(self, interval: float = CONFIG_POLL_INTERVAL):
+        if self._task is None:
+            self._task = asyncio.create_task(self._watch(interval))
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+import heapq
+import itertools
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from jobs import Job
+
+# 每百万像素·步的默认耗时（秒），运行中按实际耗时修正
+DEFAULT_SECONDS_PER_UNIT = 0.25
+MODEL_SECONDS_PER_UNIT = {
+    'nai-diffusion-4-5-full': 0.35,
+    'nai-diffusion-4-5-curated': 0.35,
+    'nai-diffusion-4-full': 0.3,
+    'nai-diffusion-4-curated': 0.3,
+    'nai-diffusion-4-curated-preview': 0.3,
+    'nai-diffusion-3': 0.2,
+    'nai-diffusion-3-inpainting': 0.2,
+    'nai-diffusion-furry-v3': 0.2
+}
+# 与尺寸无关的固定开销（网络往返、排队等），秒
+BASE_OVERHEAD = 2.0
+# 指数加权平均的平滑系数
+EWMA_ALPHA = 0.1
+# 拟合开销和系数所需的最少样本数
+MIN_FIT_SAMPLES = 5
+
+
+def cost_units(params: Dict[str, Any]) -> float:
+    """百万像素 × 步数 × 图片数量"""
+    pixels = params.get('width', 832) * params.get('height', 1216)
+    return pixels / 1e6 * params.get('steps', 28) * params.get('n_samples', 1)
+
+
+class CostModel:
+    """
+    按 像素 × 步数 × 模型系数 预估生成耗时
+
+    每个模型维护 (耗时 = 固定开销 + 系数 × 成本单位) 的在线线性拟合：对成本单位和实际API耗时的
+    一阶、二阶矩做指数加权平均，旧样本的权重逐渐衰减，能跟上API速度的变化。
+    样本不足或成本单位过于集中时使用经验值。
+    """
+
+    def __init__(self, alpha: float = EWMA_ALPHA, overhead: float = BASE_OVERHEAD):
+        self.alpha = alpha
+        self.overhead = overhead
+        # 模型 -> [样本数, E[x], E[y], E[x²], E[xy]]
+        self._moments: Dict[str, List[float]] = {}
+        self.observations = 0
+
+    def coefficients(self, model: Optional[str]) -> Tuple[float, float]:
+        """返回 (固定开销, 每单位耗时)"""
+        prior = (self.overhead, MODEL_SECONDS_PER_UNIT.get(model, DEFAULT_SECONDS_PER_UNIT))
+        moments = self._moments.get(model)
+        if moments is None:
+            return prior
+        count, mean_x, mean_y, mean_xx, mean_xy = moments
+        variance = mean_xx - mean_x * mean_x
+        if count < MIN_FIT_SAMPLES or variance < 1e-6:
+            # 样本尺寸过于集中，无法区分开销和系数，只按比例缩放经验值
+            scale = mean_y / (prior[0] + prior[1] * mean_x)
+            return prior[0] * scale, prior[1] * scale
+        slope = max(0.0, (mean_xy - mean_x * mean_y) / variance)
+        return max(0.0, mean_y - slope * mean_x), slope
+
+    def predict(self, params: Dict[str, Any]) -> float:
+        intercept, slope = self.coefficients(params.get('model'))
+        return intercept + slope * cost_units(params)
+
+    def observe(self, params: Dict[str, Any], seconds: float):
+        x = cost_units(params)
+        moments = self._moments.get(params.get('model'))
+        if moments is None:
+            self._moments[params.get('model')] = [1, x, seconds, x * x, x * seconds]
+        else:
+            moments[0] += 1
+            for i, value in enumerate((x, seconds, x * x, x * seconds), 1):
+                moments[i] += self.alpha * (value - moments[i])
+        self.observations += 1
+
+    def stats(self) -> Dict[str, Tuple[float, float]]:
+        return {model: self.coefficients(model) for model in self._moments}
+
+
+class CostAwareQueue:
+    """
+    按预估耗时排序的任务队列（最短预估任务优先 + 老化）
+
+    任务的优先级为 预估耗时 - 老化系数 × 已等待时间。由于所有任务的等待时间同步增长，
+    排序等价于按 预估耗时 + 老化系数 × 入队时间 排序，这个值在入队时即可确定，用堆维护即可。
+    一个任务最多被晚于它 (预估耗时差 / 老化系数) 秒内到达的任务插队。
+
+    policy 为 sjf（预估耗时短的优先，带老化）或 fifo；aging 为老化系数，每等待1秒优先级相当于
+    预估耗时减少 aging 秒，保证大任务不会被无限推后。两者都来自运行配置（queue_policy、queue_aging）。
+    """
+
+    def __init__(self, cost_model: CostModel, policy: str, aging: float):
+        self.cost_model = cost_model
+        self.policy = policy
+        self.aging = aging
+        self._heap: List[tuple] = []
+        self._counter = itertools.count()
+        # 正在生成的任务: id(task) -> (开始时间, 预估耗时)
+        self._running: Dict[int, tuple] = {}
+
+    def _key(self, task: Job) -> float:
+        if self.policy == 'fifo':
+            return task.enqueued_at
+        return task.predicted + self.aging * task.enqueued_at
+
+    def _prepare(self, task: Job):
+        if task.predicted is None:
+            task.predicted = self.cost_model.predict(task.params)
+
+    def append(self, task: Job) -> int:
+        """加入任务，返回按当前顺序的排队位置（从1开始）"""
+        self._prepare(task)
+        key = self._key(task)
+        heapq.heappush(self._heap, (key, next(self._counter), task))
+        return 1 + sum(1 for entry in self._heap if entry[0] < key)
+
+    def configure(self, policy: str, aging: float):
+        """修改调度策略，已排队的任务按新策略重新排序"""
+        self.policy = policy
+        self.aging = aging
+        self._heap = [(self._key(task), count, task) for _, count, task in self._heap]
+        heapq.heapify(self._heap)
+
+    def popleft(self) -> Job:
+        _, _, task = heapq.heappop(self._heap)
+        self._running[id(task)] = (time.monotonic(), task.predicted)
+        return task
+
+    def finish(self, task: Job, seconds: Optional[float] = None):
+        """任务生成结束；seconds 为成功时的实际API耗时，用于修正成本模型"""
+        self._running.pop(id(task), None)
+        if seconds is not None:
+            self.cost_model.observe(task.params, seconds)
+
+    def _running_remaining(self) -> float:
+        now = time.monotonic()
+        return sum(max(0.0, predicted - (now - started)) for started, predicted in self._running.values())
+
+    def backlog(self, concurrency: int) -> float:
+        """排队和正在生成的任务全部完成的预估时间（秒）"""
+        queued = sum(entry[2].predicted for entry in self._heap)
+        return (queued + self._running_remaining()) / max(1, concurrency)
+
+    def estimate_wait(self, task: Job, concurrency: int) -> float:
+        """预估任务从现在到开始生成的等待时间（秒），任务可以尚未入队"""
+        self._prepare(task)
+        key = self._key(task)
+        ahead = sum(entry[2].predicted for entry in self._heap
+                    if entry[0] < key and entry[2] is not task)
+        backlog = ahead + self._running_remaining()
+        # 有空闲生成槽位时无需等待
+        if len(self._running) < concurrency and ahead == 0:
+            return 0.0
+        return backlog / max(1, concurrency)
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def __bool__(self) -> bool:
+        return bool(self._heap)
+
+    def __iter__(self) -> Iterator[Job]:
+        """按出队顺序遍历"""
+        return (entry[2] for entry in sorted(self._heap, key=lambda entry: entry[:2]))
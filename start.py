@@ -1,26 +1,32 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 """
-Zeabur启动脚本 - 提供更好的日志输出
+Zeabur启动脚本 - 输出环境信息后在当前进程中启动bot
 """
 import os
 import sys
-import time
+import logging
 
-# 强制无缓冲输出
-os.environ['PYTHONUNBUFFERED'] = '1'
-sys.stdout.reconfigure(line_buffering=True) if hasattr(sys.stdout, 'reconfigure') else None
+from dotenv import load_dotenv
 
-print("=" * 60, flush=True)
-print("ZEABUR STARTUP SCRIPT", flush=True)
-print("=" * 60, flush=True)
-print(f"Python Version: {sys.version}", flush=True)
-print(f"Python Executable: {sys.executable}", flush=True)
-print(f"Current Directory: {os.getcwd()}", flush=True)
-print(f"Files in directory:", flush=True)
+from log_setup import setup_logging
+
+# 先加载.env，日志配置（LOG_LEVEL等）和下面的环境检查才能读到其中的值；
+# 日志在这里初始化后，main.py中的 setup_logging() 不再重复配置
+load_dotenv()
+setup_logging()
+logger = logging.getLogger('start')
+
+logger.info("=" * 60)
+logger.info("ZEABUR STARTUP SCRIPT")
+logger.info("=" * 60)
+logger.info(f"Python Version: {sys.version}")
+logger.info(f"Python Executable: {sys.executable}")
+logger.info(f"Current Directory: {os.getcwd()}")
+logger.info(f"Files in directory:")
 for file in os.listdir('.'):
-    print(f"  - {file}", flush=True)
-print("=" * 60, flush=True)
+    logger.info(f"  - {file}")
+logger.info("=" * 60)
 
 # 检查环境变量
 env_vars = {
@@ -28,61 +34,35 @@ env_vars = {
     'NAI_API_KEY': os.getenv('NAI_API_KEY'),
     'ZEABUR': os.getenv('ZEABUR'),
     'PORT': os.getenv('PORT'),
-    'PYTHONUNBUFFERED': os.getenv('PYTHONUNBUFFERED')
+    'LOG_LEVEL': os.getenv('LOG_LEVEL')
 }
 
-print("Environment Variables:", flush=True)
+logger.info("Environment Variables:")
 for key, value in env_vars.items():
     if key in ['DISCORD_TOKEN', 'NAI_API_KEY']:
         # 隐藏敏感信息
         display = '***' + value[-4:] if value and len(value) > 4 else 'NOT SET'
-        print(f"  {key}: {display}", flush=True)
+        logger.info(f"  {key}: {display}")
     else:
-        print(f"  {key}: {value or 'NOT SET'}", flush=True)
-
-print("=" * 60, flush=True)
+        logger.info(f"  {key}: {value or 'NOT SET'}")
 
-# 检查必需的环境变量
-missing = []
-if not env_vars['DISCORD_TOKEN']:
-    missing.append('DISCORD_TOKEN')
-if not env_vars['NAI_API_KEY']:
-    missing.append('NAI_API_KEY')
+logger.info("=" * 60)
 
+# 缺少必需的环境变量时由监督器保持进程运行，健康检查会报告未就绪
+missing = [key for key in ('DISCORD_TOKEN', 'NAI_API_KEY') if not env_vars[key]]
 if missing:
-    print(f"❌ ERROR: Missing required environment variables: {', '.join(missing)}", flush=True)
-    print("Please configure these in Zeabur dashboard", flush=True)
-    print("Keeping process alive for debugging...", flush=True)
-
-    while True:
-        time.sleep(30)
-        print(f"Still waiting for: {', '.join(missing)}", flush=True)
+    logger.error(f"❌ ERROR: Missing required environment variables: {', '.join(missing)}")
+    logger.error("Please configure these in Zeabur dashboard")
 else:
-    print("✓ All required environment variables are set", flush=True)
-    print("Starting main.py...", flush=True)
-    print("=" * 60, flush=True)
-
-    try:
-        # 导入并运行主程序
-        import subprocess
-        import sys
-        result = subprocess.run([sys.executable, 'main.py'], capture_output=False, text=True)
-        sys.exit(result.returncode)
-    except ImportError as e:
-        print(f"❌ Failed to import main.py: {e}", flush=True)
-        import traceback
-        traceback.print_exc()
+    logger.info("✓ All required environment variables are set")
+logger.info("Starting bot in-process under supervisor...")
+logger.info("=" * 60)
 
-        # 保持进程运行以便查看错误
-        while True:
-            time.sleep(60)
-            print("Process kept alive for debugging...", flush=True)
-    except Exception as e:
-        print(f"❌ Error starting bot: {e}", flush=True)
-        import traceback
-        traceback.print_exc()
+try:
+    # 在当前进程中运行，崩溃时由监督器重启连接，无需重新启动进程
+    import main
+except Exception as e:
+    logger.exception(f"❌ Failed to import main.py: {e}")
+    sys.exit(1)
 
-        # 保持进程运行以便查看错误
-        while True:
-            time.sleep(60)
-            print("Process kept alive for debugging...", flush=True)
\ No newline at end of file
+main.run()
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import base64
+import json
+import logging
+import time
+from typing import AsyncIterator, Awaitable, Callable, Optional, Tuple
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+# 每隔多少个中间步骤解码一次预览
+PREVIEW_EVERY_N = 4
+# 两次编辑预览消息之间的最小间隔（秒），Discord对消息编辑有速率限制
+PREVIEW_MIN_INTERVAL = 2.0
+
+
+def _parse_event(event: str, data_lines: list) -> Tuple[str, dict]:
+    payload = '\n'.join(data_lines)
+    try:
+        data = json.loads(payload)
+    except ValueError:
+        data = {'raw': payload}
+    return data.get('event_type', event), data
+
+
+async def iter_sse_events(response: aiohttp.ClientResponse) -> AsyncIterator[Tuple[str, dict]]:
+    """
+    逐条解析Server-Sent Events，返回 (事件类型, 数据)
+
+    最终图片的data行可能有数MB，超过aiohttp按行读取的上限，因此按块读取并自行分行。
+    """
+    event = 'message'
+    data_lines = []
+    buffer = bytearray()
+
+    async def lines():
+        scanned = 0
+        async for chunk in response.content.iter_any():
+            buffer.extend(chunk)
+            while True:
+                # 只在新到达的数据中查找换行，避免对长行重复扫描
+                pos = buffer.find(b'\n', scanned)
+                if pos < 0:
+                    scanned = len(buffer)
+                    break
+                line = bytes(buffer[:pos])
+                del buffer[:pos + 1]
+                scanned = 0
+                yield line.decode('utf-8').rstrip('\r')
+        if buffer:
+            yield buffer.decode('utf-8').rstrip('\r')
+
+    async for line in lines():
+        if not line:
+            # 空行表示一个事件结束
+            if data_lines:
+                yield _parse_event(event, data_lines)
+            event = 'message'
+            data_lines = []
+            continue
+        if line.startswith(':'):
+            continue
+        field, _, value = line.partition(':')
+        value = value[1:] if value.startswith(' ') else value
+        if field == 'event':
+            event = value
+        elif field == 'data':
+            data_lines.append(value)
+
+    if data_lines:
+        yield _parse_event(event, data_lines)
+
+
+class PreviewThrottler:
+    """
+    合并中间预览并按固定节奏推送
+
+    offer() 只记录最新的一帧（不解码），后台协程在间隔到达后才解码并调用 push，
+    因此无论API推送多快，消息编辑频率都不会超过 1 / min_interval。
+    """
+
+    def __init__(self, push: Callable[[bytes, int], Awaitable[None]],
+                 every_n: int = PREVIEW_EVERY_N, min_interval: float = PREVIEW_MIN_INTERVAL):
+        self.push = push
+        self.every_n = max(1, every_n)
+        self.min_interval = min_interval
+        self.received = 0
+        self.pushed = 0
+        self._pending: Optional[Tuple[str, int]] = None
+        self._last_push = 0.0
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._closed = False
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def offer(self, step: int, image_b64: str):
+        """收到一帧中间预览"""
+        self.received += 1
+        if self.received % self.every_n:
+            return
+        self._pending = (image_b64, step)
+        self._wakeup.set()
+
+    async def _run(self):
+        while not self._closed:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            delay = self._last_push + self.min_interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if self._pending is None or self._closed:
+                continue
+            image_b64, step = self._pending
+            self._pending = None
+            self._last_push = time.monotonic()
+            try:
+                await self.push(base64.b64decode(image_b64), step)
+                self.pushed += 1
+            except Exception as e:
+                logger.warning(f"[预览更新失败] 步骤: {step} | 错误: {e}")
+
+    async def close(self):
+        """停止推送，丢弃未发送的预览"""
+        self._closed = True
+        self._wakeup.set()
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
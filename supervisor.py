@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+import math
+import os
+import time
+from typing import Optional, Sequence
+
+import discord
+from aiohttp import web
+
+from http_server import HttpServer
+
+logger = logging.getLogger(__name__)
+
+# 崩溃后重启的退避时间（秒），连续崩溃时翻倍
+RESTART_BACKOFF_INITIAL = float(os.getenv('RESTART_BACKOFF_INITIAL', '1'))
+RESTART_BACKOFF_MAX = float(os.getenv('RESTART_BACKOFF_MAX', '60'))
+# 连接持续运行超过该时长（秒）后视为稳定，退避时间重置
+RESTART_STABLE_AFTER = 300
+
+
+class Supervisor:
+    """
+    在同一进程和事件循环中运行bot，连接崩溃时按指数退避重启
+
+    重启只重建Discord连接（bot.clear() 后重新登录），队列、生成历史、成本模型和各类缓存都是模块级状态，
+    在重启之间保持不变，正在生成和上传的任务继续执行。
+    提供HTTP服务时注册 /healthz（事件循环能响应即存活）和 /readyz（已连接到Discord）。
+    """
+
+    def __init__(self, bot: discord.Client, token: Optional[str], http_server: Optional[HttpServer] = None,
+                 missing: Sequence[str] = ()):
+        self.bot = bot
+        self.token = token
+        self.missing = list(missing)
+        self.started = time.monotonic()
+        self.restarts = 0
+        self.crashed_at: Optional[float] = None
+        # 最近一次从崩溃到重新就绪的耗时
+        self.last_recovery: Optional[float] = None
+        self.last_error: Optional[str] = None
+        bot.add_listener(self._on_ready, 'on_ready')
+        if http_server is not None:
+            http_server.app.router.add_get('/healthz', self.handle_healthz)
+            http_server.app.router.add_get('/readyz', self.handle_readyz)
+
+    @property
+    def ready(self) -> bool:
+        return not self.bot.is_closed() and self.bot.is_ready()
+
+    async def _on_ready(self):
+        if self.crashed_at is not None:
+            self.last_recovery = time.monotonic() - self.crashed_at
+            self.crashed_at = None
+            logger.info(f"[重启完成] 第 {self.restarts} 次重启 | 从崩溃到就绪耗时: {self.last_recovery:.2f}秒")
+
+    def status(self) -> dict:
+        # 收到第一次心跳确认之前延迟为inf
+        latency = self.bot.latency if self.ready else float('nan')
+        return {
+            'ready': self.ready,
+            'uptime': round(time.monotonic() - self.started, 1),
+            'restarts': self.restarts,
+            'last_recovery_seconds': None if self.last_recovery is None else round(self.last_recovery, 3),
+            'last_error': self.last_error,
+            'missing_config': self.missing,
+            'latency_ms': round(latency * 1000) if math.isfinite(latency) else None
+        }
+
+    async def handle_healthz(self, request: web.Request) -> web.Response:
+        """存活探针：能执行到这里说明事件循环没有卡死"""
+        return web.json_response({'status': 'ok'})
+
+    async def handle_readyz(self, request: web.Request) -> web.Response:
+        """就绪探针：已连接到Discord时返回200，否则503"""
+        return web.json_response(self.status(), status=200 if self.ready else 503)
+
+    async def run(self):
+        if self.missing:
+            # 缺少配置时重启没有意义：保持进程和探针运行以便查看日志，等待重新部署
+            logger.error(f"[启动失败] 缺少必需的环境变量: {', '.join(self.missing)}，请配置后重新部署")
+            self.last_error = 'missing configuration'
+            await asyncio.Event().wait()
+
+        backoff = RESTART_BACKOFF_INITIAL
+        while True:
+            attempt_started = time.monotonic()
+            try:
+                async with self.bot:
+                    await self.bot.start(self.token, reconnect=True)
+                # 只有主动调用 bot.close() 时 start 才会正常返回
+                logger.info("[Bot停止] 连接已关闭")
+                return
+            except discord.LoginFailure as e:
+                # 令牌无效时重试也不会成功，按最大退避时间等待
+                self.last_error = f'LoginFailure: {e}'
+                logger.error(f"[登录失败] {e}，请检查DISCORD_TOKEN")
+                backoff = RESTART_BACKOFF_MAX
+            except Exception as e:
+                self.last_error = f'{type(e).__name__}: {e}'
+                logger.exception(f"[Bot崩溃] {self.last_error}")
+
+            if time.monotonic() - attempt_started > RESTART_STABLE_AFTER:
+                backoff = RESTART_BACKOFF_INITIAL
+            if self.crashed_at is None:
+                self.crashed_at = time.monotonic()
+            self.restarts += 1
+            logger.info(f"[重启] {backoff:g}秒后进行第 {self.restarts} 次重启")
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, RESTART_BACKOFF_MAX)
+            # 清空上一次连接的缓存和关闭状态，之后可以重新登录；
+            # 关闭会话时连接器也随之关闭，需要让下一次登录重新创建
+            self.bot.clear()
+            self.bot.http.connector = discord.utils.MISSING